@@ -1,7 +1,11 @@
+import argparse
+import importlib.util
+import sys
 import psycopg2
 import traceback
 import testHelper
 import Interface as MyAssignment
+import Instrumentation
 import time
 
 # Constants
@@ -11,6 +15,8 @@ RANGE_TABLE_PREFIX = 'range_part'
 RROBIN_TABLE_PREFIX = 'rrobin_part'
 INPUT_FILE_PATH = 'ratings.dat'
 ACTUAL_ROWS_IN_INPUT_FILE = 10000054
+# Ratings of the asyncio interface test, which replaces the partitions of the ratings table
+ASYNC_RATINGS_TABLE = 'asyncratings'
 
 def print_progress(message, indent=0):
     """Print progress message with timestamp and indentation"""
@@ -34,71 +40,284 @@ def verify_partition_content(conn, prefix, number_of_partitions):
     print_progress("Partition content passed!" if total_rows == original_count else "Partition content failed!")
     cur.close()
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Test the Interface functions without any prompts")
+    parser.add_argument('--partitioning', choices=['range', 'roundrobin', 'both'], default='both')
+    parser.add_argument('--ratings-file', default=INPUT_FILE_PATH)
+    parser.add_argument('--rows', type=int, default=ACTUAL_ROWS_IN_INPUT_FILE, help="rows in the ratings file")
+    parser.add_argument('--keep-tables', action='store_true', help="keep the tables instead of deleting them at the end")
+    parser.add_argument('--dbname', default=DATABASE_NAME)
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='1234')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5432)
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
+    passed = True
     try:
         print_progress("Starting test...")
-        testHelper.createdb(DATABASE_NAME)
+        conn = MyAssignment.getopenconnection(args.user, args.password, 'postgres', args.host, args.port)
+        MyAssignment.create_db(args.dbname, conn)
+        # Other databases of the server stand in for the shard nodes
+        shards = [dict(dbname=f"{args.dbname}_shard{i}") for i in range(2)]
+        for shard in shards:
+            MyAssignment.create_db(shard['dbname'], conn)
+        conn.close()
 
-        with testHelper.getopenconnection(dbname=DATABASE_NAME) as conn:
+        with MyAssignment.getopenconnection(args.user, args.password, args.dbname, args.host, args.port) as conn:
             conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
             testHelper.deleteAllPublicTables(conn)
+            # Connection in the default transaction mode for the inserts in a transaction of the caller
+            txconn = MyAssignment.getopenconnection(args.user, args.password, args.dbname, args.host, args.port)
 
             # Test loadratings
             print_progress("Testing loadratings...")
             start_time = time.time()
-            [result, e] = testHelper.testloadratings(MyAssignment, RATINGS_TABLE, INPUT_FILE_PATH, conn, ACTUAL_ROWS_IN_INPUT_FILE)
+            [result, e] = testHelper.testloadratings(MyAssignment, RATINGS_TABLE, args.ratings_file, conn, args.rows)
             load_time = time.time() - start_time
             print_progress(f"loadratings: {'passed' if result else 'failed'}! ({load_time:.3f} seconds)")
+            passed &= result
+
+            print_progress("Testing loadratings with 4 workers...")
+            [result, e] = testHelper.testparallelload(MyAssignment, RATINGS_TABLE, 'parallelratings', args.ratings_file,
+                                                      conn, 4)
+            print_progress(f"loadratings with 4 workers: {'passed' if result else 'failed'}!")
+            passed &= result
+
+            print_progress("Testing loadratings with the text and binary copy formats...")
+            [result, e] = testHelper.testcopyformats(MyAssignment, 'copyformats', conn)
+            print_progress(f"loadratings copy formats: {'passed' if result else 'failed'}!")
+            passed &= result
+
+            print_progress("Testing loadratings with compressed files, a file object and stdin...")
+            [result, e] = testHelper.teststreamedinputs(MyAssignment, 'streamedratings', conn)
+            print_progress(f"loadratings of streamed inputs: {'passed' if result else 'failed'}!")
+            passed &= result
 
-            # Get partition choice
-            partition_choice = input("\nChoose partitioning (range/roundrobin): ").strip().lower()
+            print_progress("Testing loadprogress of a resumable load...")
+            [result, e] = testHelper.testloadprogress(MyAssignment, 'loadprogress', conn)
+            print_progress(f"loadprogress: {'passed' if result else 'failed'}!")
+            passed &= result
+
+            # Rows in the ratings table, which every insert adds to
+            rows = args.rows
             start_time = time.time()
 
-            if partition_choice == 'range':
+            if args.partitioning in ('range', 'both'):
                 print_progress("Testing RANGE partitioning...")
                 print_progress("Creating 5 range partitions...")
-                [result, e] = testHelper.testrangepartition(MyAssignment, RATINGS_TABLE, 5, conn, 0, ACTUAL_ROWS_IN_INPUT_FILE)
+                [result, e] = testHelper.testrangepartition(MyAssignment, RATINGS_TABLE, 5, conn, 0, rows)
                 if result:
                     print_progress("rangepartition passed!")
                     verify_partition_content(conn, RANGE_TABLE_PREFIX, 5)
                 else:
                     print_progress("rangepartition failed!")
+                passed &= result
+
+                print_progress("Testing range partitioning with 3 workers...")
+                [result, e] = testHelper.testparallelpartition(MyAssignment, RATINGS_TABLE, 'range', 5, conn,
+                                                               RANGE_TABLE_PREFIX, 3)
+                print_progress(f"rangepartition with 3 workers: {'passed' if result else 'failed'}!")
+                passed &= result
 
                 print_progress("Testing range insert...")
                 [result, e] = testHelper.testrangeinsert(MyAssignment, RATINGS_TABLE, 100, 2, 3, conn, '2')
                 print_progress(f"rangeinsert: {'passed' if result else 'failed'}!")
+                passed &= result
+                rows += 1
+
+                print_progress("Testing range insert in a transaction...")
+                [result, e] = testHelper.testinsertintransaction(MyAssignment, 'rangeinsert', RATINGS_TABLE, 100, 3, 0.5,
+                                                                 txconn, RANGE_TABLE_PREFIX, '0')
+                print_progress(f"rangeinsert in a transaction: {'passed' if result else 'failed'}!")
+                passed &= result
+                rows += 1
+
+                print_progress("Testing range batch insert...")
+                [result, e] = testHelper.testinsertmany(MyAssignment, 'rangeinsert_many', RATINGS_TABLE,
+                                                        [(100, 5, 0.5), (100, 6, 2.5), (100, 7, 5)], conn,
+                                                        RANGE_TABLE_PREFIX, ['0', '2', '4'])
+                print_progress(f"rangeinsert_many: {'passed' if result else 'failed'}!")
+                passed &= result
+                rows += 3
 
-            elif partition_choice == 'roundrobin':
+                print_progress("Testing the buffered writer...")
+                [result, e] = testHelper.testbufferedwriter(MyAssignment, RATINGS_TABLE, 'range',
+                                                            [(100, 17, 1), (100, 18, 4)], conn, RANGE_TABLE_PREFIX,
+                                                            ['0', '3'])
+                print_progress(f"BufferedWriter: {'passed' if result else 'failed'}!")
+                passed &= result
+                rows += 2
+
+                print_progress("Testing range batch insert with malformed ids...")
+                [result, e] = testHelper.testinsertmanyrejects(MyAssignment, 'rangeinsert_many', RATINGS_TABLE, conn)
+                print_progress(f"rangeinsert_many with malformed ids: {'passed' if result else 'failed'}!")
+                passed &= result
+
+                print_progress("Testing range queries after a rebuild by another process...")
+                [result, e] = testHelper.testqueriesafterrebuild(MyAssignment, RATINGS_TABLE, 3, 5, conn, 1.5, 3.5)
+                print_progress(f"rangequery and pointquery after a rebuild: {'passed' if result else 'failed'}!")
+                passed &= result
+
+                print_progress("Testing the connection pool...")
+                [result, e] = testHelper.testconnectionpool(MyAssignment, RATINGS_TABLE, 5, conn, 2.5)
+                print_progress(f"ConnectionPool: {'passed' if result else 'failed'}!")
+                passed &= result
+
+                print_progress("Repartitioning from 5 to 6 range partitions...")
+                [result, e] = testHelper.testrepartition(MyAssignment, RATINGS_TABLE, 'range', 6, conn, RANGE_TABLE_PREFIX)
+                print_progress(f"rangerepartition: {'passed' if result else 'failed'}!")
+                passed &= result
+
+                print_progress("Testing range insert after the repartitioning...")
+                [result, e] = testHelper.testrangeinsert(MyAssignment, RATINGS_TABLE, 100, 10, 1, conn, '1')
+                print_progress(f"rangeinsert after rangerepartition: {'passed' if result else 'failed'}!")
+                passed &= result
+                rows += 1
+
+            if args.partitioning in ('roundrobin', 'both'):
                 print_progress("Testing ROUND ROBIN partitioning...")
                 print_progress("Creating 5 roundrobin partitions...")
-                [result, e] = testHelper.testroundrobinpartition(MyAssignment, RATINGS_TABLE, 5, conn, 0, ACTUAL_ROWS_IN_INPUT_FILE)
+                [result, e] = testHelper.testroundrobinpartition(MyAssignment, RATINGS_TABLE, 5, conn, 0, rows)
                 if result:
                     print_progress("roundrobinpartition passed!")
                     verify_partition_content(conn, RROBIN_TABLE_PREFIX, 5)
                 else:
                     print_progress("roundrobinpartition failed!")
+                passed &= result
+
+                print_progress("Testing roundrobin partitioning with 3 workers...")
+                [result, e] = testHelper.testparallelpartition(MyAssignment, RATINGS_TABLE, 'roundrobin', 5, conn,
+                                                               RROBIN_TABLE_PREFIX, 3)
+                print_progress(f"roundrobinpartition with 3 workers: {'passed' if result else 'failed'}!")
+                passed &= result
 
                 print_progress("Testing roundrobin insert...")
-                [result, e] = testHelper.testroundrobininsert(MyAssignment, RATINGS_TABLE, 100, 1, 3, conn, '4')
+                # The row after the first rows goes to partition rows % 5
+                [result, e] = testHelper.testroundrobininsert(MyAssignment, RATINGS_TABLE, 100, 1, 3, conn, str(rows % 5))
                 print_progress(f"roundrobininsert: {'passed' if result else 'failed'}!")
+                passed &= result
+                rows += 1
 
-            else:
-                print_progress("Invalid choice! Choose 'range' or 'roundrobin'.")
-                return
+                print_progress("Testing roundrobin insert in a transaction...")
+                [result, e] = testHelper.testinsertintransaction(MyAssignment, 'roundrobininsert', RATINGS_TABLE, 100, 4,
+                                                                 3, txconn, RROBIN_TABLE_PREFIX, str(rows % 5))
+                print_progress(f"roundrobininsert in a transaction: {'passed' if result else 'failed'}!")
+                passed &= result
+                rows += 1
+
+                print_progress("Testing roundrobin batch insert...")
+                # The rows continue the rotation where the single inserts left it
+                [result, e] = testHelper.testinsertmany(MyAssignment, 'roundrobininsert_many', RATINGS_TABLE,
+                                                        [(100, 5, 1), (100, 6, 2), (100, 7, 3)], conn,
+                                                        RROBIN_TABLE_PREFIX, [str((rows + i) % 5) for i in range(3)])
+                print_progress(f"roundrobininsert_many: {'passed' if result else 'failed'}!")
+                passed &= result
+                rows += 3
+
+                print_progress("Testing roundrobin batch insert with malformed ids...")
+                [result, e] = testHelper.testinsertmanyrejects(MyAssignment, 'roundrobininsert_many', RATINGS_TABLE, conn)
+                print_progress(f"roundrobininsert_many with malformed ids: {'passed' if result else 'failed'}!")
+                passed &= result
+
+                print_progress("Repartitioning from 5 to 3 roundrobin partitions...")
+                [result, e] = testHelper.testrepartition(MyAssignment, RATINGS_TABLE, 'roundrobin', 3, conn,
+                                                         RROBIN_TABLE_PREFIX)
+                print_progress(f"roundrobinrepartition: {'passed' if result else 'failed'}!")
+                passed &= result
+
+                print_progress("Testing roundrobin insert after the repartitioning...")
+                # The rotation continues over the 3 partitions
+                [result, e] = testHelper.testroundrobininsert(MyAssignment, RATINGS_TABLE, 100, 11, 2, conn, str(rows % 3))
+                print_progress(f"roundrobininsert after roundrobinrepartition: {'passed' if result else 'failed'}!")
+                passed &= result
+                rows += 1
 
             # Display total execution time
             elapsed_time = time.time() - start_time
             print_progress(f"Total partitioning + insert time: {elapsed_time:.3f} seconds")
 
+            for key in ('movieid', 'userid'):
+                print_progress(f"Testing hash partitioning by {key}...")
+                [result, e] = testHelper.testhashpartition(MyAssignment, RATINGS_TABLE, 5, key, conn)
+                print_progress(f"hashpartition by {key}: {'passed' if result else 'failed'}!")
+                passed &= result
+
+            print_progress("Testing hash insert and hash query...")
+            [result, e] = testHelper.testhashinsert(MyAssignment, RATINGS_TABLE, 100, 12, 3.0, conn)
+            print_progress(f"hashinsert and hashquery: {'passed' if result else 'failed'}!")
+            passed &= result
+            rows += 1
+
+            print_progress("Testing the instrumentation of an aggregate over the hash partitions...")
+            [result, e] = testHelper.testinstrumentation(MyAssignment, Instrumentation, 'hash', conn)
+            print_progress(f"Instrumentation: {'passed' if result else 'failed'}!")
+            passed &= result
+
+            for scheme, prefix, rating, index in (('range', RANGE_TABLE_PREFIX, (100, 13, 4.5), '4'),
+                                                  ('roundrobin', RROBIN_TABLE_PREFIX, (100, 14, 2.5), None)):
+                print_progress(f"Testing {scheme} partitioning on 2 shards...")
+                # The round robin row follows the rows of the ratings table
+                [result, e] = testHelper.testshardedpartition(MyAssignment, RATINGS_TABLE, scheme, 5, conn, prefix, shards,
+                                                              rating, index or str(rows % 5))
+                print_progress(f"{scheme}partition on shards: {'passed' if result else 'failed'}!")
+                passed &= result
+                rows += 1
+
+            for scheme, prefix in (('range', RANGE_TABLE_PREFIX), ('roundrobin', RROBIN_TABLE_PREFIX)):
+                print_progress(f"Testing the statistics of the {scheme} partitions...")
+                [result, e] = testHelper.testratingstats(MyAssignment, RATINGS_TABLE, scheme, 5,
+                                                         [(100, 15, 0.5), (100, 16, 5), (101, 15, 2.5)], conn, prefix)
+                print_progress(f"ratingstats and checkstats of the {scheme} partitions: "
+                               f"{'passed' if result else 'failed'}!")
+                passed &= result
+                rows += 3
+
+            for scheme, prefix in (('range', RANGE_TABLE_PREFIX), ('roundrobin', RROBIN_TABLE_PREFIX)):
+                print_progress(f"Testing aggregate over the {scheme} partitions...")
+                [result, e] = testHelper.testaggregate(MyAssignment, scheme, 5, conn, prefix, 1.5, 3.5)
+                print_progress(f"aggregate over the {scheme} partitions: {'passed' if result else 'failed'}!")
+                passed &= result
+
+            print_progress("Testing loadandpartition of the ratings file into 5 partitions of both schemes...")
+            [result, e] = testHelper.testloadandpartition(MyAssignment, RATINGS_TABLE, args.ratings_file, conn, 5,
+                                                          args.rows)
+            print_progress(f"loadandpartition: {'passed' if result else 'failed'}!")
+            passed &= result
+            rows = args.rows
+
+            # The asyncio interface needs asyncpg, which the other functions do not
+            if importlib.util.find_spec('asyncpg') is None:
+                print_progress("AsyncInterface: skipped, asyncpg is not installed")
+            else:
+                import AsyncInterface
+                print_progress("Testing the asyncio interface with 5 partitions over 2 connections...")
+                # The round robin row follows the rows of the file and the range row
+                [result, e] = testHelper.testasyncinterface(AsyncInterface, ASYNC_RATINGS_TABLE, args.ratings_file, 5,
+                                                            [(100, 8, 2.0), (100, 9, 3.0)], conn, args.rows,
+                                                            ['1', str((args.rows + 1) % 5)], 2)
+                print_progress(f"AsyncInterface: {'passed' if result else 'failed'}!")
+                passed &= result
+
+            txconn.close()
+
             # Delete tables
-            if input('\nPress enter to delete all tables: ') == '':
+            if not args.keep_tables:
                 print_progress("Deleting all tables...")
                 testHelper.deleteAllPublicTables(conn)
+                for shard in shards:
+                    with testHelper.getshardconnection(MyAssignment, conn, shard) as shardconn:
+                        shardconn.autocommit = True
+                        testHelper.deleteAllPublicTables(shardconn)
                 print_progress("Tables deleted.")
 
     except Exception:
         print_progress("Error occurred:")
         traceback.print_exc()
+        passed = False
+    return 0 if passed else 1
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
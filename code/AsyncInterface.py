@@ -0,0 +1,412 @@
+#
+# Asyncio interface for the assignment, the operations of Interface on asyncpg connection pools
+#
+
+import asyncio
+import functools
+import io
+import mmap
+import time
+
+import asyncpg
+
+import Interface
+from Interface import PARTITION_CATALOG_TABLE, RANGE_TABLE_PREFIX, ROUNDROBIN_STATE_TABLE, RROBIN_TABLE_PREFIX
+
+# Connection arguments, partition catalog cache and catalog listener of every pool opened by getopenpool
+_pools = {}
+
+
+async def getopenpool(user='postgres', password='1234', dbname='postgres', host='localhost', port=5432,
+                      minconn=1, maxconn=10):
+    """
+    Function to open an asyncpg connection pool with the arguments of Interface.getopenconnection.
+    """
+    params = dict(user=user, password=password, database=dbname, host=host, port=port)
+    pool = await asyncpg.create_pool(min_size=minconn, max_size=maxconn, **params)
+    _pools[pool] = {'params': params, 'catalog': {}, 'listener': None, 'lock': asyncio.Lock()}
+    return pool
+
+
+async def closepool(openpool):
+    """
+    Function to close a pool opened by getopenpool together with its catalog listener.
+    """
+    state = _pools.pop(openpool, None)
+    if state is not None and state['listener'] is not None:
+        await state['listener'].close()
+    await openpool.close()
+
+
+async def loadratings(ratingstablename, ratingsfilepath, openpool, numberofworkers=1):
+    """
+    Function to load data in @ratingsfilepath file to a table called @ratingstablename.
+    The file is split into @numberofworkers slices at line boundaries. Every slice is parsed in vectorized blocks
+    and sent as a binary COPY stream on its own connection of @openpool, all slices at the same time.
+    Returns the load statistics (rows, seconds, rows per second) of every worker.
+    """
+    async with openpool.acquire() as con:
+        await con.execute(f"""
+            DROP TABLE IF EXISTS {ratingstablename};
+            CREATE TABLE {ratingstablename} (
+                userid integer,
+                movieid integer,
+                rating float
+            )
+        """)
+
+    slices = Interface._splitfile(ratingsfilepath, numberofworkers)
+    return await asyncio.gather(*[
+        _copyslice(ratingstablename, ratingsfilepath, start, end, openpool) for start, end in slices
+    ])
+
+
+async def _copyslice(tablename, ratingsfilepath, start, end, openpool):
+    """
+    Function to COPY the lines between byte offsets @start and @end of @ratingsfilepath into @tablename.
+    The blocks are parsed in a worker thread while the previous block is sent.
+    """
+    started = time.perf_counter()
+    rows = 0
+
+    with open(ratingsfilepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        async def tuples():
+            nonlocal rows
+            yield Interface._PGCOPY_HEADER
+            for blockstart, blockend in Interface._lineblocks(mm, start, end):
+                userid, movieid, rating = await asyncio.to_thread(Interface._parsemapped, mm, blockstart, blockend)
+                rows += len(userid)
+                yield Interface._pgcopytuples(userid, movieid, rating)
+            yield Interface._PGCOPY_TRAILER
+
+        async with openpool.acquire() as con:
+            await con.copy_to_table(tablename, source=tuples(), columns=['userid', 'movieid', 'rating'],
+                                    format='binary')
+
+    return Interface._loadstats(rows, started)
+
+
+async def rangepartition(ratingstablename, numberofpartitions, openpool, numberofworkers=None):
+    """
+    Function to create partitions of main table based on range of ratings, with the tables of
+    Interface.rangepartition. Every partition is filled into an UNLOGGED staging table by its own
+    INSERT ... SELECT, on up to @numberofworkers connections at the same time, one per partition by default and
+    never more than the pool holds. The staging tables replace the previous partitions in one transaction once
+    all of them are complete. A failed build is rolled back as a whole and leaves the previous partitions as
+    they were.
+    """
+    bounds = Interface._rangebounds(numberofpartitions)
+    tablenames = [f"{RANGE_TABLE_PREFIX}{i}" for i in range(numberofpartitions)]
+    async with openpool.acquire() as con:
+        await con.execute(Interface._stagingtablessql(tablenames, Interface._rangestagingconstraints(bounds)))
+
+    # Each partition selects the rows of its PostgreSQL range bounds, worker i fills partitions i, i + workers, ...
+    statements = [
+        """
+            INSERT INTO {}{}
+            SELECT userid, movieid, rating
+            FROM {}
+            WHERE rating >= {!r} AND rating < {!r};
+            {};
+        """.format(tablename, Interface._STAGING_SUFFIX, ratingstablename, minRange, maxRange, _finishstagingsql(tablename))
+        for tablename, (minRange, maxRange) in zip(tablenames, Interface._rangepartitionbounds(bounds))
+    ]
+    workers = _numberofworkers(openpool, numberofworkers, numberofpartitions)
+    await _fillstagingtables(openpool, tablenames, [''.join(statements[i::workers]) for i in range(workers)])
+
+    async with openpool.acquire() as con:
+        async with con.transaction():
+            await con.execute(Interface._rangetablessql(bounds, staged=True))
+            await _dropstats(con, 'range')
+            await _registerpartitions(con, 'range', ratingstablename, bounds, tablenames)
+    _invalidatecatalog(openpool, 'range')
+
+
+async def roundrobinpartition(ratingstablename, numberofpartitions, openpool, numberofworkers=None):
+    """
+    Function to create partitions of main table using round robin approach, with the tables of
+    Interface.roundrobinpartition. The main table is read once on one connection and its rows are dealt out to
+    COPYs on up to @numberofworkers writer connections, one per partition by default and never more than the
+    other connections of the pool, into UNLOGGED staging tables that replace the previous partitions in one
+    transaction once all of them are complete, like in rangepartition.
+    """
+    if openpool.get_max_size() < 2:
+        raise ValueError("Round robin partitioning reads and writes at the same time, it needs a pool of at least "
+                         "two connections")
+    tablenames = [f"{RROBIN_TABLE_PREFIX}{i}" for i in range(numberofpartitions)]
+    async with openpool.acquire() as con:
+        await con.execute(Interface._stagingtablessql(tablenames))
+
+    # The reader takes one connection of the pool
+    workers = _numberofworkers(openpool, numberofworkers, numberofpartitions, reserved=1)
+    queues = [asyncio.Queue(maxsize=4) for _ in range(workers)]
+    dealer = _RoundRobinDealer(queues, tablenames)
+
+    async def read(con):
+        try:
+            await con.copy_from_table(ratingstablename, output=dealer.write, columns=['userid', 'movieid', 'rating'])
+            await dealer.flush()
+        finally:
+            for rows in queues:
+                await rows.put(None)
+
+    async def write(con, rows, tablenames):
+        while (chunk := await rows.get()) is not None:
+            tablename, data = chunk
+            await con.copy_to_table(tablename + Interface._STAGING_SUFFIX, source=io.BytesIO(data),
+                                    columns=['userid', 'movieid', 'rating'])
+        await con.execute('; '.join(_finishstagingsql(tablename) for tablename in tablenames))
+
+    # The reader and all writers keep their transactions open until every stream succeeded
+    await _fillstagingtables(openpool, tablenames, [read] + [
+        functools.partial(write, rows=rows, tablenames=tablenames[i::workers]) for i, rows in enumerate(queues)
+    ])
+
+    async with openpool.acquire() as con:
+        async with con.transaction():
+            previouspartitions = 0
+            if await con.fetchval("SELECT to_regclass($1)", ROUNDROBIN_STATE_TABLE) is not None:
+                previouspartitions = await con.fetchval(
+                    f"SELECT COALESCE(MAX(numberofpartitions), 0) FROM {ROUNDROBIN_STATE_TABLE}")
+            await con.execute(Interface._roundrobintablessql(numberofpartitions, previouspartitions, staged=True))
+            await con.execute(Interface._ROUNDROBIN_STATE_SQL)
+            await con.execute(f"DELETE FROM {ROUNDROBIN_STATE_TABLE}")
+            await con.execute(f"INSERT INTO {ROUNDROBIN_STATE_TABLE} VALUES ($1, $2)", numberofpartitions, dealer.rows)
+            await _dropstats(con, 'roundrobin')
+            await _registerpartitions(con, 'roundrobin', ratingstablename, None, tablenames)
+    _invalidatecatalog(openpool, 'roundrobin')
+
+
+class _RoundRobinDealer:
+    """
+    Output of COPY TO that cuts the data into rows and deals every chunk out to the partitions of @tablenames,
+    the rows of tablenames[i] going to the queue of writer i % len(queues) as (tablename, rows).
+    """
+    def __init__(self, queues, tablenames, chunk_size=100000):
+        self.queues = queues
+        self.tablenames = tablenames
+        self.chunk_size = chunk_size
+        self.partial = b''
+        self.chunk = []
+        self.rows = 0
+
+    async def write(self, data):
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        self.chunk.extend(lines)
+        if len(self.chunk) >= self.chunk_size:
+            await self.flush()
+
+    async def flush(self):
+        # Row self.rows + j goes to partition (self.rows + j) % numberofpartitions
+        numberofpartitions = len(self.tablenames)
+        for i, tablename in enumerate(self.tablenames):
+            lines = self.chunk[(i - self.rows) % numberofpartitions::numberofpartitions]
+            if lines:
+                await self.queues[i % len(self.queues)].put((tablename, b'\n'.join(lines) + b'\n'))
+        self.rows += len(self.chunk)
+        self.chunk = []
+
+
+def _numberofworkers(openpool, numberofworkers, numberofpartitions, reserved=0):
+    """
+    Function to get the number of connections to fill @numberofpartitions partitions on: @numberofworkers, one per
+    partition by default, but at most the connections of @openpool beyond the @reserved ones of the call, as
+    _concurrently holds all of them at once.
+    """
+    return max(1, min(numberofworkers or numberofpartitions, numberofpartitions, openpool.get_max_size() - reserved))
+
+
+async def _fillstagingtables(openpool, tablenames, statements):
+    """
+    Function to fill the committed staging tables of @tablenames by running @statements with _concurrently,
+    dropping the staging tables when it fails. The statement filling a staging table also runs the
+    _finishstagingsql of the table in its transaction.
+    """
+    try:
+        await _concurrently(openpool, statements)
+    except BaseException:
+        async with openpool.acquire() as con:
+            await con.execute('; '.join(f"DROP TABLE IF EXISTS {tablename}{Interface._STAGING_SUFFIX}"
+                                        for tablename in tablenames))
+        raise
+
+
+def _finishstagingsql(tablename):
+    """
+    SQL to make the filled staging table of @tablename LOGGED and analyze it, like Interface._fillstagingtables.
+    """
+    return f"ALTER TABLE {tablename}{Interface._STAGING_SUFFIX} SET LOGGED; ANALYZE {tablename}{Interface._STAGING_SUFFIX}"
+
+
+async def _concurrently(openpool, statements):
+    """
+    Function to run every statement, SQL or a coroutine function of the connection, on its own connection
+    of @openpool at the same time, so there must not be more statements than connections in the pool. The transactions are committed together once all succeeded; when one
+    fails the others are cancelled and all of them are rolled back.
+    """
+    async def run(con, statement):
+        if isinstance(statement, str):
+            await con.execute(statement)
+        else:
+            await statement(con)
+
+    connections = [await openpool.acquire() for _ in statements]
+    try:
+        transactions = [con.transaction() for con in connections]
+        for transaction in transactions:
+            await transaction.start()
+        tasks = [asyncio.ensure_future(run(con, statement)) for con, statement in zip(connections, statements)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for con, transaction in zip(connections, transactions):
+                try:
+                    await transaction.rollback()
+                except Exception:
+                    # A connection interrupted in the middle of a COPY cannot be reused
+                    con.terminate()
+            raise
+        for transaction in transactions:
+            await transaction.commit()
+    finally:
+        for con in connections:
+            await openpool.release(con)
+
+
+async def roundrobininsert(ratingstablename, userid, itemid, rating, openpool):
+    """
+    Function to insert a new row into the main table and specific partition based on round robin
+    approach, taking the next turn of the round robin state and updating the statistics of the partitions in
+    the same statement, see Interface._roundrobininsertsql. Sharded partitions are left to
+    Interface.roundrobininsert.
+    """
+    for attempt in range(2):
+        catalog = await _partitioncatalog('roundrobin', openpool)
+        if catalog['shards']:
+            raise Exception("The round robin partitions are sharded, insert with Interface.roundrobininsert")
+        # asyncpg prepares the statement once per connection
+        try:
+            async with openpool.acquire() as con:
+                index = await con.fetchval(
+                    Interface._roundrobininsertsql(ratingstablename, catalog['numberofpartitions'], catalog['statistics']),
+                    userid, itemid, float(rating))
+        except asyncpg.UndefinedTableError:
+            # A partition of the cached rotation was dropped by a repartition the insert waited for
+            if attempt:
+                raise
+            index = None
+        if index is not None:
+            return
+        # The rotation has another number of partitions than the cached catalog entry
+        _invalidatecatalog(openpool, 'roundrobin')
+    raise Exception("No round robin partitions found, run roundrobinpartition first")
+
+
+async def rangeinsert(ratingstablename, userid, itemid, rating, openpool):
+    """
+    Function to insert a new row into the main table and specific partition based on range rating,
+    with the partitions taken from the cached catalog. Sharded partitions are left to Interface.rangeinsert.
+    The statistics of the partitions are updated by the same statement.
+    """
+    async def insert(catalog):
+        if catalog['shards']:
+            raise Exception("The range partitions are sharded, insert with Interface.rangeinsert")
+        index = Interface._rangeindex(rating, catalog['boundaries'])
+        if index is None:
+            raise ValueError("Rating {} is outside of all {} range partitions".format(rating, catalog['numberofpartitions']))
+
+        # All inserts in one statement, which is atomic on its own and takes a single round trip
+        async with openpool.acquire() as con:
+            await con.execute(
+                Interface._singleinsertsql(ratingstablename, catalog['tablenames'][index],
+                                           'range' if catalog['statistics'] else None, index),
+                userid, itemid, float(rating))
+
+    await _retryoncatalogchange('range', openpool, insert)
+
+
+async def _retryoncatalogchange(scheme, openpool, insert):
+    """
+    Function to await insert(catalog) with the cached catalog entry of @scheme, and once more with a freshly read
+    entry when the partition it wrote to was dropped or now holds other ratings, like
+    Interface._retryoncatalogchange.
+    """
+    try:
+        return await insert(await _partitioncatalog(scheme, openpool))
+    except (asyncpg.CheckViolationError, asyncpg.UndefinedTableError):
+        _invalidatecatalog(openpool, scheme)
+        return await insert(await _partitioncatalog(scheme, openpool))
+
+
+async def _dropstats(con, scheme):
+    """
+    Function to drop the statistics of @scheme, which the partitionings of this module do not maintain, within the
+    transaction of the build like Interface._refreshstats.
+    """
+    if await con.fetchval("SELECT to_regclass($1)", Interface.PARTITION_STATS_TABLE) is not None:
+        for table in (Interface.PARTITION_STATS_TABLE, Interface.MOVIE_STATS_TABLE, Interface.USER_STATS_TABLE):
+            await con.execute(f"DELETE FROM {table} WHERE scheme = $1", scheme)
+
+
+async def _registerpartitions(con, scheme, ratingstablename, boundaries, tablenames):
+    """
+    Function to record a partitioning in the partition catalog, like Interface._registerpartitions.
+    """
+    await con.execute(Interface._PARTITION_CATALOG_SQL)
+    version = await con.fetchval(Interface._registerpartitionssql([f'${i}' for i in range(1, 9)]),
+                                 scheme, ratingstablename, len(tablenames), boundaries, tablenames, None, None, False)
+    await con.execute("SELECT pg_notify($1, $2)", PARTITION_CATALOG_TABLE, f"{scheme} {version}")
+
+
+async def _partitioncatalog(scheme, openpool):
+    """
+    Function to get the catalog entry of @scheme, cached per pool and dropped when a listener connection of the
+    pool hears of a newer version. Pools not opened by getopenpool read the catalog every time.
+    """
+    state = _pools.get(openpool)
+    if state is None:
+        return await _readcatalog(scheme, openpool)
+
+    if scheme not in state['catalog']:
+        # One task fills the cache while the concurrent ones wait for it
+        async with state['lock']:
+            if state['listener'] is None:
+                # Listen before reading so that no newer version can slip in between
+                state['listener'] = await asyncpg.connect(**state['params'])
+                await state['listener'].add_listener(PARTITION_CATALOG_TABLE, functools.partial(_oncatalognotify, state))
+            if scheme not in state['catalog']:
+                state['catalog'][scheme] = await _readcatalog(scheme, openpool)
+    return state['catalog'][scheme]
+
+
+async def _readcatalog(scheme, openpool):
+    async with openpool.acquire() as con:
+        row = None
+        if await con.fetchval("SELECT to_regclass($1)", PARTITION_CATALOG_TABLE) is not None:
+            row = await con.fetchrow(f"""
+                SELECT ratingstablename, numberofpartitions, boundaries, tablenames, partitionkey, shards, statistics,
+                       version
+                FROM {PARTITION_CATALOG_TABLE}
+                WHERE scheme = $1
+            """, scheme)
+    if row is None:
+        raise Exception("No {0} partitions found, run {0}partition first".format(scheme))
+
+    return dict(row, scheme=scheme, statistics=bool(row['statistics']))
+
+
+def _oncatalognotify(state, connection, pid, channel, payload):
+    scheme, version = payload.split()
+    catalog = state['catalog'].get(scheme)
+    if catalog is not None and catalog['version'] != int(version):
+        del state['catalog'][scheme]
+
+
+def _invalidatecatalog(openpool, scheme):
+    state = _pools.get(openpool)
+    if state is not None:
+        state['catalog'].pop(scheme, None)
@@ -0,0 +1,676 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the Interface functions
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import psycopg2
+
+import Instrumentation
+import Interface
+
+# Constants
+DATABASE_NAME = 'dds_benchmark'
+RATINGS_TABLE = 'ratings'
+CONCURRENCY_LEVELS = (1, 10, 100, 1000)
+PARTITION_COUNTS = (5, 16)
+WORKER_COUNTS = (1, 2, 4, 8)
+
+# Shape of MovieLens 10M: share of every half star rating, users and movies per 10M ratings, rating time span
+RATING_VALUES = ('0.5', '1', '1.5', '2', '2.5', '3', '3.5', '4', '4.5', '5')
+RATING_SHARES = (0.0094, 0.0383, 0.0118, 0.0790, 0.0370, 0.2357, 0.0879, 0.2876, 0.0584, 0.1545)
+USERS_PER_10M = 69878
+MOVIES_PER_10M = 10677
+TIMESTAMP_RANGE = (789652009, 1231131736)
+GENERATOR_CHUNK_ROWS = 1000000
+
+
+def print_progress(message, indent=0):
+    """Print progress message with timestamp and indentation"""
+    print(f"[{time.strftime('%H:%M:%S')}] {'  ' * indent}{message}")
+
+
+def open_database(args):
+    """Create the benchmark database if needed and connect to it"""
+    conn = Interface.getopenconnection(args.user, args.password, 'postgres', args.host, args.port)
+    Interface.create_db(args.dbname, conn)
+    conn.close()
+    return Interface.getopenconnection(args.user, args.password, args.dbname, args.host, args.port)
+
+
+@contextlib.contextmanager
+def throwaway_cluster(args, port=None):
+    """Run a new PostgreSQL cluster in a temporary directory, listening on a unix socket only, and delete it on exit.
+    The benchmark cluster listens on --port, and also on TCP on localhost for the benchmarks that set tcp, a shard
+    cluster on @port; yields the socket directory"""
+    pgbin = args.pgbin or os.path.dirname(shutil.which('initdb') or '')
+    datadir = tempfile.mkdtemp(prefix='dds_benchmark_')
+    listen = 'localhost' if port is None and getattr(args, 'tcp', False) else ''
+    try:
+        subprocess.run([os.path.join(pgbin, 'initdb'), '-D', datadir, '-U', args.user, '--auth=trust', '-E', 'UTF8'],
+                       check=True, stdout=subprocess.DEVNULL)
+        subprocess.run([os.path.join(pgbin, 'pg_ctl'), '-D', datadir, '-l', os.path.join(datadir, 'server.log'), '-w',
+                        '-o', f"-c listen_addresses='{listen}' -k {datadir} -p {port or args.port}", 'start'],
+                       check=True, stdout=subprocess.DEVNULL)
+        try:
+            if port is None:
+                args.host, args.password = datadir, ''
+            yield datadir
+        finally:
+            subprocess.run([os.path.join(pgbin, 'pg_ctl'), '-D', datadir, '-m', 'fast', '-w', 'stop'],
+                           stdout=subprocess.DEVNULL)
+    finally:
+        shutil.rmtree(datadir, ignore_errors=True)
+
+
+def generate_ratings(path, rows, seed=0):
+    """
+    Write @rows userid::movieid::rating::timestamp lines shaped like MovieLens 10M to @path, the same for every @seed.
+    Ratings follow the MovieLens share of every half star, a few users and movies have most of the ratings.
+    """
+    users = max(1, round(rows * USERS_PER_10M / 10000000))
+    movies = max(1, round(MOVIES_PER_10M * (rows / 10000000) ** 0.5))
+    shares = np.array(RATING_SHARES) / sum(RATING_SHARES)
+    with open(path, 'w') as f:
+        for chunk, start in enumerate(range(0, rows, GENERATOR_CHUNK_ROWS)):
+            size = min(GENERATOR_CHUNK_ROWS, rows - start)
+            rng = np.random.default_rng([seed, chunk])
+            userid = (users * rng.random(size) ** 2).astype(np.int64) + 1
+            movieid = (movies * rng.random(size) ** 3).astype(np.int64) + 1
+            rating = rng.choice(len(RATING_VALUES), size, p=shares)
+            timestamp = rng.integers(*TIMESTAMP_RANGE, size)
+            f.write(''.join(map('{}::{}::{}::{}\n'.format, userid.tolist(), movieid.tolist(),
+                                [RATING_VALUES[i] for i in rating.tolist()], timestamp.tolist())))
+
+
+def generate(args):
+    """Write a deterministic synthetic ratings file"""
+    started = time.perf_counter()
+    generate_ratings(args.path, args.rows, args.seed)
+    print_progress(f"{args.rows} rows written to {args.path} in {time.perf_counter() - started:.3f}s", indent=1)
+    return [dict(path=args.path, rows=args.rows, seed=args.seed)]
+
+
+def prepare_partitions(args):
+    """Create empty range and round robin partitions of the ratings table for the inserts to land in"""
+    conn = open_database(args)
+    cur = conn.cursor()
+    cur.execute(f"DROP TABLE IF EXISTS {RATINGS_TABLE}")
+    cur.execute(f"CREATE TABLE {RATINGS_TABLE} (userid INT, movieid INT, rating FLOAT)")
+    conn.commit()
+    Interface.rangepartition(RATINGS_TABLE, args.partitions, conn)
+    Interface.roundrobinpartition(RATINGS_TABLE, args.partitions, conn)
+    conn.close()
+
+
+def summarize(mode, clients, latencies, seconds):
+    latencies = sorted(latencies)
+    return dict(mode=mode, clients=clients, inserts=len(latencies), seconds=seconds,
+                insertspersec=len(latencies) / seconds,
+                p50=statistics.median(latencies),
+                p99=latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))])
+
+
+def run_sync(args, clients):
+    """Every client is a thread inserting through a shared Interface.ConnectionPool"""
+    pool = Interface.ConnectionPool(minconn=args.maxconn, maxconn=args.maxconn, timeout=600.0, user=args.user,
+                                    password=args.password, dbname=args.dbname, host=args.host, port=args.port)
+    latencies = []
+    lock = threading.Lock()
+
+    def client(number):
+        own = []
+        for i in range(args.inserts):
+            insert = Interface.rangeinsert if i % 2 else Interface.roundrobininsert
+            started = time.perf_counter()
+            insert(RATINGS_TABLE, number, i, (number + i) % 11 / 2, pool)
+            own.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+    pool.closeall()
+    return summarize('sync', clients, latencies, seconds)
+
+
+async def run_async(args, clients):
+    """Every client is a task inserting through a shared AsyncInterface pool, all on one event loop.
+    AsyncInterface is imported here so only this benchmark needs asyncpg"""
+    import AsyncInterface
+
+    pool = await AsyncInterface.getopenpool(args.user, args.password, args.dbname, args.host, args.port,
+                                            minconn=args.maxconn, maxconn=args.maxconn)
+    latencies = []
+
+    async def client(number):
+        for i in range(args.inserts):
+            insert = AsyncInterface.rangeinsert if i % 2 else AsyncInterface.roundrobininsert
+            started = time.perf_counter()
+            await insert(RATINGS_TABLE, number, i, (number + i) % 11 / 2, pool)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client(number) for number in range(clients)])
+    seconds = time.perf_counter() - started
+    await AsyncInterface.closepool(pool)
+    return summarize('async', clients, latencies, seconds)
+
+
+def concurrency(args):
+    """Compare inserts per second and latency of Interface and AsyncInterface at every concurrency level"""
+    results = []
+    for clients in args.clients:
+        prepare_partitions(args)
+        results.append(run_sync(args, clients))
+        prepare_partitions(args)
+        results.append(asyncio.run(run_async(args, clients)))
+        for result in results[-2:]:
+            print_progress("{mode:>5} {clients:>5} clients: {insertspersec:10.1f} inserts/s, p50 {p50:.4f}s, "
+                           "p99 {p99:.4f}s".format(**result), indent=1)
+    return results
+
+
+def partition(args):
+    """Compare the wall-clock time of range and round robin partition builds with every number of workers"""
+    conn = open_database(args)
+    Interface.loadratings(RATINGS_TABLE, args.ratingsfile, conn)
+
+    results = []
+    for numberofpartitions in args.partitions:
+        for numberofworkers in args.workers:
+            for mode, build in (('range', Interface.rangepartition), ('roundrobin', Interface.roundrobinpartition)):
+                started = time.perf_counter()
+                build(RATINGS_TABLE, numberofpartitions, conn, numberofworkers=numberofworkers)
+                results.append(dict(mode=mode, partitions=numberofpartitions, workers=numberofworkers,
+                                    seconds=time.perf_counter() - started))
+                print_progress("{mode:>10} {partitions:>3} partitions, {workers:>2} workers: {seconds:.3f}s".format(
+                    **results[-1]), indent=1)
+    conn.close()
+    return results
+
+
+def lookup(args):
+    """Compare the latency of looking up all ratings of one user in round robin and hash partitions"""
+    conn = open_database(args)
+    conn.autocommit = True
+    Interface.loadratings(RATINGS_TABLE, args.ratingsfile, conn)
+    cur = conn.cursor()
+    cur.execute(f"SELECT DISTINCT userid FROM {RATINGS_TABLE}")
+    users = random.Random(args.seed).choices([userid for (userid,) in cur.fetchall()], k=args.lookups)
+
+    def roundrobinquery(userid):
+        # Any partition can hold ratings of the user
+        return ' UNION ALL '.join(f"SELECT userid, movieid, rating FROM {Interface.RROBIN_TABLE_PREFIX}{i} "
+                                  "WHERE userid = %(userid)s" for i in range(args.partitions))
+
+    def hashquery(userid):
+        return (f"SELECT userid, movieid, rating FROM {Interface.HASH_TABLE_PREFIX}"
+                f"{Interface._hashindex(userid, args.partitions)} WHERE userid = %(userid)s")
+
+    results = []
+    layouts = (('roundrobin', lambda: Interface.roundrobinpartition(RATINGS_TABLE, args.partitions, conn), roundrobinquery),
+               ('hash', lambda: Interface.hashpartition(RATINGS_TABLE, args.partitions, 'userid', conn), hashquery),
+               ('hash+index', lambda: Interface.hashpartition(RATINGS_TABLE, args.partitions, 'userid', conn, index=True), hashquery))
+    for mode, build, query in layouts:
+        build()
+        latencies = []
+        started = time.perf_counter()
+        for userid in users:
+            lookupstarted = time.perf_counter()
+            cur.execute(query(userid), {'userid': userid})
+            cur.fetchall()
+            latencies.append(time.perf_counter() - lookupstarted)
+        seconds = time.perf_counter() - started
+        latencies.sort()
+        results.append(dict(mode=mode, partitions=args.partitions, lookups=len(users), seconds=seconds,
+                            p50=statistics.median(latencies),
+                            p99=latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]))
+        print_progress("{mode:>10} {partitions:>3} partitions: p50 {p50:.5f}s, p99 {p99:.5f}s".format(**results[-1]),
+                       indent=1)
+    conn.close()
+    return results
+
+
+def schema(args):
+    """Compare the table size, COPY time and scan time of the standard ratings layout and of a compact one with a
+    real rating column"""
+    # The compact layout was not adopted on the result of this measurement: a heap tuple is a 24-byte header plus
+    # the row padded to MAXALIGN (8), so (int4, int4, real) and (int4, int4, float8) rows both take 40 bytes and the
+    # tables have the same size and scan time
+    conn = open_database(args)
+    conn.autocommit = True
+    cur = conn.cursor()
+    Interface.loadratings(RATINGS_TABLE, args.ratingsfile, conn, copyformat='binary')
+    results = []
+    for layout, ratingtype in (('standard', 'float'), ('compact', 'real')):
+        tablename = f"{RATINGS_TABLE}_{layout}"
+        # Binary COPY data of the layout, made by the server so that the rating is encoded as the column stores it
+        data = io.BytesIO()
+        cur.copy_expert(f"COPY (SELECT userid, movieid, rating::{ratingtype} FROM {RATINGS_TABLE}) "
+                        "TO STDOUT (FORMAT binary)", data)
+        loads = []
+        for _ in range(args.runs):
+            cur.execute(f"DROP TABLE IF EXISTS {tablename}; "
+                        f"CREATE TABLE {tablename} (userid integer, movieid integer, rating {ratingtype})")
+            data.seek(0)
+            started = time.perf_counter()
+            cur.copy_expert(f"COPY {tablename} FROM STDIN (FORMAT binary)", data)
+            loads.append(time.perf_counter() - started)
+        cur.execute(f"VACUUM ANALYZE {tablename}")
+        cur.execute(f"SELECT pg_relation_size('{tablename}'), pg_total_relation_size('{tablename}'), "
+                    f"COUNT(*) FROM {tablename}")
+        tablebytes, totalbytes, rows = cur.fetchone()
+        scans = []
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            cur.execute(f"SELECT COUNT(*), SUM(rating) FROM {tablename} WHERE rating >= 0.5")
+            cur.fetchall()
+            scans.append(time.perf_counter() - started)
+        cur.execute(f"DROP TABLE {tablename}")
+        results.append(dict(layout=layout, rows=rows, tablebytes=tablebytes, totalbytes=totalbytes,
+                            bytesperrow=tablebytes / rows if rows else 0.0,
+                            copyseconds=min(loads), scanseconds=min(scans)))
+        print_progress("{layout:>8}: {tablebytes} bytes ({bytesperrow:.1f} per row), COPY {copyseconds:.3f}s, "
+                       "scan {scanseconds:.3f}s".format(**results[-1]), indent=1)
+    cur.close()
+    conn.close()
+    return results
+
+
+def shards(args):
+    """Compare the wall-clock time of partition builds and range queries with the partitions on this node and on
+    the shard nodes of --shardports"""
+    with contextlib.ExitStack() as clusters:
+        targets = []
+        for port in args.shardports:
+            host = clusters.enter_context(throwaway_cluster(args, port)) if args.initdb else args.host
+            conn = Interface.getopenconnection(args.user, args.password, 'postgres', host, port)
+            Interface.create_db(args.dbname, conn)
+            conn.close()
+            targets.append(dict(host=host, port=port))
+
+        conn = open_database(args)
+        Interface.loadratings(RATINGS_TABLE, args.ratingsfile, conn)
+        results = []
+        for layout, shardtargets in (('local', None), ('sharded', targets)):
+            for mode, build in (('range', Interface.rangepartition), ('roundrobin', Interface.roundrobinpartition)):
+                started = time.perf_counter()
+                build(RATINGS_TABLE, args.partitions, conn, shards=shardtargets)
+                buildseconds = time.perf_counter() - started
+                started = time.perf_counter()
+                rows = sum(len(userid) for _, userid, _, _ in Interface.rangequery(2, 3, conn, schemes=(mode,), arrays=True))
+                results.append(dict(layout=layout, mode=mode, partitions=args.partitions, nodes=len(shardtargets or [1]),
+                                    buildseconds=buildseconds, queryrows=rows,
+                                    queryseconds=time.perf_counter() - started))
+                print_progress("{layout:>8} {mode:>10} {partitions:>3} partitions on {nodes} nodes: build {buildseconds:.3f}s, "
+                               "range query {queryseconds:.3f}s".format(**results[-1]), indent=1)
+        conn.close()
+    return results
+
+
+def aggregation(args):
+    """Compare the wall-clock time of aggregations in one query over the ratings table and scatter-gathered over
+    the round robin partitions"""
+    conn = open_database(args)
+    conn.autocommit = True
+    Interface.loadratings(RATINGS_TABLE, args.ratingsfile, conn)
+    cur = conn.cursor()
+    results = []
+    for numberofpartitions in args.partitions:
+        Interface.roundrobinpartition(RATINGS_TABLE, numberofpartitions, conn)
+        for groupby in (None, 'movieid', 'userid'):
+            started = time.perf_counter()
+            cur.execute(f"SELECT {groupby or 0}, COUNT(rating), SUM(rating), MIN(rating), MAX(rating) "
+                        f"FROM {RATINGS_TABLE} GROUP BY 1")
+            groups = len(cur.fetchall())
+            tableseconds = time.perf_counter() - started
+            started = time.perf_counter()
+            Interface.aggregate('roundrobin', conn, groupby=groupby)
+            results.append(dict(groupby=groupby or '-', partitions=numberofpartitions, groups=groups,
+                                tableseconds=tableseconds, partitionseconds=time.perf_counter() - started))
+            print_progress("{groupby:>8} {partitions:>3} partitions, {groups} groups: table {tableseconds:.3f}s, "
+                           "partitions {partitionseconds:.3f}s".format(**results[-1]), indent=1)
+    cur.close()
+    conn.close()
+    return results
+
+
+def latency(args):
+    """Compare the latency of single-row inserts into range, round robin and hash partitions over a unix socket and
+    over TCP"""
+    prepare_partitions(args)
+    conn = open_database(args)
+    Interface.hashpartition(RATINGS_TABLE, args.partitions, 'userid', conn)
+    conn.close()
+    rng = random.Random(args.seed)
+    inserts = [(rng.randint(1, 1000), rng.randint(1, 1000), float(rng.choice(RATING_VALUES)))
+               for _ in range(args.warmup + args.inserts)]
+
+    results = []
+    transports = (('socket', args.socketdir or (args.host if os.path.isabs(args.host) else '/var/run/postgresql')),
+                  ('tcp', 'localhost' if os.path.isabs(args.host) else args.host))
+    for transport, host in transports:
+        try:
+            conn = Interface.getopenconnection(args.user, args.password, args.dbname, host, args.port)
+        except psycopg2.OperationalError as e:
+            print_progress(f"{transport:>6}: cannot connect to {host}, skipped ({str(e).strip().splitlines()[0]})", indent=1)
+            continue
+        # Every insert is a transaction of its own without the round trips of BEGIN and COMMIT
+        conn.autocommit = True
+        for mode, insert in (('range', Interface.rangeinsert), ('roundrobin', Interface.roundrobininsert),
+                             ('hash', Interface.hashinsert)):
+            latencies = []
+            started = time.perf_counter()
+            for number, (userid, movieid, rating) in enumerate(inserts):
+                insertstarted = time.perf_counter()
+                insert(RATINGS_TABLE, userid, movieid, rating, conn)
+                # The first inserts also prepare the statements of the partitions
+                if number >= args.warmup:
+                    latencies.append(time.perf_counter() - insertstarted)
+            latencies.sort()
+            results.append(dict(transport=transport, mode=mode, inserts=len(latencies),
+                                seconds=time.perf_counter() - started, p50=statistics.median(latencies),
+                                p99=latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]))
+            print_progress("{transport:>6} {mode:>10}: p50 {p50:.6f}s, p99 {p99:.6f}s".format(**results[-1]), indent=1)
+        conn.close()
+    return results
+
+
+def suite_operations(args, numberofpartitions):
+    """
+    The timed operations of one run with @numberofpartitions partitions, as (operation, rows, function) in the
+    order they run. Every operation leaves the tables as the next one expects them.
+    """
+    rng = random.Random(args.seed)
+    inserts = [(rng.randint(1, 1000), rng.randint(1, 1000), rng.choice(RATING_VALUES)) for _ in range(args.inserts)]
+    rows = args.rows
+    workers = args.workers
+    t = RATINGS_TABLE
+
+    def many(function, numberofrows):
+        return lambda conn: function(t, [(userid, movieid, float(rating)) for userid, movieid, rating in inserts[:numberofrows]], conn)
+
+    def each(function):
+        return lambda conn: [function(t, userid, movieid, float(rating), conn) for userid, movieid, rating in inserts]
+
+    def consume(generator):
+        return lambda conn: sum(1 for _ in generator(conn))
+
+    return [
+        ('loadratings', rows, lambda conn: Interface.loadratings(t, args.ratingsfile, conn)),
+        ('loadratings[binary]', rows, lambda conn: Interface.loadratings(t, args.ratingsfile, conn, copyformat='binary')),
+        (f'loadratings[workers={workers}]', rows,
+         lambda conn: Interface.loadratings(t, args.ratingsfile, conn, numberofworkers=workers)),
+        ('rangepartition', rows, lambda conn: Interface.rangepartition(t, numberofpartitions, conn)),
+        (f'rangepartition[workers={workers}]', rows,
+         lambda conn: Interface.rangepartition(t, numberofpartitions, conn, numberofworkers=workers)),
+        ('roundrobinpartition', rows, lambda conn: Interface.roundrobinpartition(t, numberofpartitions, conn)),
+        (f'roundrobinpartition[workers={workers}]', rows,
+         lambda conn: Interface.roundrobinpartition(t, numberofpartitions, conn, numberofworkers=workers)),
+        ('loadandpartition', rows, lambda conn: Interface.loadandpartition(t, args.ratingsfile, conn, numberofpartitions,
+                                                                           schemes=('range', 'roundrobin'))),
+        ('hashpartition', rows, lambda conn: Interface.hashpartition(t, numberofpartitions, 'userid', conn)),
+        ('rangeinsert', len(inserts), each(Interface.rangeinsert)),
+        ('roundrobininsert', len(inserts), each(Interface.roundrobininsert)),
+        ('hashinsert', len(inserts), each(Interface.hashinsert)),
+        ('rangeinsert_many', len(inserts), many(Interface.rangeinsert_many, len(inserts))),
+        ('roundrobininsert_many', len(inserts), many(Interface.roundrobininsert_many, len(inserts))),
+        ('rangequery', rows, consume(lambda conn: Interface.rangequery(1.5, 3.5, conn))),
+        ('pointquery', rows, consume(lambda conn: Interface.pointquery(4, conn))),
+        ('aggregate[movieid]', rows, lambda conn: Interface.aggregate('roundrobin', conn, groupby='movieid')),
+        ('hashquery', len(inserts), lambda conn: [sum(1 for _ in Interface.hashquery(userid, conn))
+                                                  for userid, _, _ in inserts]),
+        ('rangerepartition', rows, lambda conn: Interface.rangerepartition(t, numberofpartitions + 3, conn)),
+        ('roundrobinrepartition', rows, lambda conn: Interface.roundrobinrepartition(t, numberofpartitions + 3, conn)),
+    ]
+
+
+def suite(args):
+    """Time every Interface operation over several runs and partition counts"""
+    generated = args.ratingsfile is None
+    if generated:
+        args.ratingsfile = os.path.join(tempfile.mkdtemp(prefix='dds_ratings_'), 'ratings.dat')
+        print_progress(f"Generating {args.rows} rows with seed {args.seed}...")
+        generate_ratings(args.ratingsfile, args.rows, args.seed)
+    else:
+        with open(args.ratingsfile, 'rb') as f:
+            args.rows = sum(1 for _ in f)
+
+    conn = open_database(args)
+    conn.autocommit = True
+    timings = {}
+    try:
+        for run in range(args.runs):
+            for numberofpartitions in args.partitions:
+                for operation, rows, function in suite_operations(args, numberofpartitions):
+                    started = time.perf_counter()
+                    function(conn)
+                    seconds = time.perf_counter() - started
+                    timings.setdefault((operation, numberofpartitions, rows), []).append(seconds)
+                    print_progress(f"run {run + 1}/{args.runs}, {numberofpartitions:>3} partitions, "
+                                   f"{operation}: {seconds:.3f}s", indent=1)
+    finally:
+        conn.close()
+        if generated:
+            shutil.rmtree(os.path.dirname(args.ratingsfile), ignore_errors=True)
+
+    return [dict(name=f"{operation}@{numberofpartitions}", operation=operation, partitions=numberofpartitions,
+                 rows=rows, runs=seconds, best=min(seconds), median=statistics.median(seconds),
+                 rowspersec=rows / min(seconds) if min(seconds) else None)
+            for (operation, numberofpartitions, rows), seconds in timings.items()]
+
+
+def compare(args):
+    """Compare the median times of two suite results, failing when an operation slowed down beyond the threshold"""
+    with open(args.baseline) as f:
+        baseline = {result['name']: result for result in json.load(f)['results']}
+    with open(args.candidate) as f:
+        candidate = {result['name']: result for result in json.load(f)['results']}
+
+    results = []
+    for name in sorted(baseline.keys() & candidate.keys()):
+        change = candidate[name]['median'] / baseline[name]['median'] - 1 if baseline[name]['median'] else 0.0
+        results.append(dict(name=name, baseline=baseline[name]['median'], candidate=candidate[name]['median'],
+                            change=change, regression=change > args.threshold))
+        print_progress("{name:<40} {baseline:9.3f}s -> {candidate:9.3f}s {change:+7.1%}{flag}".format(
+            flag=' REGRESSION' if results[-1]['regression'] else '', **results[-1]), indent=1)
+    args.failed = any(result['regression'] for result in results)
+    return results
+
+
+def metadata(args):
+    """Description of the code and environment the results were measured with"""
+    info = dict(benchmark=args.benchmark, time=time.strftime('%Y-%m-%dT%H:%M:%S%z'), python=platform.python_version(),
+                psycopg2=psycopg2.__version__, numpy=np.__version__, platform=platform.platform(),
+                cpus=os.cpu_count(),
+                arguments={key: value for key, value in vars(args).items()
+                           if key not in ('run', 'password') and not callable(value)})
+    try:
+        info['commit'] = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                                        cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['commit'] = None
+    return info
+
+
+def ingest(args):
+    """Compare inserts per second, commits and latency of single-row inserts from many threads, each committed
+    on its own and group committed by an Interface.BufferedWriter at every batch size and delay"""
+    insert = Interface.rangeinsert if args.scheme == 'range' else Interface.roundrobininsert
+    results = []
+    for batchsize, maxdelay in [(None, None)] + [(batchsize, maxdelay) for batchsize in args.batchsizes
+                                                 for maxdelay in args.maxdelays]:
+        prepare_partitions(args)
+        pool = Interface.ConnectionPool(minconn=1, maxconn=args.clients, timeout=600.0, user=args.user,
+                                        password=args.password, dbname=args.dbname, host=args.host, port=args.port)
+        writer = batchsize and Interface.BufferedWriter(RATINGS_TABLE, pool, scheme=args.scheme, batchsize=batchsize,
+                                                        maxdelay=maxdelay)
+        latencies = []
+        lock = threading.Lock()
+
+        def client(number):
+            own = []
+            for i in range(args.inserts):
+                started = time.perf_counter()
+                if writer:
+                    # Time from the call to the commit of the row
+                    writer.insert(number, i, (number + i) % 11 / 2).add_done_callback(
+                        lambda future, started=started: own.append(time.perf_counter() - started))
+                else:
+                    insert(RATINGS_TABLE, number, i, (number + i) % 11 / 2, pool)
+                    own.append(time.perf_counter() - started)
+            if writer:
+                writer.flush()
+            with lock:
+                latencies.extend(own)
+
+        threads = [threading.Thread(target=client, args=(number,)) for number in range(args.clients)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - started
+        if writer:
+            writer.close()
+        pool.closeall()
+        result = summarize('buffered' if writer else 'direct', args.clients, latencies, seconds)
+        result.update(batchsize=batchsize or 1, maxdelay=maxdelay or 0.0,
+                      commits=writer.stats()['batches'] if writer else len(latencies))
+        results.append(result)
+        print_progress("{mode:>8} batch {batchsize:>6} delay {maxdelay:.3f}s: {insertspersec:10.1f} inserts/s, "
+                       "{commits} commits, p50 {p50:.4f}s, p99 {p99:.4f}s".format(**result), indent=1)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='1234')
+    parser.add_argument('--dbname', default=DATABASE_NAME)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--output', help="file to write the results to as JSON")
+    parser.add_argument('--initdb', action='store_true',
+                        help="run against a throwaway PostgreSQL cluster created for the benchmark")
+    parser.add_argument('--pgbin', help="directory of initdb and pg_ctl, found on PATH by default")
+    parser.add_argument('--metrics', help="file to write the instrumentation counters of every Interface operation "
+                                          "to, in the Prometheus text format")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parser_generate = subparsers.add_parser('generate', help=generate.__doc__)
+    parser_generate.add_argument('path', help="ratings file to write")
+    parser_generate.add_argument('--rows', type=int, default=1000000)
+    parser_generate.add_argument('--seed', type=int, default=0)
+    parser_generate.set_defaults(run=generate, database=False)
+
+    parser_suite = subparsers.add_parser('suite', help=suite.__doc__)
+    parser_suite.add_argument('--ratingsfile', help="ratings file to load, generated with --rows and --seed by default")
+    parser_suite.add_argument('--rows', type=int, default=1000000)
+    parser_suite.add_argument('--seed', type=int, default=0)
+    parser_suite.add_argument('--runs', type=int, default=3)
+    parser_suite.add_argument('--partitions', type=int, nargs='+', default=PARTITION_COUNTS)
+    parser_suite.add_argument('--workers', type=int, default=4, help="workers of the parallel loads and builds")
+    parser_suite.add_argument('--inserts', type=int, default=1000, help="rows inserted by every insert operation")
+    parser_suite.set_defaults(run=suite)
+
+    parser_compare = subparsers.add_parser('compare', help=compare.__doc__)
+    parser_compare.add_argument('baseline', help="suite results of the reference commit")
+    parser_compare.add_argument('candidate', help="suite results to check")
+    parser_compare.add_argument('--threshold', type=float, default=0.1, help="largest accepted slowdown, 0.1 is 10%%")
+    parser_compare.set_defaults(run=compare, database=False)
+
+    parser_concurrency = subparsers.add_parser('concurrency', help=concurrency.__doc__)
+    parser_concurrency.add_argument('--clients', type=int, nargs='+', default=CONCURRENCY_LEVELS)
+    parser_concurrency.add_argument('--inserts', type=int, default=20, help="inserts per client")
+    parser_concurrency.add_argument('--partitions', type=int, default=5)
+    parser_concurrency.add_argument('--maxconn', type=int, default=20, help="connections of each pool")
+    parser_concurrency.set_defaults(run=concurrency)
+
+    parser_partition = subparsers.add_parser('partition', help=partition.__doc__)
+    parser_partition.add_argument('ratingsfile', help="ratings file to load and partition")
+    parser_partition.add_argument('--partitions', type=int, nargs='+', default=PARTITION_COUNTS)
+    parser_partition.add_argument('--workers', type=int, nargs='+', default=WORKER_COUNTS)
+    parser_partition.set_defaults(run=partition)
+
+    parser_schema = subparsers.add_parser('schema', help=schema.__doc__)
+    parser_schema.add_argument('ratingsfile', help="ratings file to load")
+    parser_schema.add_argument('--runs', type=int, default=3)
+    parser_schema.set_defaults(run=schema)
+
+    parser_shards = subparsers.add_parser('shards', help=shards.__doc__)
+    parser_shards.add_argument('ratingsfile', help="ratings file to load and partition")
+    parser_shards.add_argument('--partitions', type=int, default=8)
+    parser_shards.add_argument('--shardports', type=int, nargs='+', default=(5433, 5434),
+                               help="ports of the shard nodes on --host, clusters of their own with --initdb")
+    parser_shards.set_defaults(run=shards)
+
+    parser_aggregation = subparsers.add_parser('aggregation', help=aggregation.__doc__)
+    parser_aggregation.add_argument('ratingsfile', help="ratings file to load and partition")
+    parser_aggregation.add_argument('--partitions', type=int, nargs='+', default=PARTITION_COUNTS)
+    parser_aggregation.set_defaults(run=aggregation)
+
+    parser_latency = subparsers.add_parser('latency', help=latency.__doc__)
+    parser_latency.add_argument('--partitions', type=int, default=5)
+    parser_latency.add_argument('--inserts', type=int, default=10000, help="timed inserts of every kind and transport")
+    parser_latency.add_argument('--warmup', type=int, default=100, help="untimed inserts before them")
+    parser_latency.add_argument('--seed', type=int, default=0)
+    parser_latency.add_argument('--socketdir', help="unix socket directory of the server, --host when it is one")
+    parser_latency.set_defaults(run=latency, tcp=True)
+
+    parser_ingest = subparsers.add_parser('ingest', help=ingest.__doc__)
+    parser_ingest.add_argument('--scheme', choices=('range', 'roundrobin'), default='range')
+    parser_ingest.add_argument('--clients', type=int, default=16, help="threads inserting at once")
+    parser_ingest.add_argument('--inserts', type=int, default=500, help="inserts per client")
+    parser_ingest.add_argument('--partitions', type=int, default=5)
+    parser_ingest.add_argument('--batchsizes', type=int, nargs='+', default=(100, 1000))
+    parser_ingest.add_argument('--maxdelays', type=float, nargs='+', default=(0.001, 0.01, 0.05),
+                               help="longest wait of a buffered row in seconds")
+    parser_ingest.set_defaults(run=ingest)
+
+    parser_lookup = subparsers.add_parser('lookup', help=lookup.__doc__)
+    parser_lookup.add_argument('ratingsfile', help="ratings file to load and partition")
+    parser_lookup.add_argument('--partitions', type=int, default=8)
+    parser_lookup.add_argument('--lookups', type=int, default=1000)
+    parser_lookup.add_argument('--seed', type=int, default=0)
+    parser_lookup.set_defaults(run=lookup)
+
+    args = parser.parse_args()
+    print_progress(f"Running the {args.benchmark} benchmark...")
+    metrics = Instrumentation.PrometheusSink()
+    with throwaway_cluster(args) if args.initdb and getattr(args, 'database', True) else contextlib.nullcontext(), \
+            Instrumentation.instrumented(metrics) if args.metrics else contextlib.nullcontext():
+        results = args.run(args)
+        info = metadata(args)
+    if args.metrics:
+        with open(args.metrics, 'w') as f:
+            f.write(metrics.render())
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(metadata=info, results=results), f, indent=2)
+    return 1 if getattr(args, 'failed', False) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
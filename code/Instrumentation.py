@@ -0,0 +1,391 @@
+#
+# Instrumentation of the Interface operations: the phases, rows, bytes and statements of every call, optionally with
+# the EXPLAIN (ANALYZE, BUFFERS) plan of every statement, reported to pluggable sinks
+#
+
+import collections
+import contextvars
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+import psycopg2.extensions
+
+# While disabled, the hooks only check this flag and hand out the shared no-op context
+_enabled = False
+_explain = False
+_sinks = []
+_NOOP = nullcontext()
+
+# Record of the operation in progress, also set in the helper threads of the operation
+_current = contextvars.ContextVar('instrumentationrecord', default=None)
+
+# Statements that EXPLAIN accepts
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def enable(*sinks, explain=False):
+    """
+    Function to start recording every Interface operation and report it to @sinks, objects with an emit(record)
+    method. With @explain the plan of every generated statement is captured with EXPLAIN (ANALYZE, BUFFERS), which
+    runs the statement one more time in a savepoint that is rolled back.
+    """
+    global _enabled, _explain, _sinks
+    _sinks = list(sinks)
+    _explain = explain
+    _enabled = True
+
+
+def disable():
+    global _enabled, _explain, _sinks
+    _enabled = False
+    _explain = False
+    _sinks = []
+
+
+def isenabled():
+    return _enabled
+
+
+@contextmanager
+def instrumented(*sinks, explain=False):
+    """
+    Context manager that enables the instrumentation with @sinks and restores the previous settings on exit.
+    """
+    previous = _enabled, _explain, _sinks
+    enable(*sinks, explain=explain)
+    try:
+        yield
+    finally:
+        _restore(*previous)
+
+
+def _restore(enabled, explain, sinks):
+    global _enabled, _explain, _sinks
+    _enabled, _explain, _sinks = enabled, explain, sinks
+
+
+class OperationRecord:
+    """
+    Timings and counters of one Interface operation, updated by the operation and its helper threads.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.seconds = 0.0
+        self.phases = collections.defaultdict(float)
+        # Statement kind -> [count, seconds]
+        self.statements = collections.defaultdict(lambda: [0, 0.0])
+        self.rows = 0
+        self.bytes = 0
+        self.explains = []
+        self.error = None
+        self._lock = threading.Lock()
+
+    def addphase(self, name, seconds):
+        with self._lock:
+            self.phases[name] += seconds
+
+    def addstatement(self, kind, seconds, rows, nbytes):
+        with self._lock:
+            statement = self.statements[kind]
+            statement[0] += 1
+            statement[1] += seconds
+            self.rows += rows
+            self.bytes += nbytes
+
+    def addexplain(self, query, plan):
+        with self._lock:
+            self.explains.append({'statement': query, 'plan': plan})
+
+    def todict(self):
+        return {
+            'operation': self.name,
+            'started': self.started,
+            'seconds': self.seconds,
+            'phases': dict(self.phases),
+            'statements': {kind: {'count': count, 'seconds': seconds}
+                           for kind, (count, seconds) in self.statements.items()},
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'explains': list(self.explains),
+            'error': self.error,
+        }
+
+    def summary(self):
+        return "{} {:.6f}s rows={} bytes={} statements={} phases={}{}".format(
+            self.name, self.seconds, self.rows, self.bytes,
+            ','.join(f"{kind}:{count}" for kind, (count, _) in sorted(self.statements.items())) or '-',
+            ','.join(f"{name}:{seconds:.6f}s" for name, seconds in self.phases.items()) or '-',
+            f" error={self.error}" if self.error else '')
+
+
+def current():
+    return _current.get() if _enabled else None
+
+
+def operation(name):
+    """
+    Context manager recording the operation @name and reporting it to the sinks at the end. An operation started
+    within another one is recorded as part of the outer one.
+    """
+    if not _enabled or _current.get() is not None:
+        return _NOOP
+    return _operation(name)
+
+
+@contextmanager
+def _operation(name):
+    record = OperationRecord(name)
+    sinks = _sinks
+    token = _current.set(record)
+    started = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record.error = repr(e)
+        raise
+    finally:
+        record.seconds = time.perf_counter() - started
+        _current.reset(token)
+        for sink in sinks:
+            sink.emit(record)
+
+
+def phase(name):
+    """
+    Context manager adding the time spent in it to the phase @name of the current operation.
+    """
+    record = _current.get() if _enabled else None
+    if record is None:
+        return _NOOP
+    return _phase(record, name)
+
+
+@contextmanager
+def _phase(record, name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.addphase(name, time.perf_counter() - started)
+
+
+def attached(record):
+    """
+    Context manager making @record, taken from current() in another thread, the current record of this thread.
+    """
+    if record is None:
+        return _NOOP
+    return _attached(record)
+
+
+@contextmanager
+def _attached(record):
+    token = _current.set(record)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """
+    Cursor that adds its statements to the current operation record, with their plans when explain is on.
+    """
+    def execute(self, query, vars=None):
+        record = current()
+        if record is None:
+            return super().execute(query, vars)
+
+        kind = _statementkind(query)
+        if _explain and kind in _EXPLAINABLE and ';' not in query.strip().rstrip(';'):
+            record.addexplain(query, self._explainplan(query, vars))
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record.addstatement(kind, time.perf_counter() - started, max(self.rowcount, 0), len(self.query or b''))
+
+    def copy_expert(self, sql, file, size=8192):
+        record = current()
+        if record is None:
+            return super().copy_expert(sql, file, size)
+
+        counted = _CountingFile(file)
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, counted, size)
+        finally:
+            record.addstatement('COPY', time.perf_counter() - started, max(self.rowcount, 0), counted.bytes)
+
+    def copy_from(self, file, table, sep='\t', null='\\N', size=8192, columns=None):
+        record = current()
+        if record is None:
+            return super().copy_from(file, table, sep, null, size, columns)
+
+        counted = _CountingFile(file)
+        started = time.perf_counter()
+        try:
+            return super().copy_from(counted, table, sep, null, size, columns)
+        finally:
+            record.addstatement('COPY', time.perf_counter() - started, max(self.rowcount, 0), counted.bytes)
+
+    def _explainplan(self, query, vars):
+        """
+        Function to run @query under EXPLAIN (ANALYZE, BUFFERS) and undo it, returning the plan, None if it failed.
+        """
+        con = self.connection
+        idle = con.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        if not idle:
+            super().execute("SAVEPOINT instrumentation_explain")
+        elif con.autocommit:
+            super().execute("BEGIN")
+        plan = None
+        try:
+            super().execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, vars)
+            plan = self.fetchone()[0]
+        except psycopg2.Error:
+            pass
+        finally:
+            if not idle:
+                super().execute("ROLLBACK TO SAVEPOINT instrumentation_explain; RELEASE SAVEPOINT instrumentation_explain")
+            elif con.autocommit:
+                super().execute("ROLLBACK")
+            else:
+                con.rollback()
+        return plan
+
+
+def _statementkind(query):
+    words = query.split(None, 1) if isinstance(query, str) else None
+    return words[0].rstrip(';').upper() if words else 'OTHER'
+
+
+class _CountingFile:
+    """
+    File-like wrapper counting the bytes COPY reads from or writes to @file.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.bytes += len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.file.readline(size)
+        self.bytes += len(data)
+        return data
+
+    def write(self, data):
+        self.bytes += len(data)
+        return self.file.write(data)
+
+
+class LogSink:
+    """
+    Sink logging one line per operation, and the plans it captured at DEBUG level.
+    """
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('Interface')
+        self.level = level
+
+    def emit(self, record):
+        self.logger.log(self.level, "%s", record.summary())
+        for explain in record.explains:
+            self.logger.debug("%s plan of %s: %s", record.name, explain['statement'].strip(), json.dumps(explain['plan']))
+
+
+class MemorySink:
+    """
+    Sink keeping the last @maxrecords operation records in memory.
+    """
+    def __init__(self, maxrecords=None):
+        self.records = collections.deque(maxlen=maxrecords)
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def clear(self):
+        with self._lock:
+            self.records.clear()
+
+    def totals(self):
+        """
+        Function to sum the calls, seconds, rows, bytes, phases and statements of the kept records by operation.
+        """
+        totals = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            total = totals.setdefault(record.name, {'calls': 0, 'errors': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0,
+                                                    'phases': collections.defaultdict(float),
+                                                    'statements': collections.defaultdict(int)})
+            total['calls'] += 1
+            total['errors'] += record.error is not None
+            total['seconds'] += record.seconds
+            total['rows'] += record.rows
+            total['bytes'] += record.bytes
+            for name, seconds in record.phases.items():
+                total['phases'][name] += seconds
+            for kind, (count, _) in record.statements.items():
+                total['statements'][kind] += count
+        return totals
+
+
+class PrometheusSink:
+    """
+    Sink accumulating counters of the operations, rendered in the Prometheus text exposition format by render().
+    """
+    _HELP = {
+        'operation_calls_total': "Interface operations run",
+        'operation_errors_total': "Interface operations that raised",
+        'operation_seconds_total': "Wall-clock seconds of the Interface operations",
+        'operation_rows_total': "Rows affected or returned by the statements of the Interface operations",
+        'operation_bytes_total': "Bytes of the statements and COPY data of the Interface operations",
+        'phase_seconds_total': "Seconds spent in every phase of the Interface operations",
+        'statements_total': "Statements run by the Interface operations",
+        'statement_seconds_total': "Seconds spent running the statements of the Interface operations",
+    }
+
+    def __init__(self, prefix='dds'):
+        self.prefix = prefix
+        self.counters = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        operation = (('operation', record.name),)
+        with self._lock:
+            self.counters['operation_calls_total', operation] += 1
+            self.counters['operation_errors_total', operation] += record.error is not None
+            self.counters['operation_seconds_total', operation] += record.seconds
+            self.counters['operation_rows_total', operation] += record.rows
+            self.counters['operation_bytes_total', operation] += record.bytes
+            for name, seconds in record.phases.items():
+                self.counters['phase_seconds_total', operation + (('phase', name),)] += seconds
+            for kind, (count, seconds) in record.statements.items():
+                self.counters['statements_total', operation + (('statement', kind),)] += count
+                self.counters['statement_seconds_total', operation + (('statement', kind),)] += seconds
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self.counters.items())
+        lines = []
+        for metric in self._HELP:
+            samples = [(labels, value) for (name, labels), value in counters if name == metric]
+            if not samples:
+                continue
+            lines.append(f"# HELP {self.prefix}_{metric} {self._HELP[metric]}")
+            lines.append(f"# TYPE {self.prefix}_{metric} counter")
+            for labels, value in samples:
+                lines.append("{}_{}{{{}}} {}".format(self.prefix, metric, ','.join(
+                    '{}="{}"'.format(label, str(labelvalue).replace('\\', '\\\\').replace('"', '\\"'))
+                    for label, labelvalue in labels), repr(float(value))))
+        return '\n'.join(lines) + '\n'
@@ -3,200 +3,2822 @@
 # Interface for the assignement
 #
 
+import bisect
+import bz2
+import collections
+import concurrent.futures
+import contextvars
+import functools
+import gzip
+import inspect
+import itertools
+import lzma
+import math
+import mmap
+import multiprocessing
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+import weakref
+from contextlib import ExitStack, closing, contextmanager, nullcontext
+from io import BytesIO, StringIO
+
+import numpy as np
 import psycopg2
-from io import StringIO
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.pool
+
+import Instrumentation
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+RANGE_TABLE_PREFIX = 'range_part'
+RROBIN_TABLE_PREFIX = 'rrobin_part'
+RANGE_PARENT_TABLE = 'range_ratings'
+HASH_TABLE_PREFIX = 'hash_part'
+HASH_PARENT_TABLE = 'hash_ratings'
+ROUNDROBIN_STATE_TABLE = 'roundrobin_state'
+PARTITION_CATALOG_TABLE = 'partition_catalog'
+LOAD_CHECKPOINT_TABLE = 'load_checkpoint'
+PARTITION_STATS_TABLE = 'partition_stats'
+MOVIE_STATS_TABLE = 'movie_stats'
+USER_STATS_TABLE = 'user_stats'
+
+# Suffix of the UNLOGGED tables that parallel loads and builds fill before switching them in place
+_STAGING_SUFFIX = '_staging'
+
+# Connections kept open to every shard node by the process
+SHARD_POOL_SIZE = 8
+
+# Columns of the ratings table and of every partition
+_RATING_COLUMNS = "userid integer, movieid integer, rating float"
+
+# Tables shared with AsyncInterface
+_ROUNDROBIN_STATE_SQL = f"""
+    CREATE TABLE IF NOT EXISTS {ROUNDROBIN_STATE_TABLE} (
+        numberofpartitions integer NOT NULL,
+        nextrow bigint NOT NULL
+    )
+"""
+_PARTITION_CATALOG_SQL = f"""
+    CREATE TABLE IF NOT EXISTS {PARTITION_CATALOG_TABLE} (
+        scheme text PRIMARY KEY,
+        ratingstablename text NOT NULL,
+        numberofpartitions integer NOT NULL,
+        boundaries float8[],
+        tablenames text[] NOT NULL,
+        version bigint NOT NULL,
+        partitionkey text,
+        shards text[],
+        statistics boolean
+    );
+    ALTER TABLE {PARTITION_CATALOG_TABLE} ADD COLUMN IF NOT EXISTS partitionkey text;
+    ALTER TABLE {PARTITION_CATALOG_TABLE} ADD COLUMN IF NOT EXISTS shards text[];
+    ALTER TABLE {PARTITION_CATALOG_TABLE} ADD COLUMN IF NOT EXISTS statistics boolean
+"""
+
+# Statistics of the rows of a partition
+_PARTITION_STATS_SELECT = "SELECT COUNT(*), COALESCE(SUM(rating), 0), MIN(rating), MAX(rating) FROM {}"
+
+# Rows read from a partition by the queries
+_SCAN_SELECT = "SELECT userid, movieid, rating FROM {tablename} WHERE {condition}"
+
+# Partial aggregates of a partition for the scatter-gather aggregations, grouped by {key}, which may be a constant
+_PARTIAL_AGGREGATE_SELECT = """
+    SELECT {key}, COUNT(rating), COALESCE(SUM(rating), 0), MIN(rating), MAX(rating)
+    FROM {tablename}
+    WHERE {condition}
+    GROUP BY 1
+"""
+AGGREGATE_FUNCTIONS = ('count', 'sum', 'avg', 'min', 'max')
+_AGGREGATE_KEYS = {None: '0', 'userid': 'userid', 'movieid': 'movieid', 'rating': 'rating'}
+
+# Summaries of the partitions of a scheme and of the ratings of every movie and user in them, rows counts all
+# rows and ratingsum the ratings that are not NULL
+_STATS_SQL = f"""
+    CREATE TABLE IF NOT EXISTS {PARTITION_STATS_TABLE} (
+        scheme text NOT NULL,
+        partition integer NOT NULL,
+        rows bigint NOT NULL,
+        ratingsum float8 NOT NULL,
+        minrating float8,
+        maxrating float8,
+        PRIMARY KEY (scheme, partition)
+    );
+    CREATE TABLE IF NOT EXISTS {MOVIE_STATS_TABLE} (
+        scheme text NOT NULL,
+        movieid integer NOT NULL,
+        rows bigint NOT NULL,
+        ratingsum float8 NOT NULL,
+        PRIMARY KEY (scheme, movieid)
+    );
+    CREATE TABLE IF NOT EXISTS {USER_STATS_TABLE} (
+        scheme text NOT NULL,
+        userid integer NOT NULL,
+        rows bigint NOT NULL,
+        ratingsum float8 NOT NULL,
+        PRIMARY KEY (scheme, userid)
+    )
+"""
+
+# Committed progress of every slice of the resumable loads, sliceend is NULL for streams of unknown length
+_LOAD_CHECKPOINT_SQL = f"""
+    CREATE TABLE IF NOT EXISTS {LOAD_CHECKPOINT_TABLE} (
+        tablename text NOT NULL,
+        fileid text NOT NULL,
+        loadedtable text NOT NULL,
+        slicestart bigint NOT NULL,
+        sliceend bigint,
+        position bigint NOT NULL,
+        rows bigint NOT NULL,
+        updated timestamptz NOT NULL DEFAULT now(),
+        PRIMARY KEY (tablename, slicestart)
+    )
+"""
+
+# Multiplier of the Knuth multiplicative hash of the hash partitions
+_HASH_MULTIPLIER = 2654435761
+
+# Process-local cache of the partition catalog: the entries by scheme of every connection listening for its versions,
+# which only that connection hears of, dropped together with the connection
+_catalogcache = weakref.WeakKeyDictionary()
+
+# Server-side prepared statements of the single-row inserts by connection, the name of every statement by its SQL
+_preparedstatements = weakref.WeakKeyDictionary()
+_preparedids = itertools.count()
+
+# Parameter types of the prepared single-row inserts, the rating is cast to the rating column type on insert
+_INSERT_PARAMETER_TYPES = ('integer', 'integer', 'float8')
+
+# Pool of the Interface call in progress, where its helper threads take their connections from
+_currentpool = contextvars.ContextVar('currentpool', default=None)
+
+# Process-local pools of the shard nodes by their conninfo in the partition catalog
+_shardpools = {}
+_shardpoolslock = threading.Lock()
+
+# Byte values and tables of the vectorized ratings parser
+_NEWLINE, _COLON, _DOT, _MINUS, _ZERO, _NINE = b'\n'[0], b':'[0], b'.'[0], b'-'[0], b'0'[0], b'9'[0]
+# Digits of a number the vectorized parser sums up exactly, longer numbers are parsed line by line
+_PARSED_DIGITS = 15
+_POW10 = 10.0 ** np.arange(32)
+_BINARY_BLOCK_BYTES = 1 << 22
+
+# Blocks read from streamed inputs and the number of them buffered between the reader thread and COPY
+_STREAM_BLOCK_BYTES = 1 << 22
+_STREAM_QUEUE_BLOCKS = 4
+
+# Binary COPY framing and the tuple layout of a (userid integer, movieid integer, rating float) row
+_PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+_PGCOPY_TRAILER = struct.pack('!h', -1)
+_PGCOPY_RATING = np.dtype([
+    ('fields', '>i2'),
+    ('userid_length', '>i4'), ('userid', '>i4'),
+    ('movieid_length', '>i4'), ('movieid', '>i4'),
+    ('rating_length', '>i4'), ('rating', '>f8'),
+])
+
+
+def getopenconnection(user='postgres', password='1234', dbname='postgres', host='localhost', port=5432):
+    return psycopg2.connect("dbname='" + dbname + "' user='" + user + "' host='" + host + "' port='" + str(port) + "' password='" + password + "'")
+
+
+class ConnectionPool:
+    """
+    Pool of open connections to one database, created with the arguments of getopenconnection.
+    @minconn connections are opened ahead of time and at most @maxconn are open at once; a caller waits up to
+    @timeout seconds for a free one. A connection is checked before it is handed out and replaced when broken,
+    connections idle for more than @healthcheckinterval seconds are also pinged.
+    Every Interface function accepts the pool in place of an open connection. roundrobinpartition reads the main
+    table while it writes the partitions, so it needs @maxconn of at least 2 and raises PoolError otherwise.
+    """
+    def __init__(self, minconn=1, maxconn=10, timeout=30.0, healthcheckinterval=30.0, **params):
+        if not 0 <= minconn <= maxconn or maxconn < 1:
+            raise ValueError("Expected 0 <= minconn <= maxconn and maxconn >= 1")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheckinterval = healthcheckinterval
+        self.params = params
+        self.closed = False
+        self._idle = collections.deque()
+        self._size = 0
+        self._condition = threading.Condition()
+        self._stats = dict(checkouts=0, waits=0, timeouts=0, reconnects=0, waittime=0.0, maxwaittime=0.0)
+        for _ in range(minconn):
+            self._idle.append((getopenconnection(**params), time.monotonic()))
+            self._size += 1
+
+    def getconn(self, timeout=None):
+        """
+        Function to check a connection out of the pool, waiting for one when all @maxconn are in use.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        con = None
+        waited = False
+        with self._condition:
+            while True:
+                if self.closed:
+                    raise psycopg2.pool.PoolError("connection pool is closed")
+                if self._idle:
+                    con, lastused = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    break
+                remaining = started + timeout - time.monotonic()
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    self._stats['timeouts'] += 1
+                    raise psycopg2.pool.PoolError(
+                        "no connection available within {} seconds".format(timeout))
+                waited = True
+            waittime = time.monotonic() - started
+
+        try:
+            if con is None:
+                con = getopenconnection(**self.params)
+            else:
+                con = self._healthcheck(con, lastused)
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+        with self._condition:
+            self._stats['checkouts'] += 1
+            self._stats['waits'] += waited
+            self._stats['waittime'] += waittime
+            self._stats['maxwaittime'] = max(self._stats['maxwaittime'], waittime)
+        return con
+
+    def putconn(self, con, close=False):
+        """
+        Function to return a connection to the pool, rolling back the transaction it left open.
+        """
+        if not con.closed and con.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                con.rollback()
+            except psycopg2.Error:
+                close = True
+        with self._condition:
+            if close or con.closed or self.closed:
+                self._size -= 1
+                con.close()
+            else:
+                self._idle.append((con, time.monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Context manager that checks a connection out of the pool and returns it on exit.
+        """
+        con = self.getconn(timeout)
+        try:
+            yield con
+        finally:
+            self.putconn(con)
+
+    def stats(self):
+        """
+        Function to get the checkout and wait time statistics of the pool.
+        """
+        with self._condition:
+            stats = dict(self._stats, size=self._size, idle=len(self._idle), maxconn=self.maxconn)
+        stats['averagewaittime'] = stats['waittime'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
+
+    def closeall(self):
+        with self._condition:
+            self.closed = True
+            while self._idle:
+                self._idle.pop()[0].close()
+                self._size -= 1
+            self._condition.notify_all()
+
+    def _healthcheck(self, con, lastused):
+        """
+        Function to hand out @con if it still works, a new connection otherwise.
+        """
+        broken = con.closed or con.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+        if not broken and time.monotonic() - lastused > self.healthcheckinterval:
+            try:
+                with con.cursor() as cur:
+                    cur.execute("SELECT 1")
+                if not con.autocommit:
+                    con.rollback()
+            except psycopg2.Error:
+                broken = True
+        if not broken:
+            return con
+
+        con.close()
+        con = getopenconnection(**self.params)
+        with self._condition:
+            self._stats['reconnects'] += 1
+        return con
+
+def _pooled(function):
+    """
+    Decorator letting @function take a ConnectionPool as its openconnection argument: a connection is checked
+    out for the call, and helper connections of the call are taken from the same pool.
+    A generator @function keeps its connection until it is exhausted or closed.
+    The call is also recorded as one Instrumentation operation while the instrumentation is enabled.
+    """
+    position = list(inspect.signature(function).parameters).index('openconnection')
+
+    @contextmanager
+    def pooledcall(args, kwargs):
+        pool = kwargs['openconnection'] if 'openconnection' in kwargs else args[position] if len(args) > position else None
+        if not isinstance(pool, ConnectionPool):
+            yield args, kwargs
+            return
+        with pool.connection() as con:
+            if 'openconnection' in kwargs:
+                kwargs = dict(kwargs, openconnection=con)
+            else:
+                args = args[:position] + (con,) + args[position + 1:]
+            token = _currentpool.set(pool)
+            try:
+                yield args, kwargs
+            finally:
+                _currentpool.reset(token)
+
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            # The pool and operation of the call are set in a context of its own, entered for every step of the
+            # generator only, so that they do not leak into the frame of the consumer while it is suspended
+            context = contextvars.copy_context()
+            call = ExitStack()
+
+            def start():
+                call.enter_context(Instrumentation.operation(function.__name__))
+                pooledargs, pooledkwargs = call.enter_context(pooledcall(args, kwargs))
+                return function(*pooledargs, **pooledkwargs)
+
+            generator = None
+            try:
+                generator = context.run(start)
+                step, value = generator.send, None
+                while True:
+                    try:
+                        item = context.run(step, value)
+                    except StopIteration as stop:
+                        return stop.value
+                    try:
+                        step, value = generator.send, (yield item)
+                    except GeneratorExit:
+                        raise
+                    except BaseException as e:
+                        step, value = generator.throw, e
+            finally:
+                if generator is not None:
+                    context.run(generator.close)
+                context.run(call.__exit__, *sys.exc_info())
+    else:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with Instrumentation.operation(function.__name__), pooledcall(args, kwargs) as (args, kwargs):
+                return function(*args, **kwargs)
+    return wrapper
+
+
+@_pooled
+def loadratings(ratingstablename, ratingsfilepath, openconnection, numberofworkers=1, copyformat='text', resume=False):
+    """
+    Function to load data in @ratingsfilepath file to a table called @ratingstablename.
+    With @numberofworkers > 1 the file is split at line boundaries and every slice is copied by its own
+    process and connection into an UNLOGGED staging table, which replaces @ratingstablename at the end.
+    @copyformat selects the load engine: 'text' parses line by line into a text COPY, 'binary' parses the
+    memory mapped file in vectorized batches and streams binary COPY tuples.
+    @ratingsfilepath can also be a binary or text file object, '-' for stdin, or a .gz, .bz2, .xz or .zst
+    (with the zstandard package) compressed file. These are streamed by a single worker: a reader thread
+    reads and decompresses blocks of lines ahead of the COPY into a bounded queue, so memory use does not
+    depend on the size of the input.
+    With @resume the load can be restarted after a failure, see _resumableload.
+    Returns the load statistics (rows, seconds, rows per second) of every worker.
+    """
+    if copyformat not in _COPYENGINES:
+        raise ValueError("Unknown copy format '{}', expected one of {}".format(copyformat, sorted(_COPYENGINES)))
+    if resume:
+        return _resumableload(ratingstablename, ratingsfilepath, openconnection, numberofworkers, copyformat)
+    streamed = _isstream(ratingsfilepath)
+    if numberofworkers > 1 and not streamed:
+        return _parallelload(ratingstablename, ratingsfilepath, openconnection, numberofworkers, copyformat)
+
+    con = openconnection
+    cur = _cursor(con)
+    
+    # Drop table if exists and create new one
+    with Instrumentation.phase('create'):
+        _clearcheckpoints(cur, ratingstablename)
+        cur.execute(f"DROP TABLE IF EXISTS {ratingstablename}")
+        cur.execute(f"""
+            CREATE TABLE {ratingstablename} (
+                userid integer,
+                movieid integer,
+                rating float
+            )
+        """)
+    cur.close()
+
+    if streamed:
+        return [_copystream(con, ratingstablename, ratingsfilepath, copyformat)]
+    copyslice = _COPYENGINES[copyformat]
+    return [copyslice(con, ratingstablename, ratingsfilepath, 0, os.path.getsize(ratingsfilepath))]
+
+def _parallelload(ratingstablename, ratingsfilepath, openconnection, numberofworkers, copyformat):
+    """
+    Function to load @ratingsfilepath with one worker process and connection per slice of the file.
+    """
+    con = openconnection
+    stagingtablename = ratingstablename + _STAGING_SUFFIX
+    slices = _splitfile(ratingsfilepath, numberofworkers)
+
+    # The staging table must be committed before the workers can see it
+    with Instrumentation.phase('staging'), _transaction(con) as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {stagingtablename}")
+        cur.execute(f"""
+            CREATE UNLOGGED TABLE {stagingtablename} (
+                userid integer,
+                movieid integer,
+                rating float
+            )
+        """)
+
+    try:
+        stats = _loadworkers(con, stagingtablename, ratingsfilepath, slices, copyformat)
+    except Exception:
+        with _transaction(con) as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {stagingtablename}")
+        raise
+
+    # Switch the staging table in place of the real one
+    with Instrumentation.phase('switch'), _transaction(con) as cur:
+        _clearcheckpoints(cur, ratingstablename)
+        cur.execute(f"ALTER TABLE {stagingtablename} SET LOGGED")
+        cur.execute(f"DROP TABLE IF EXISTS {ratingstablename}")
+        cur.execute(f"ALTER TABLE {stagingtablename} RENAME TO {ratingstablename}")
+
+    return stats
+
+def _loadworkers(openconnection, tablename, ratingsfilepath, slices, copyformat, checkpoints=None):
+    """
+    Function to COPY every (start, end) slice of @ratingsfilepath into @tablename with its own worker process and
+    connection, with the checkpoint key of every slice in @checkpoints when the load is resumable.
+    """
+    params = _connectionparams(openconnection)
+    with Instrumentation.phase('workers'), multiprocessing.Pool(len(slices)) as pool:
+        stats = pool.starmap(_loadworker, [
+            (params, tablename, ratingsfilepath, start, end, copyformat, checkpoint)
+            for (start, end), checkpoint in zip(slices, checkpoints or [None] * len(slices))
+        ])
+
+    # The worker processes cannot record their COPYs themselves
+    record = Instrumentation.current()
+    if record is not None:
+        for (start, end), stat in zip(slices, stats):
+            record.addstatement('COPY', stat['seconds'], stat['rows'], end - start)
+    return stats
+
+def _loadworker(params, tablename, ratingsfilepath, start, end, copyformat, checkpoint=None):
+    """
+    Worker process of the parallel load: copies one slice of the file over its own connection.
+    """
+    con = getopenconnection(**params)
+    try:
+        return _COPYENGINES[copyformat](con, tablename, ratingsfilepath, start, end, checkpoint)
+    finally:
+        con.close()
+
+def _resumableload(ratingstablename, ratingsfilepath, openconnection, numberofworkers, copyformat):
+    """
+    Function to load the file @ratingsfilepath so that a failed load can be continued. Every slice of the file
+    has a checkpoint in LOAD_CHECKPOINT_TABLE with the byte offset and number of the rows it committed, updated
+    in the transaction of every chunk of rows. A load of a file with the same path, size and modification time
+    as the unfinished one continues every slice from its checkpoint, with the slices and table of the first
+    attempt, so no row is copied twice or lost. Otherwise the table is recreated and the load starts over.
+    Parallel loads fill a logged staging table, which survives a server crash, and switch it in place at the end.
+    The checkpoints are removed once the load is complete, see loadprogress for the progress in between.
+    """
+    con = openconnection
+    if not isinstance(ratingsfilepath, (str, os.PathLike)) or ratingsfilepath == '-':
+        raise ValueError("Only files can be loaded resumably, streams cannot be read again")
+    fileid = _fileidentity(ratingsfilepath)
+    streamed = _isstream(ratingsfilepath)
+
+    with Instrumentation.phase('checkpoint'), _transaction(con) as cur:
+        cur.execute(_LOAD_CHECKPOINT_SQL)
+        cur.execute(f"""
+            SELECT loadedtable, slicestart, sliceend, position, to_regclass(loadedtable) IS NOT NULL
+            FROM {LOAD_CHECKPOINT_TABLE}
+            WHERE tablename = %s AND fileid = %s
+            ORDER BY slicestart
+            FOR UPDATE
+        """, (ratingstablename, fileid))
+        checkpoints = cur.fetchall()
+
+        if not checkpoints or not checkpoints[0][4]:
+            # Nothing to continue, start over
+            loadedtable = ratingstablename
+            if streamed:
+                slices = [(0, None)]
+            elif numberofworkers > 1:
+                loadedtable = ratingstablename + _STAGING_SUFFIX
+                slices = _splitfile(ratingsfilepath, numberofworkers)
+            else:
+                slices = [(0, os.path.getsize(ratingsfilepath))]
+            _clearcheckpoints(cur, ratingstablename)
+            cur.execute(f"DROP TABLE IF EXISTS {loadedtable}")
+            cur.execute(f"CREATE TABLE {loadedtable} ({_RATING_COLUMNS})")
+            cur.executemany(f"""
+                INSERT INTO {LOAD_CHECKPOINT_TABLE} (tablename, fileid, loadedtable, slicestart, sliceend, position, rows)
+                VALUES (%s, %s, %s, %s, %s, %s, 0)
+            """, [(ratingstablename, fileid, loadedtable, start, end, start) for start, end in slices])
+            checkpoints = [(loadedtable, start, end, start, True) for start, end in slices]
+
+    loadedtable = checkpoints[0][0]
+    # Slices left to copy as (start, end) and their checkpoint keys
+    pending = [((position, end), (ratingstablename, start))
+               for _, start, end, position, _ in checkpoints if end is None or position < end]
+    if streamed:
+        (position, _), checkpoint = pending[0]
+        stats = [_copystream(con, loadedtable, ratingsfilepath, copyformat, position, checkpoint)]
+    elif len(pending) > 1:
+        stats = _loadworkers(con, loadedtable, ratingsfilepath, [slice for slice, _ in pending], copyformat,
+                             [checkpoint for _, checkpoint in pending])
+    else:
+        stats = [_COPYENGINES[copyformat](con, loadedtable, ratingsfilepath, start, end, checkpoint)
+                 for (start, end), checkpoint in pending]
+
+    with Instrumentation.phase('switch'), _transaction(con) as cur:
+        _clearcheckpoints(cur, ratingstablename)
+        if loadedtable != ratingstablename:
+            cur.execute(f"DROP TABLE IF EXISTS {ratingstablename}")
+            cur.execute(f"ALTER TABLE {loadedtable} RENAME TO {ratingstablename}")
+
+    return stats
+
+@_pooled
+def loadprogress(ratingstablename, openconnection):
+    """
+    Function to get the progress of the unfinished resumable load of @ratingstablename from its committed
+    checkpoints, which can be read from other sessions while the load runs: the rows and bytes copied so far,
+    the bytes to copy (None for compressed files) and the fraction done. Returns None when there is no such load.
+    """
+    con = openconnection
+    with _transaction(con) as cur:
+        cur.execute("SELECT to_regclass(%s)", (LOAD_CHECKPOINT_TABLE,))
+        if cur.fetchone()[0] is None:
+            return None
+        cur.execute(f"""
+            SELECT fileid, SUM(rows), SUM(position - slicestart), SUM(sliceend - slicestart), MAX(updated)
+            FROM {LOAD_CHECKPOINT_TABLE}
+            WHERE tablename = %s
+            GROUP BY fileid
+        """, (ratingstablename,))
+        row = cur.fetchone()
+    if row is None:
+        return None
+    fileid, rows, loadedbytes, totalbytes, updated = row
+    return {'file': fileid, 'rows': int(rows), 'bytes': int(loadedbytes),
+            'totalbytes': None if totalbytes is None else int(totalbytes),
+            'fraction': float(loadedbytes / totalbytes) if totalbytes else None, 'updated': updated}
+
+def _fileidentity(ratingsfilepath):
+    """
+    Function to identify the contents of @ratingsfilepath by its path, size and modification time.
+    """
+    stat = os.stat(ratingsfilepath)
+    return f"{os.path.realpath(ratingsfilepath)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def _clearcheckpoints(cur, ratingstablename):
+    """
+    Function to drop the checkpoints of an unfinished resumable load of @ratingstablename, within the transaction
+    that replaces or completes the table, so that no later load continues from them.
+    """
+    cur.execute("SELECT to_regclass(%s)", (LOAD_CHECKPOINT_TABLE,))
+    if cur.fetchone()[0] is not None:
+        cur.execute(f"DELETE FROM {LOAD_CHECKPOINT_TABLE} WHERE tablename = %s", (ratingstablename,))
+
+def _savecheckpoint(cur, checkpoint, position, rows):
+    """
+    Function to record in the transaction of the rows that the slice of the (tablename, slicestart) key @checkpoint
+    is loaded up to byte @position with @rows more rows.
+    """
+    cur.execute(f"""
+        UPDATE {LOAD_CHECKPOINT_TABLE}
+        SET position = %s, rows = rows + %s, updated = now()
+        WHERE tablename = %s AND slicestart = %s
+    """, (position, rows) + tuple(checkpoint))
+
+def _copytextslice(con, tablename, ratingsfilepath, start, end, checkpoint=None):
+    """
+    Function to COPY the lines between byte offsets @start and @end of @ratingsfilepath into @tablename.
+    With a @checkpoint key the progress is saved with every chunk, see _savecheckpoint.
+    Returns the number of rows, the elapsed seconds and the rows per second.
+    """
+    cur = _cursor(con)
+    started = time.perf_counter()
+    rows = 0
+
+    # Read and process file in chunks
+    chunk_size = 100000
+    with open(ratingsfilepath, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = []
+            with Instrumentation.phase('parse'):
+                while remaining > 0 and len(chunk) < chunk_size:
+                    line = f.readline()
+                    if not line:
+                        remaining = 0
+                        break
+                    remaining -= len(line)
+                    parts = line.decode().strip().split('::')  # File format uses :: as delimiter
+                    if len(parts) >= 3:  # userID::movieID::rating::timestamp
+                        userid, movieid, rating = parts[0], parts[1], parts[2]
+                        chunk.append(f"{userid}\t{movieid}\t{rating}\n")  # Use tab delimiter
+
+            if not chunk:
+                continue
+
+            # Create a string buffer for the chunk and use COPY
+            buffer = StringIO(''.join(chunk))
+            with Instrumentation.phase('copy'):
+                cur.copy_from(buffer, tablename, sep='\t', columns=('userid', 'movieid', 'rating'))
+            if checkpoint is not None:
+                _savecheckpoint(cur, checkpoint, end - remaining, len(chunk))
+            with Instrumentation.phase('commit'):
+                con.commit()
+            rows += len(chunk)
+
+    cur.close()
+    return _loadstats(rows, started)
+
+def _copybinaryslice(con, tablename, ratingsfilepath, start, end, checkpoint=None):
+    """
+    Function to COPY the lines between byte offsets @start and @end of @ratingsfilepath into @tablename.
+    The file is memory mapped and parsed in blocks of whole lines, each block is sent as one binary COPY.
+    """
+    cur = _cursor(con)
+    started = time.perf_counter()
+    rows = 0
+
+    if end > start:
+        with open(ratingsfilepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for blockstart, blockend in _lineblocks(mm, start, end):
+                with Instrumentation.phase('parse'):
+                    userid, movieid, rating = _parsemapped(mm, blockstart, blockend)
+                if len(userid):
+                    with Instrumentation.phase('copy'):
+                        _copyrows(cur, tablename, userid, movieid, rating)
+                    if checkpoint is not None:
+                        _savecheckpoint(cur, checkpoint, blockend, len(userid))
+                    with Instrumentation.phase('commit'):
+                        con.commit()
+                    rows += len(userid)
+
+    cur.close()
+    return _loadstats(rows, started)
+
+def _lineblocks(mm, start, end):
+    """
+    Generator of the (blockstart, blockend) offsets that cut @start to @end of the mapped file @mm into
+    blocks of whole lines of about _BINARY_BLOCK_BYTES.
+    """
+    position = start
+    while position < end:
+        # Cut the block after the last complete line that fits into it
+        blockend = min(position + _BINARY_BLOCK_BYTES, end)
+        if blockend < end:
+            newline = mm.rfind(b'\n', position, blockend)
+            if newline < 0:
+                newline = mm.find(b'\n', blockend, end)
+            blockend = newline + 1 if newline >= 0 else end
+        yield position, blockend
+        position = blockend
+
+def _parsemapped(mm, blockstart, blockend):
+    """
+    Function to parse the lines between @blockstart and @blockend of the map @mm with _parseratings.
+    The block is copied out of the map, a numpy view kept alive by the traceback of a parse error would
+    keep the map from closing.
+    """
+    return _parseratings(np.frombuffer(mm[blockstart:blockend], dtype=np.uint8))
+
+def _parseratings(block):
+    """
+    Function to parse the userid::movieid::rating::timestamp lines held in the uint8 array @block into the
+    same rows as the text path.
+    Every line has six ':' and one newline as separators, so the fields are numbered by counting separators
+    and the digits of every field are summed up with their decimal weights in one vectorized pass.
+    Blocks with any other line or number form (whitespace, fewer or more fields, '+', exponents, ...) are
+    parsed line by line with _parseratinglines.
+    Returns the userid, movieid and rating arrays.
+    """
+    if len(block) and block[-1] != _NEWLINE:
+        block = np.append(block, np.uint8(_NEWLINE))
+
+    newline = block == _NEWLINE
+    # Blank lines are skipped like in the text path
+    blank = newline.copy()
+    blank[1:] &= newline[:-1]
+    newline &= ~blank
+    separator = (block == _COLON) | newline
+    isdigit = (block >= _ZERO) & (block <= _NINE)
+    isminus = block == _MINUS
+    isdot = block == _DOT
+    if not (separator | blank | isdigit | isminus | isdot).all():
+        return _parseratinglines(block)
+
+    seppos = np.flatnonzero(separator)
+    lines = int(np.count_nonzero(newline))
+    if len(seppos) != 7 * lines or not newline[seppos[6::7]].all():
+        return _parseratinglines(block)
+    # The ':' must come in '::' pairs, which leaves the fields 1, 3 and 5 of every line empty
+    if not ((seppos[1::7] == seppos[0::7] + 1) & (seppos[3::7] == seppos[2::7] + 1)
+            & (seppos[5::7] == seppos[4::7] + 1)).all():
+        return _parseratinglines(block)
+
+    # Field of every byte = number of separators in front of it, weight = digits left in that field
+    fieldof = np.cumsum(separator, dtype=np.int32)
+    digits = np.flatnonzero(isdigit)
+    field = fieldof[digits]
+    digitcount = np.cumsum(isdigit, dtype=np.int32)
+    fieldend = digitcount[seppos]
+    # The timestamp is not read, the other fields must be numbers with up to _PARSED_DIGITS digits, an optional
+    # leading '-' and a '.' only in the rating
+    fielddigits = np.diff(fieldend, prepend=0).reshape(lines, 7)[:, 0:5:2]
+    if not ((fielddigits > 0) & (fielddigits <= _PARSED_DIGITS)).all():
+        return _parseratinglines(block)
+    minus = np.flatnonzero(isminus)
+    minusfield = fieldof[minus]
+    fieldstart = np.concatenate(([0], seppos[:-1] + 1))
+    signed = minus[minusfield % 7 != 6]
+    signedfield = fieldof[signed]
+    if not (fieldstart[signedfield] == signed).all():
+        return _parseratinglines(block)
+    dots = np.flatnonzero(isdot)
+    dotfield = fieldof[dots]
+    ratingdots = dotfield[dotfield % 7 == 4]
+    if (dotfield % 7 < 4).any() or len(np.unique(ratingdots)) != len(ratingdots):
+        return _parseratinglines(block)
+
+    values = np.bincount(
+        field, weights=(block[digits] - _ZERO) * _POW10[fieldend[field] - digitcount[digits]], minlength=len(seppos)
+    )
+    # Scale down the ratings with a decimal point by the number of digits behind it
+    if len(ratingdots):
+        values[ratingdots] /= _POW10[fieldend[ratingdots] - digitcount[dots[dotfield % 7 == 4]]]
+    values[signedfield] = -values[signedfield]
+
+    values = values.reshape(lines, 7)
+    return _ratingarrays(values[:, 0], values[:, 2], values[:, 4])
+
+def _parseratinglines(block):
+    """
+    Function to parse the lines of the uint8 array @block one at a time exactly like _textrows, lines with
+    fewer than three '::' separated fields are skipped and the numbers are read with int and float.
+    Returns the userid, movieid and rating arrays.
+    """
+    userid, movieid, rating = [], [], []
+    try:
+        for line in block.tobytes().decode().split('\n'):
+            parts = line.strip().split('::')
+            if len(parts) >= 3:
+                userid.append(int(parts[0]))
+                movieid.append(int(parts[1]))
+                rating.append(float(parts[2]))
+        userid, movieid = np.array(userid, dtype=np.float64), np.array(movieid, dtype=np.float64)
+    except (ValueError, OverflowError) as e:
+        raise ValueError("Malformed ratings data, expected userid::movieid::rating::timestamp lines") from e
+    return _ratingarrays(userid, movieid, np.array(rating, dtype=np.float64))
+
+def _ratingarrays(userid, movieid, rating):
+    """
+    Function to turn the parsed @userid and @movieid into integer arrays, which must fit the integer columns.
+    """
+    info = np.iinfo(np.int32)
+    if ((userid < info.min) | (userid > info.max) | (movieid < info.min) | (movieid > info.max)).any():
+        raise ValueError("Malformed ratings data, userid and movieid must be integers")
+    return userid.astype(np.int32), movieid.astype(np.int32), rating
+
+def _copyrows(cur, tablename, userid, movieid, rating):
+    """
+    Function to COPY the rows given as userid, movieid and rating arrays into @tablename in binary format.
+    """
+    cur.copy_expert(
+        f"COPY {tablename} (userid, movieid, rating) FROM STDIN WITH (FORMAT binary)",
+        _pgcopy(userid, movieid, rating)
+    )
+
+def _pgcopy(userid, movieid, rating):
+    """
+    Function to encode the columns as a PostgreSQL binary COPY stream (PGCOPY) for copy_expert.
+    """
+    return BytesIO(b''.join((_PGCOPY_HEADER, _pgcopytuples(userid, movieid, rating), _PGCOPY_TRAILER)))
+
+def _pgcopytuples(userid, movieid, rating):
+    """
+    Function to encode the columns as the tuples of a binary COPY stream, without header and trailer.
+    """
+    tuples = np.empty(len(userid), dtype=_PGCOPY_RATING)
+    tuples['fields'] = 3
+    tuples['userid_length'] = 4
+    tuples['userid'] = userid
+    tuples['movieid_length'] = 4
+    tuples['movieid'] = movieid
+    tuples['rating_length'] = 8
+    tuples['rating'] = rating
+    return tuples.tobytes()
+
+def _loadstats(rows, started):
+    """
+    Function to build the statistics of one load worker.
+    """
+    seconds = time.perf_counter() - started
+    return {'rows': rows, 'seconds': seconds, 'rowspersec': rows / seconds if seconds > 0 else 0.0}
+
+def _splitfile(ratingsfilepath, numberofslices):
+    """
+    Function to split @ratingsfilepath into at most @numberofslices byte ranges that start and end on line boundaries.
+    """
+    size = os.path.getsize(ratingsfilepath)
+    offsets = [0]
+    with open(ratingsfilepath, 'rb') as f:
+        for i in range(1, numberofslices):
+            # Move to the first line that starts at or after the even split point
+            f.seek(max(size * i // numberofslices - 1, offsets[-1]))
+            f.readline()
+            offsets.append(min(f.tell(), size))
+    offsets.append(size)
+    return [(offsets[i], offsets[i + 1]) for i in range(numberofslices) if offsets[i] < offsets[i + 1]]
+
+def _isstream(ratingsfilepath):
+    """
+    Function to tell whether @ratingsfilepath must be streamed, being no path of a plain file that can be split and mapped.
+    """
+    if not isinstance(ratingsfilepath, (str, os.PathLike)):
+        return True
+    return ratingsfilepath == '-' or os.path.splitext(ratingsfilepath)[1] in _DECOMPRESSORS
+
+@contextmanager
+def _openratings(ratingsfilepath):
+    """
+    Context manager giving the file object to read the ratings of @ratingsfilepath from, decompressing it by its suffix.
+    File objects passed in are left open.
+    """
+    if not isinstance(ratingsfilepath, (str, os.PathLike)):
+        yield ratingsfilepath
+    elif ratingsfilepath == '-':
+        yield sys.stdin.buffer
+    else:
+        with _DECOMPRESSORS[os.path.splitext(ratingsfilepath)[1]](ratingsfilepath, 'rb') as f:
+            yield f
+
+def _openzstd(path, mode='rb'):
+    if zstandard is None:
+        raise ImportError("Loading .zst files needs the zstandard package")
+    return zstandard.open(path, mode)
+
+_DECOMPRESSORS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open, '.zst': _openzstd}
+
+def _copystream(con, tablename, ratingsfilepath, copyformat, start=0, checkpoint=None):
+    """
+    Function to COPY the ratings streamed from @ratingsfilepath into @tablename, one block of lines at a time.
+    The blocks are read and decompressed by a _BlockReader thread while the previous ones are parsed and sent,
+    only _STREAM_QUEUE_BLOCKS of them are buffered in between. The first @start bytes of the stream are skipped.
+    """
+    cur = _cursor(con)
+    started = time.perf_counter()
+    rows = 0
+
+    with _openratings(ratingsfilepath) as f:
+        blocks = queue.Queue(maxsize=_STREAM_QUEUE_BLOCKS)
+        reader = _BlockReader(f, blocks, start)
+        try:
+            while True:
+                block = blocks.get()
+                if block is None:
+                    break
+                if isinstance(block, Exception):
+                    raise block
+                position, block = block
+
+                with Instrumentation.phase('parse'):
+                    if copyformat == 'binary':
+                        userid, movieid, rating = _parseratings(np.frombuffer(block, dtype=np.uint8))
+                        count = len(userid)
+                    else:
+                        chunk = _textrows(block)
+                        count = len(chunk)
+                if not count:
+                    continue
+                with Instrumentation.phase('copy'):
+                    if copyformat == 'binary':
+                        _copyrows(cur, tablename, userid, movieid, rating)
+                    else:
+                        cur.copy_from(StringIO(''.join(chunk)), tablename, sep='\t', columns=('userid', 'movieid', 'rating'))
+                if checkpoint is not None:
+                    _savecheckpoint(cur, checkpoint, position, count)
+                with Instrumentation.phase('commit'):
+                    con.commit()
+                rows += count
+        finally:
+            reader.stop()
+
+    cur.close()
+    return _loadstats(rows, started)
+
+def _parsedblocks(ratingsfilepath):
+    """
+    Generator of the userid, movieid and rating arrays of @ratingsfilepath, one block of lines at a time.
+    Plain files are memory mapped like in _copybinaryslice, streams are read ahead like in _copystream.
+    """
+    if _isstream(ratingsfilepath):
+        with _openratings(ratingsfilepath) as f:
+            blocks = queue.Queue(maxsize=_STREAM_QUEUE_BLOCKS)
+            reader = _BlockReader(f, blocks)
+            try:
+                for block in iter(blocks.get, None):
+                    if isinstance(block, Exception):
+                        raise block
+                    with Instrumentation.phase('parse'):
+                        parsed = _parseratings(np.frombuffer(block[1], dtype=np.uint8))
+                    if len(parsed[0]):
+                        yield parsed
+            finally:
+                reader.stop()
+        return
+
+    if not os.path.getsize(ratingsfilepath):
+        return
+    with open(ratingsfilepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for blockstart, blockend in _lineblocks(mm, 0, len(mm)):
+            with Instrumentation.phase('parse'):
+                parsed = _parsemapped(mm, blockstart, blockend)
+            if len(parsed[0]):
+                yield parsed
+
+def _textrows(block):
+    """
+    Function to turn the userid::movieid::rating::timestamp lines of the bytes @block into tab separated COPY rows.
+    """
+    chunk = []
+    for line in block.decode().split('\n'):
+        parts = line.strip().split('::')
+        if len(parts) >= 3:
+            chunk.append(f"{parts[0]}\t{parts[1]}\t{parts[2]}\n")
+    return chunk
+
+class _BlockReader(threading.Thread):
+    """
+    Thread that reads a file object from byte @start on in blocks of whole lines and puts them on a bounded queue
+    as (end offset, bytes), then None, or the error that stopped it.
+    """
+    def __init__(self, source, blocks, start=0):
+        super().__init__(daemon=True)
+        self.record = Instrumentation.current()
+        self.source = source
+        self.blocks = blocks
+        self.position = start
+        self.stopped = threading.Event()
+        self.start()
+
+    def run(self):
+        try:
+            with Instrumentation.attached(self.record):
+                # Skip what an earlier load already copied
+                skip = self.position
+                while skip > 0:
+                    with Instrumentation.phase('read'):
+                        data = self.source.read(min(skip, _STREAM_BLOCK_BYTES))
+                    if not data:
+                        break
+                    skip -= len(data.encode() if isinstance(data, str) else data)
+
+                rest = b''
+                while True:
+                    with Instrumentation.phase('read'):
+                        data = self.source.read(_STREAM_BLOCK_BYTES)
+                    if isinstance(data, str):
+                        data = data.encode()
+                    if not data:
+                        break
+                    # Keep the partial last line for the next block
+                    data = rest + data
+                    cut = data.rfind(b'\n') + 1
+                    rest = data[cut:]
+                    self.position += cut
+                    if cut and not self.put((self.position, data[:cut])):
+                        return
+                if rest and not self.put((self.position + len(rest), rest)):
+                    return
+            self.put(None)
+        except Exception as e:
+            self.put(e)
+
+    def put(self, block):
+        """
+        Wait for room on the queue unless stopped, returning whether the block was queued.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(block, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+_COPYENGINES = {'text': _copytextslice, 'binary': _copybinaryslice}
+
+@_pooled
+def rangepartition(ratingstablename, numberofpartitions, openconnection, numberofworkers=1, shards=None,
+                   statistics=False):
+    """
+    Function to create partitions of main table based on range of ratings.
+    The partitions belong to a parent table partitioned by range of rating, so one INSERT ... SELECT
+    reads the main table once and PostgreSQL routes every row to its partition.
+    With @numberofworkers > 1 every partition is filled by its own INSERT ... SELECT instead, on up to
+    @numberofworkers connections at the same time.
+    With @shards the partitions are placed on other nodes instead, see _shardedpartition.
+    With @statistics the summaries of the partitions, movies and users are built as well and kept up to date by
+    the inserts, see ratingstats.
+    """
+    if shards:
+        return _shardedpartition('range', ratingstablename, numberofpartitions, openconnection, shards, statistics)
+    if numberofworkers > 1:
+        return _parallelrangepartition(ratingstablename, numberofpartitions, openconnection, numberofworkers,
+                                       statistics)
+
+    con = openconnection
+    bounds = _rangebounds(numberofpartitions)
+
+    with _transaction(con) as cur:
+        with Instrumentation.phase('create'):
+            cur.execute(_rangetablessql(bounds))
+
+        # Insert data into partitions with a single scan of the main table
+        with Instrumentation.phase('fill'):
+            cur.execute("""
+                INSERT INTO {}
+                SELECT userid, movieid, rating
+                FROM {}
+                WHERE rating >= {!r} AND rating <= {!r}
+            """.format(RANGE_PARENT_TABLE, ratingstablename, bounds[0], bounds[-1]))
+
+        tablenames = [f"{RANGE_TABLE_PREFIX}{i}" for i in range(numberofpartitions)]
+        with Instrumentation.phase('statistics'):
+            _refreshstats(cur, 'range', ratingstablename, tablenames, statistics)
+        with Instrumentation.phase('catalog'):
+            _registerpartitions(cur, 'range', ratingstablename, bounds, tablenames, statistics=statistics)
+    _invalidatecatalog(con, 'range')
+
+def _parallelrangepartition(ratingstablename, numberofpartitions, openconnection, numberofworkers, statistics=False):
+    """
+    Function to build the range partitions as UNLOGGED staging tables filled at the same time on their own
+    connections, attached to the parent table only once every one of them is complete.
+    """
+    con = openconnection
+    bounds = _rangebounds(numberofpartitions)
+    tablenames = [f"{RANGE_TABLE_PREFIX}{i}" for i in range(numberofpartitions)]
+
+    with Instrumentation.phase('staging'), _transaction(con) as cur:
+        partitionbounds = _rangepartitionbounds(bounds)
+        cur.execute(_stagingtablessql(tablenames, _rangestagingconstraints(bounds)))
+
+    def fill(writers):
+        for i, (minRange, maxRange) in enumerate(partitionbounds):
+            writers[i % len(writers)].execute(f"""
+                INSERT INTO {tablenames[i]}{_STAGING_SUFFIX}
+                SELECT userid, movieid, rating
+                FROM {ratingstablename}
+                WHERE rating >= {minRange!r} AND rating < {maxRange!r}
+            """)
+    _fillstagingtables(con, tablenames, numberofworkers, fill)
+
+    with Instrumentation.phase('switch'), _transaction(con) as cur:
+        cur.execute(_rangetablessql(bounds, staged=True))
+        _refreshstats(cur, 'range', ratingstablename, tablenames, statistics)
+        _registerpartitions(cur, 'range', ratingstablename, bounds, tablenames, statistics=statistics)
+    _invalidatecatalog(con, 'range')
+
+def _rangestagingconstraints(bounds):
+    """
+    Function to get the CHECK constraints of the staging tables of the range partitions of @bounds. They imply
+    the partition bounds, so attaching the filled tables does not scan them again.
+    """
+    return [f"CONSTRAINT partitionbounds CHECK (rating IS NOT NULL AND rating >= {minRange!r} AND rating < {maxRange!r})"
+            for minRange, maxRange in _rangepartitionbounds(bounds)]
+
+def _rangetablessql(bounds, staged=False):
+    """
+    SQL to replace the range partitions by a parent table and one partition per pair of @bounds.
+    With @staged the partitions are the filled staging tables of a parallel build, attached in place.
+    """
+    numberofpartitions = len(bounds) - 1
+    if staged:
+        partitions = ["ALTER TABLE {0}{1}{2} RENAME TO {0}{1}; "
+                      "ALTER TABLE {3} ATTACH PARTITION {0}{1} FOR VALUES FROM ({4!r}) TO ({5!r}); "
+                      "ALTER TABLE {0}{1} DROP CONSTRAINT partitionbounds".format(
+                          RANGE_TABLE_PREFIX, i, _STAGING_SUFFIX, RANGE_PARENT_TABLE, minRange, maxRange)
+                      for i, (minRange, maxRange) in enumerate(_rangepartitionbounds(bounds))]
+    else:
+        partitions = ["CREATE TABLE {}{} PARTITION OF {} FOR VALUES FROM ({!r}) TO ({!r})".format(
+                          RANGE_TABLE_PREFIX, i, RANGE_PARENT_TABLE, minRange, maxRange)
+                      for i, (minRange, maxRange) in enumerate(_rangepartitionbounds(bounds))]
+    return '; '.join(
+        # Drop the previous partitioning, dropping the parent also drops its partitions
+        [f"DROP TABLE IF EXISTS {RANGE_PARENT_TABLE}"] +
+        [f"DROP TABLE IF EXISTS {RANGE_TABLE_PREFIX}{i}" for i in range(numberofpartitions)] +
+        # Create the parent and all partition tables at once
+        [f"CREATE TABLE {RANGE_PARENT_TABLE} ({_RATING_COLUMNS}) PARTITION BY RANGE (rating)"] +
+        partitions
+    )
+
+def _rangebounds(numberofpartitions):
+    """
+    Function to get the numberofpartitions + 1 boundaries of the range partitions.
+    Partition i holds the ratings in (bounds[i], bounds[i + 1]], the first partition also holds bounds[0].
+    """
+    delta = 5.0 / numberofpartitions
+    return [0.0] + [i * delta + delta for i in range(numberofpartitions)]
+
+def _rangeindex(rating, bounds):
+    """
+    Function to get the index of the range partition of @rating, None if no partition covers it.
+    """
+    if not bounds[0] <= rating <= bounds[-1]:
+        return None
+    return max(bisect.bisect_left(bounds, rating) - 1, 0)
+
+def _rangepartitionbounds(bounds):
+    """
+    Function to get the FROM (inclusive) and TO (exclusive) values of every PostgreSQL range partition.
+    Moving the boundaries to the next float turns the left-open partitions into PostgreSQL's right-open ones.
+    """
+    upper = [math.nextafter(bound, math.inf) for bound in bounds]
+    return [(bounds[0], upper[1])] + [(upper[i], upper[i + 1]) for i in range(1, len(bounds) - 1)]
+
+@_pooled
+def roundrobinpartition(ratingstablename, numberofpartitions, openconnection, numberofworkers=1, shards=None,
+                        statistics=False):
+    """
+    Function to create partitions of main table using round robin approach.
+    The main table is read once with COPY TO and row k is dealt to partition k % numberofpartitions through
+    COPY streams on @numberofworkers writer connections, into UNLOGGED staging tables that replace the
+    previous partitions once all of them are complete. The number of dealt rows is recorded in the round
+    robin state so that inserts continue the rotation.
+    With @shards the partitions are placed on other nodes instead, see _shardedpartition.
+    With @statistics the summaries are built and maintained like with rangepartition.
+    """
+    if shards:
+        return _shardedpartition('roundrobin', ratingstablename, numberofpartitions, openconnection, shards,
+                                 statistics)
+    con = openconnection
+    tablenames = [f"{RROBIN_TABLE_PREFIX}{i}" for i in range(numberofpartitions)]
+    pool = _currentpool.get()
+    if pool is not None and pool.maxconn < 2:
+        # The connection of the call reads the main table while a writer fills the partitions
+        raise psycopg2.pool.PoolError("roundrobinpartition takes two connections of the pool, it has {}".format(
+            pool.maxconn))
+
+    # Create all staging tables at once, the writers only see them once committed
+    with Instrumentation.phase('staging'), _transaction(con) as cur:
+        cur.execute(_stagingtablessql(tablenames))
+
+    def fill(writers):
+        # Number the rows once while they stream out of the main table
+        dealer = _RoundRobinDealer(writers, [tablename + _STAGING_SUFFIX for tablename in tablenames])
+        cur = _cursor(con)
+        try:
+            cur.copy_expert(f"COPY {ratingstablename} (userid, movieid, rating) TO STDOUT", dealer)
+        finally:
+            cur.close()
+        dealer.flush()
+        return dealer.rows
+    rows = _fillstagingtables(con, tablenames, numberofworkers, fill)
+
+    # Switch the partitions in place and record the cursor position for the inserts
+    with Instrumentation.phase('switch'), _transaction(con) as cur:
+        _switchroundrobinpartitions(cur, numberofpartitions, rows)
+        _refreshstats(cur, 'roundrobin', ratingstablename, tablenames, statistics)
+        _registerpartitions(cur, 'roundrobin', ratingstablename, None, tablenames, statistics=statistics)
+    _invalidatecatalog(con, 'roundrobin')
+
+def _switchroundrobinpartitions(cur, numberofpartitions, rows):
+    """
+    Function to put the staging tables of @numberofpartitions round robin partitions in place, also dropping the
+    partitions of a previous build with more partitions, and to record that @rows rows were dealt.
+    """
+    previouspartitions = 0
+    cur.execute("SELECT to_regclass(%s)", (ROUNDROBIN_STATE_TABLE,))
+    if cur.fetchone()[0] is not None:
+        cur.execute(f"SELECT COALESCE(MAX(numberofpartitions), 0) FROM {ROUNDROBIN_STATE_TABLE}")
+        previouspartitions = cur.fetchone()[0]
+    cur.execute(_roundrobintablessql(numberofpartitions, previouspartitions, staged=True))
+
+    cur.execute(_ROUNDROBIN_STATE_SQL)
+    cur.execute(f"DELETE FROM {ROUNDROBIN_STATE_TABLE}")
+    cur.execute(f"INSERT INTO {ROUNDROBIN_STATE_TABLE} VALUES (%s, %s)", (numberofpartitions, rows))
+
+def _roundrobintablessql(numberofpartitions, previouspartitions=0, staged=False):
+    """
+    SQL to replace the round robin partitions, also dropping the partitions of a previous build with more of them.
+    With @staged the partitions are the filled staging tables of roundrobinpartition, renamed in place.
+    """
+    if staged:
+        partitions = [f"ALTER TABLE {RROBIN_TABLE_PREFIX}{i}{_STAGING_SUFFIX} RENAME TO {RROBIN_TABLE_PREFIX}{i}"
+                      for i in range(numberofpartitions)]
+    else:
+        partitions = [f"CREATE TABLE {RROBIN_TABLE_PREFIX}{i} ({_RATING_COLUMNS})"
+                      for i in range(numberofpartitions)]
+    return '; '.join(
+        [f"DROP TABLE IF EXISTS {RROBIN_TABLE_PREFIX}{i}" for i in range(max(numberofpartitions, previouspartitions))] +
+        partitions
+    )
+
+def _stagingtablessql(tablenames, constraints=None):
+    """
+    SQL to create an empty UNLOGGED staging table for each of @tablenames, with the matching one of @constraints.
+    """
+    constraints = constraints or [None] * len(tablenames)
+    return '; '.join(
+        [f"DROP TABLE IF EXISTS {tablename}{_STAGING_SUFFIX}" for tablename in tablenames] +
+        ["CREATE UNLOGGED TABLE {}{} ({}{})".format(
+            tablename, _STAGING_SUFFIX, _RATING_COLUMNS, ', ' + constraint if constraint else '')
+         for tablename, constraint in zip(tablenames, constraints)]
+    )
+
+def _fillstagingtables(openconnection, tablenames, numberofworkers, fill):
+    """
+    Function to fill the committed staging tables of @tablenames on up to @numberofworkers writer connections.
+    fill(writers) queues the rows, the staging table of tablenames[i] being written by writers[i % len(writers)],
+    which then sets it LOGGED and analyzes it in the same transaction. The writers only commit when all of
+    them succeeded, otherwise they roll back and the staging tables are dropped.
+    When the pool of the call has no connection besides the one of the call, the single writer works on that
+    one, so fill must not use it.
+    Returns the result of fill.
+    """
+    con = openconnection
+    numberofworkers = min(numberofworkers, len(tablenames))
+    pool = _currentpool.get()
+    if pool is not None:
+        # Leave the pool connection of the call itself
+        numberofworkers = min(numberofworkers, pool.maxconn - 1)
+
+    writers = []
+    try:
+        if numberofworkers >= 1:
+            writers.extend(_CopyWriter(con) for _ in range(numberofworkers))
+        else:
+            writers.append(_CopyWriter(con, borrowed=True))
+        with Instrumentation.phase('fill'):
+            result = fill(writers)
+        with Instrumentation.phase('finish'):
+            for i, tablename in enumerate(tablenames):
+                writers[i % len(writers)].execute(
+                    f"ALTER TABLE {tablename}{_STAGING_SUFFIX} SET LOGGED; ANALYZE {tablename}{_STAGING_SUFFIX}")
+            for writer in writers:
+                writer.close()
+        with Instrumentation.phase('commit'):
+            for writer in writers:
+                writer.commit()
+    except Exception:
+        for writer in writers:
+            writer.rollback()
+        with _transaction(con) as cur:
+            cur.execute('; '.join(f"DROP TABLE IF EXISTS {tablename}{_STAGING_SUFFIX}" for tablename in tablenames))
+        raise
+    return result
+
+@_pooled
+def loadandpartition(ratingstablename, ratingsfilepath, openconnection, numberofpartitions, schemes=('range',),
+                     numberofworkers=None, statistics=False):
+    """
+    Function to load @ratingsfilepath into @ratingstablename and build its @numberofpartitions partitions of every
+    one of @schemes, 'range' and 'roundrobin', in a single pass over the file.
+    The file is parsed once in vectorized blocks like the binary load, the partition of every row is computed
+    here, and the rows are COPYed into the main table and all partition tables at the same time over
+    @numberofworkers writer connections, one per table by default. The tables are UNLOGGED staging tables until
+    all of them are complete, then they replace the previous ones in one transaction.
+    The result is the same as loadratings followed by rangepartition and roundrobinpartition, round robin
+    partitions being dealt in the order of the file. @ratingsfilepath can be anything loadratings accepts,
+    @statistics is that of the partition functions.
+    Returns the load statistics like loadratings.
+    """
+    unknown = [scheme for scheme in schemes if scheme not in ('range', 'roundrobin')]
+    if unknown or not schemes:
+        raise ValueError("Unknown partitioning scheme '{}', expected range or roundrobin".format(
+            (unknown or [None])[0]))
+
+    con = openconnection
+    bounds = _rangebounds(numberofpartitions)
+    partitiontables = {'range': [f"{RANGE_TABLE_PREFIX}{i}" for i in range(numberofpartitions)],
+                       'roundrobin': [f"{RROBIN_TABLE_PREFIX}{i}" for i in range(numberofpartitions)]}
+    tablenames = [ratingstablename] + [tablename for scheme in schemes for tablename in partitiontables[scheme]]
+    constraints = [None] + [constraint for scheme in schemes for constraint in (
+        _rangestagingconstraints(bounds) if scheme == 'range' else [None] * numberofpartitions)]
+    stagingtables = [tablename + _STAGING_SUFFIX for tablename in tablenames]
+
+    with Instrumentation.phase('staging'), _transaction(con) as cur:
+        cur.execute(_stagingtablessql(tablenames, constraints))
+
+    started = time.perf_counter()
+
+    def fill(writers):
+        # _fillstagingtables finishes tablenames[i] on writers[i % len(writers)], so it must also fill it
+        streams = [writers[i % len(writers)] for i in range(len(tablenames))]
+        rows = 0
+        for userid, movieid, rating in _parsedblocks(ratingsfilepath):
+            with Instrumentation.phase('deal'):
+                _copyrows(streams[0], stagingtables[0], userid, movieid, rating)
+                first = 1
+                for scheme in schemes:
+                    if scheme == 'range':
+                        index = _rangeindexes(rating, bounds)
+                        inside = np.flatnonzero(index >= 0)
+                        index, partitionrows = index[inside], (userid[inside], movieid[inside], rating[inside])
+                    else:
+                        # Row k of the file goes to partition k % numberofpartitions
+                        index = (rows + np.arange(len(userid))) % numberofpartitions
+                        partitionrows = userid, movieid, rating
+                    _copypartitions(streams[first:first + numberofpartitions],
+                                    stagingtables[first:first + numberofpartitions], index, *partitionrows)
+                    first += numberofpartitions
+            rows += len(userid)
+        return rows
+    rows = _fillstagingtables(con, tablenames, numberofworkers or len(tablenames), fill)
+
+    with Instrumentation.phase('switch'), _transaction(con) as cur:
+        _clearcheckpoints(cur, ratingstablename)
+        cur.execute(f"DROP TABLE IF EXISTS {ratingstablename}")
+        cur.execute(f"ALTER TABLE {ratingstablename}{_STAGING_SUFFIX} RENAME TO {ratingstablename}")
+        for scheme in schemes:
+            if scheme == 'range':
+                cur.execute(_rangetablessql(bounds, staged=True))
+            else:
+                _switchroundrobinpartitions(cur, numberofpartitions, rows)
+            _refreshstats(cur, scheme, ratingstablename, partitiontables[scheme], statistics)
+            _registerpartitions(cur, scheme, ratingstablename, bounds if scheme == 'range' else None,
+                                partitiontables[scheme], statistics=statistics)
+    for scheme in schemes:
+        _invalidatecatalog(con, scheme)
+    return [_loadstats(rows, started)]
+
+def _shardedpartition(scheme, ratingstablename, numberofpartitions, openconnection, shards, statistics=False):
+    """
+    Function to build the 'range' or 'roundrobin' partitions on shard nodes: partition i is a table on the node of
+    @shards[i % len(shards)], a connection target with the arguments of getopenconnection, those left out being
+    the ones of @openconnection. The main table is read once with COPY TO and its rows are dealt out to one
+    COPY stream per node, all nodes writing at the same time. Every node recreates its partitions in one
+    transaction, committed once all nodes succeeded, then the shard map is recorded in the partition catalog.
+    The tables of the previous build are dropped on its nodes as well.
+    """
+    con = openconnection
+    prefix = RANGE_TABLE_PREFIX if scheme == 'range' else RROBIN_TABLE_PREFIX
+    tablenames = [f"{prefix}{i}" for i in range(numberofpartitions)]
+    partitionshards = []
+    for i in range(numberofpartitions):
+        target = dict(_connectionparams(con), **shards[i % len(shards)])
+        partitionshards.append(_shardconninfo(target))
+        _shardpool(con, partitionshards[-1], target['password'])
+
+    with Instrumentation.phase('staging'), _transaction(con) as cur:
+        previoustablenames, previousshards = [], []
+        cur.execute("SELECT to_regclass(%s)", (PARTITION_CATALOG_TABLE,))
+        if cur.fetchone()[0] is not None:
+            cur.execute(f"SELECT tablenames, shards FROM {PARTITION_CATALOG_TABLE} WHERE scheme = %s", (scheme,))
+            row = cur.fetchone()
+            if row is not None:
+                previoustablenames, previousshards = row[0], row[1] or []
+
+    writers = {}
+    try:
+        # One writer per node, also for the nodes of the previous build only
+        for shard in dict.fromkeys(partitionshards + previousshards):
+            writers[shard] = _CopyWriter(con, shard)
+            writers[shard].execute('; '.join(
+                [f"DROP TABLE IF EXISTS {tablename}" for tablename in set(tablenames) | set(previoustablenames)] +
+                [f"CREATE TABLE {tablename} ({_RATING_COLUMNS})"
+                 for tablename, partitionshard in zip(tablenames, partitionshards) if partitionshard == shard]
+            ))
+        partitionwriters = [writers[shard] for shard in partitionshards]
+
+        with Instrumentation.phase('fill'):
+            cur = _cursor(con)
+            try:
+                if scheme == 'range':
+                    bounds = _rangebounds(numberofpartitions)
+                    dealer = _RangeDealer(partitionwriters, tablenames)
+                    cur.copy_expert(f"""
+                        COPY (
+                            SELECT {_rangeindexsql(bounds)}, userid, movieid, rating
+                            FROM {ratingstablename}
+                            WHERE rating >= {bounds[0]!r} AND rating <= {bounds[-1]!r}
+                        ) TO STDOUT
+                    """, dealer)
+                else:
+                    bounds = None
+                    dealer = _RoundRobinDealer(partitionwriters, tablenames)
+                    cur.copy_expert(f"COPY {ratingstablename} (userid, movieid, rating) TO STDOUT", dealer)
+            finally:
+                cur.close()
+            dealer.flush()
+        with Instrumentation.phase('finish'):
+            for tablename, writer in zip(tablenames, partitionwriters):
+                writer.execute(f"ANALYZE {tablename}")
+            for writer in writers.values():
+                writer.close()
+        with Instrumentation.phase('commit'):
+            for writer in writers.values():
+                writer.commit()
+    except Exception:
+        for writer in writers.values():
+            writer.rollback()
+        raise
+
+    with Instrumentation.phase('catalog'), _transaction(con) as cur:
+        # The partitions no longer live on this node
+        cur.execute('; '.join(
+            ([f"DROP TABLE IF EXISTS {RANGE_PARENT_TABLE}"] if scheme == 'range' else []) +
+            [f"DROP TABLE IF EXISTS {tablename}" for tablename in set(tablenames) | set(previoustablenames)]
+        ))
+        if scheme == 'roundrobin':
+            cur.execute(_ROUNDROBIN_STATE_SQL)
+            cur.execute(f"DELETE FROM {ROUNDROBIN_STATE_TABLE}")
+            cur.execute(f"INSERT INTO {ROUNDROBIN_STATE_TABLE} VALUES (%s, %s)", (numberofpartitions, dealer.rows))
+        _refreshstats(cur, scheme, ratingstablename, tablenames, statistics, partitionshards)
+        _registerpartitions(cur, scheme, ratingstablename, bounds, tablenames,
+                            shards=partitionshards, statistics=statistics)
+    _invalidatecatalog(con, scheme)
+
+def _rangeindexsql(bounds):
+    """
+    SQL expression of the index of the range partition of a rating between the first and the last of @bounds.
+    """
+    partitionbounds = _rangepartitionbounds(bounds)
+    if len(partitionbounds) == 1:
+        return "0"
+    return "CASE {} ELSE {} END".format(
+        ' '.join(f"WHEN rating < {maxRange!r} THEN {i}" for i, (_, maxRange) in enumerate(partitionbounds[:-1])),
+        len(partitionbounds) - 1)
+
+@_pooled
+def rangerepartition(ratingstablename, numberofpartitions, openconnection):
+    """
+    Function to change the number of range partitions in place, moving only the rows whose partition changes.
+    The partitions are detached, cut down to their new range and attached again, then the rows cut out of them
+    and all rows of the partitions that are no longer needed are routed to their new partitions by the parent
+    table. Inserts into the old partitions wait for the change and retry with the new catalog.
+    Returns the number of moved rows.
+    """
+    con = openconnection
+    bounds = _rangebounds(numberofpartitions)
+    tablenames = [f"{RANGE_TABLE_PREFIX}{i}" for i in range(numberofpartitions)]
+    moved = 0
+
+    with _transaction(con) as cur:
+        with Instrumentation.phase('lock'):
+            previous = _lockcatalog(cur, 'range')
+            previoustablenames = previous['tablenames']
+            if len(previoustablenames) == numberofpartitions:
+                return moved
+            cur.execute(f"LOCK TABLE {RANGE_PARENT_TABLE}, {', '.join(previoustablenames)} IN ACCESS EXCLUSIVE MODE")
+        cur.execute(f"CREATE TEMPORARY TABLE repartition_moved ({_RATING_COLUMNS}) ON COMMIT DROP")
+
+        partitionbounds = _rangepartitionbounds(bounds)
+        with Instrumentation.phase('detach'):
+            for i, tablename in enumerate(previoustablenames):
+                cur.execute(f"ALTER TABLE {RANGE_PARENT_TABLE} DETACH PARTITION {tablename}")
+                condition = "TRUE"
+                if i < numberofpartitions:
+                    condition = "NOT (rating >= {!r} AND rating < {!r})".format(*partitionbounds[i])
+                cur.execute(f"""
+                    WITH moved AS (
+                        DELETE FROM {tablename} WHERE {condition} RETURNING userid, movieid, rating
+                    )
+                    INSERT INTO repartition_moved SELECT * FROM moved
+                """)
+                moved += cur.rowcount
+                if i >= numberofpartitions:
+                    cur.execute(f"DROP TABLE {tablename}")
+
+        with Instrumentation.phase('attach'):
+            for i, (minRange, maxRange) in enumerate(partitionbounds):
+                if i < len(previoustablenames):
+                    cur.execute(f"ALTER TABLE {RANGE_PARENT_TABLE} ATTACH PARTITION {tablenames[i]} "
+                                f"FOR VALUES FROM ({minRange!r}) TO ({maxRange!r})")
+                else:
+                    cur.execute(f"CREATE TABLE {tablenames[i]} PARTITION OF {RANGE_PARENT_TABLE} "
+                                f"FOR VALUES FROM ({minRange!r}) TO ({maxRange!r})")
+            cur.execute(f"INSERT INTO {RANGE_PARENT_TABLE} SELECT * FROM repartition_moved")
+
+        if previous['statistics']:
+            with Instrumentation.phase('statistics'):
+                _refreshpartitionstats(cur, 'range', tablenames)
+        with Instrumentation.phase('catalog'):
+            _registerpartitions(cur, 'range', ratingstablename, bounds, tablenames, statistics=previous['statistics'])
+    _invalidatecatalog(con, 'range')
+    return moved
+
+@_pooled
+def roundrobinrepartition(ratingstablename, numberofpartitions, openconnection):
+    """
+    Function to change the number of round robin partitions in place, moving the fewest rows that leave every
+    partition with the rows a fresh roundrobinpartition would give it. Partitions above their new share hand
+    their surplus to the new and the emptier ones, partitions that are no longer needed hand over all of their
+    rows. Inserts wait on the round robin state and continue the new rotation.
+    Returns the number of moved rows.
+    """
+    con = openconnection
+    tablenames = [f"{RROBIN_TABLE_PREFIX}{i}" for i in range(numberofpartitions)]
+    moved = 0
+
+    with _transaction(con) as cur:
+        with Instrumentation.phase('lock'):
+            previous = _lockcatalog(cur, 'roundrobin')
+            previoustablenames = previous['tablenames']
+            if len(previoustablenames) == numberofpartitions:
+                return moved
+            # An insert locks all partitions of its rotation before it waits on the state row, so the partitions
+            # to drop are locked first, in the same order
+            if previoustablenames[numberofpartitions:]:
+                cur.execute(f"LOCK TABLE {', '.join(previoustablenames[numberofpartitions:])} IN ACCESS EXCLUSIVE MODE")
+            # Inserts queue on the state row until the new rotation is committed
+            cur.execute(f"SELECT nextrow FROM {ROUNDROBIN_STATE_TABLE} FOR UPDATE")
+
+        counts = {}
+        with Instrumentation.phase('count'):
+            for tablename in previoustablenames:
+                cur.execute(f"SELECT COUNT(*) FROM {tablename}")
+                counts[tablename] = cur.fetchone()[0]
+        total = sum(counts.values())
+        for tablename in tablenames[len(previoustablenames):]:
+            cur.execute(f"CREATE TABLE {tablename} ({_RATING_COLUMNS})")
+            counts[tablename] = 0
+
+        # Row k of a fresh build goes to partition k % numberofpartitions
+        shares = {tablename: total // numberofpartitions + (i < total % numberofpartitions)
+                  for i, tablename in enumerate(tablenames)}
+        surplus = [[tablename, count - shares.get(tablename, 0)] for tablename, count in counts.items()
+                   if count > shares.get(tablename, 0)]
+        deficit = [[tablename, shares[tablename] - counts[tablename]] for tablename in tablenames
+                   if counts[tablename] < shares[tablename]]
+        with Instrumentation.phase('move'):
+            while surplus and deficit:
+                rows = min(surplus[-1][1], deficit[-1][1])
+                cur.execute(f"""
+                    WITH moved AS (
+                        DELETE FROM {surplus[-1][0]}
+                        WHERE ctid = ANY(ARRAY(SELECT ctid FROM {surplus[-1][0]} LIMIT %s))
+                        RETURNING userid, movieid, rating
+                    )
+                    INSERT INTO {deficit[-1][0]} SELECT * FROM moved
+                """, (rows,))
+                moved += rows
+                for remaining in (surplus, deficit):
+                    remaining[-1][1] -= rows
+                    if not remaining[-1][1]:
+                        remaining.pop()
+
+        for tablename in previoustablenames[numberofpartitions:]:
+            cur.execute(f"DROP TABLE {tablename}")
+        cur.execute(f"UPDATE {ROUNDROBIN_STATE_TABLE} SET numberofpartitions = %s, nextrow = %s",
+                    (numberofpartitions, total))
+
+        if previous['statistics']:
+            with Instrumentation.phase('statistics'):
+                _refreshpartitionstats(cur, 'roundrobin', tablenames)
+        with Instrumentation.phase('catalog'):
+            _registerpartitions(cur, 'roundrobin', ratingstablename, None, tablenames,
+                                statistics=previous['statistics'])
+    _invalidatecatalog(con, 'roundrobin')
+    return moved
+
+def _lockcatalog(cur, scheme):
+    """
+    Function to read the catalog entry of @scheme for a change of the partitioning, locking it until the end of
+    the transaction so that changes of the same scheme run one after the other.
+    """
+    cur.execute("SELECT to_regclass(%s)", (PARTITION_CATALOG_TABLE,))
+    row = None
+    if cur.fetchone()[0] is not None:
+        cur.execute(f"SELECT numberofpartitions, boundaries, tablenames, shards, statistics "
+                    f"FROM {PARTITION_CATALOG_TABLE} WHERE scheme = %s FOR UPDATE", (scheme,))
+        row = cur.fetchone()
+    if row is None:
+        raise Exception("No {0} partitions found, run {0}partition first".format(scheme))
+    numberofpartitions, boundaries, tablenames, shards, statistics = row
+    if shards:
+        raise Exception("The {0} partitions are sharded, run {0}partition to change them".format(scheme))
+    return {'numberofpartitions': numberofpartitions, 'boundaries': boundaries, 'tablenames': tablenames,
+            'statistics': bool(statistics)}
+
+class _RoundRobinDealer:
+    """
+    File-like target of COPY TO: buffers the text rows and deals every chunk out to the round robin partitions.
+    """
+    def __init__(self, writers, tablenames, chunk_size=100000):
+        self.writers = writers
+        self.tablenames = tablenames
+        self.numberofpartitions = len(tablenames)
+        self.chunk_size = chunk_size
+        self.chunk = []
+        self.rows = 0
+
+    def write(self, row):
+        self.chunk.append(row)
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        # Row self.rows + j goes to partition (self.rows + j) % numberofpartitions
+        for i in range(self.numberofpartitions):
+            rows = self.chunk[(i - self.rows) % self.numberofpartitions::self.numberofpartitions]
+            if rows:
+                self.writers[i % len(self.writers)].put(self.tablenames[i], b''.join(rows))
+        self.rows += len(self.chunk)
+        self.chunk = []
+
+class _RangeDealer:
+    """
+    File-like target of COPY TO: buffers the text rows, which start with the index of their range partition,
+    and sends every chunk to the writers of the partitions without that index.
+    """
+    def __init__(self, writers, tablenames, chunk_size=100000):
+        self.writers = writers
+        self.tablenames = tablenames
+        self.chunk_size = chunk_size
+        self.chunks = [[] for _ in tablenames]
+        self.buffered = 0
+        self.rows = 0
+
+    def write(self, row):
+        tab = row.index(b'\t')
+        self.chunks[int(row[:tab])].append(row[tab + 1:])
+        self.buffered += 1
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        for writer, tablename, rows in zip(self.writers, self.tablenames, self.chunks):
+            if rows:
+                writer.put(tablename, b''.join(rows))
+        self.rows += self.buffered
+        self.buffered = 0
+        self.chunks = [[] for _ in self.tablenames]
+
+class _CopyWriter(threading.Thread):
+    """
+    Thread with its own connection that COPYs the text rows queued for a table and runs the queued statements,
+    leaving the transaction open until commit or rollback is called. The connection goes to the database of
+    @openconnection, or to the node of @shard. A @borrowed writer works on @openconnection itself, which the
+    caller must leave alone until commit or rollback.
+    """
+    def __init__(self, openconnection, shard=None, borrowed=False):
+        super().__init__(daemon=True)
+        self.record = Instrumentation.current()
+        self.borrowed = borrowed
+        if borrowed:
+            self.pool = None
+            self.con = openconnection
+        elif shard is None:
+            self.pool = _currentpool.get()
+            self.con = _workerconnection(openconnection)
+        else:
+            self.pool = _shardpool(openconnection, shard)
+            self.con = self.pool.getconn()
+        self.queue = queue.Queue(maxsize=4)
+        self.error = None
+        self.start()
+
+    def run(self):
+        cur = _cursor(self.con)
+        with Instrumentation.attached(self.record):
+            for statement, data in iter(self.queue.get, None):
+                # After a failure the queue is still drained so that put never blocks
+                if self.error is None:
+                    try:
+                        if data is None:
+                            cur.execute(statement)
+                        else:
+                            cur.copy_expert(statement, BytesIO(data))
+                    except Exception as e:
+                        self.error = e
+        cur.close()
+
+    def put(self, tablename, data):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((f"COPY {tablename} (userid, movieid, rating) FROM STDIN", data))
+
+    def execute(self, statement):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((statement, None))
+
+    def copy_expert(self, statement, file):
+        """
+        Queue the COPY FROM STDIN @statement with the contents of the BytesIO @file, so that the writer can stand in
+        for the cursor of _copyrows.
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((statement, file.getvalue()))
+
+    def close(self):
+        """
+        Wait until everything queued is written, raising the error of a failed COPY.
+        """
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+        if self.error is not None:
+            raise self.error
+
+    def commit(self):
+        con, self.con = self.con, None
+        try:
+            con.commit()
+        finally:
+            if not self.borrowed:
+                _releaseworkerconnection(con, self.pool)
+
+    def rollback(self):
+        """
+        Discard everything written, a writer that already committed or rolled back is left alone.
+        """
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+        if self.con is not None:
+            con, self.con = self.con, None
+            con.rollback()
+            if not self.borrowed:
+                _releaseworkerconnection(con, self.pool)
+
+@_pooled
+def hashpartition(ratingstablename, numberofpartitions, key, openconnection, index=False):
+    """
+    Function to create partitions of main table based on a hash of the @key column, userid or movieid.
+    The partition of a key is _hashindex(key, numberofpartitions), which clients compute as well, so inserting
+    or looking up the ratings of one user or movie touches a single partition. The partitions belong to a parent
+    table partitioned by list of that hash, so one INSERT ... SELECT reads the main table once.
+    With @index every partition gets an index on @key.
+    """
+    if key not in ('userid', 'movieid'):
+        raise ValueError("Unknown hash partitioning key '{}', expected userid or movieid".format(key))
+    con = openconnection
+    tablenames = [f"{HASH_TABLE_PREFIX}{i}" for i in range(numberofpartitions)]
+
+    with _transaction(con) as cur:
+        with Instrumentation.phase('create'):
+            cur.execute('; '.join(
+                # Dropping the parent also drops the partitions of a previous build
+                [f"DROP TABLE IF EXISTS {HASH_PARENT_TABLE}"] +
+                [f"DROP TABLE IF EXISTS {tablename}" for tablename in tablenames] +
+                [f"CREATE TABLE {HASH_PARENT_TABLE} ({_RATING_COLUMNS}) "
+                 f"PARTITION BY LIST ({_hashsql(key, numberofpartitions)})"] +
+                [f"CREATE TABLE {tablename} PARTITION OF {HASH_PARENT_TABLE} FOR VALUES IN ({i})"
+                 for i, tablename in enumerate(tablenames)]
+            ))
+
+        with Instrumentation.phase('fill'):
+            cur.execute(f"""
+                INSERT INTO {HASH_PARENT_TABLE}
+                SELECT userid, movieid, rating
+                FROM {ratingstablename}
+                WHERE {key} IS NOT NULL
+            """)
+
+        if index:
+            with Instrumentation.phase('index'):
+                for tablename in tablenames:
+                    cur.execute(f"CREATE INDEX ON {tablename} ({key})")
+
+        with Instrumentation.phase('catalog'):
+            _registerpartitions(cur, 'hash', ratingstablename, None, tablenames, key)
+    _invalidatecatalog(con, 'hash')
+
+def _hashindex(key, numberofpartitions):
+    """
+    Function to get the hash partition of the integer @key: the upper bits of its Knuth multiplicative hash,
+    scaled to @numberofpartitions.
+    """
+    return (key * _HASH_MULTIPLIER) % 2 ** 32 * numberofpartitions >> 32
+
+def _hashsql(column, numberofpartitions):
+    """
+    SQL expression of _hashindex on @column, which also maps negative keys like Python's modulo does.
+    """
+    return (f"((({column}::bigint * {_HASH_MULTIPLIER}) % 4294967296 + 4294967296) % 4294967296 "
+            f"* {numberofpartitions} / 4294967296)")
+
+@_pooled
+def roundrobininsert(ratingstablename, userid, itemid, rating, openconnection):
+    """
+    Function to insert a new row into the main table and specific partition based on round robin
+    approach. The partition comes from the round robin state, which is advanced in the same transaction
+    as the inserts, so concurrent inserters queue on the state row and take consecutive turns.
+    Local partitions are written by one prepared statement in a single round trip, see _executeprepared.
+    A sharded partition is written in a transaction on its node, committed just before the one of this node,
+    so the two inserts are not atomic.
+    """
+    con = openconnection
+    catalog = _partitioncatalog('roundrobin', con)
+    shards = catalog['shards']
+
+    if not shards:
+        for attempt in range(2):
+            sql = _roundrobininsertsql(ratingstablename, catalog['numberofpartitions'], catalog['statistics'])
+            try:
+                if _executeprepared(con, sql, _INSERT_PARAMETER_TYPES, (userid, itemid, rating)):
+                    return
+            except psycopg2.errors.UndefinedTable:
+                # A partition of the cached rotation was dropped by a repartition the insert waited for
+                if attempt:
+                    raise
+            # The rotation has another number of partitions than the cached catalog entry
+            _invalidatecatalog(con, 'roundrobin')
+            catalog = _partitioncatalog('roundrobin', con)
+        raise Exception("No round robin partitions found, run roundrobinpartition first")
+
+    with _transaction(con) as cur:
+        # Take the next turn of the rotation
+        cur.execute(f"""
+            UPDATE {ROUNDROBIN_STATE_TABLE}
+            SET nextrow = nextrow + 1
+            RETURNING (nextrow - 1) % numberofpartitions
+        """)
+        state = cur.fetchone()
+        if state is None:
+            raise Exception("No round robin partitions found, run roundrobinpartition first")
+        index = state[0]
+
+        # Insert into main table
+        cur.execute("""
+            INSERT INTO {} (userid, movieid, rating)
+            VALUES (%s, %s, %s)
+        """.format(ratingstablename), (userid, itemid, rating))
+        if catalog['statistics']:
+            cur.execute(_statsupdatesql('roundrobin', ['%s'] * 11),
+                        _statsdeltas(index, userid, itemid, rating))
+
+        # Insert into partition
+        with _shardtransaction(con, shards[index]) as partitioncur:
+            partitioncur.execute("""
+                INSERT INTO {}{} (userid, movieid, rating)
+                VALUES (%s, %s, %s)
+            """.format(RROBIN_TABLE_PREFIX, index), (userid, itemid, rating))
+
+@_pooled
+def rangeinsert(ratingstablename, userid, itemid, rating, openconnection):
+    """
+    Function to insert a new row into the main table and specific partition based on range rating.
+    Local partitions are written by one prepared statement per partition in a single round trip, see
+    _executeprepared. A sharded partition is written in a transaction on its node, like in roundrobininsert.
+    """
+    con = openconnection
+
+    def insert(catalog):
+        index = _rangeindex(rating, catalog['boundaries'])
+        if index is None:
+            raise ValueError("Rating {} is outside of all {} range partitions".format(rating, catalog['numberofpartitions']))
+
+        if not catalog['shards']:
+            sql = _singleinsertsql(ratingstablename, catalog['tablenames'][index],
+                                   'range' if catalog['statistics'] else None, index)
+            _executeprepared(con, sql, _INSERT_PARAMETER_TYPES, (userid, itemid, rating))
+            return
+
+        # Statistics updated in the transaction of the insert into the main table
+        statssql, statsparams = '', []
+        if catalog['statistics']:
+            statssql = _statsupdatesql('range', ['%s'] * 11) + ';'
+            statsparams = _statsdeltas(index, userid, itemid, rating)
+        with _transaction(con) as cur, _shardtransaction(con, catalog['shards'][index]) as partitioncur:
+            cur.execute(f"INSERT INTO {ratingstablename} (userid, movieid, rating) VALUES (%s, %s, %s);" + statssql,
+                        [userid, itemid, rating] + statsparams)
+            partitioncur.execute(f"INSERT INTO {catalog['tablenames'][index]} (userid, movieid, rating) "
+                                 "VALUES (%s, %s, %s)", (userid, itemid, rating))
+
+    # Get the partitions from the cached catalog
+    _retryoncatalogchange('range', con, insert)
+
+@_pooled
+def hashinsert(ratingstablename, userid, itemid, rating, openconnection):
+    """
+    Function to insert a new row into the main table and the hash partition of its key, taken from the cached catalog,
+    with one prepared statement per partition in a single round trip like rangeinsert.
+    """
+    con = openconnection
+
+    def insert(catalog):
+        key = userid if catalog['partitionkey'] == 'userid' else itemid
+        tablename = catalog['tablenames'][_hashindex(key, catalog['numberofpartitions'])]
+        _executeprepared(con, _singleinsertsql(ratingstablename, tablename),
+                         _INSERT_PARAMETER_TYPES, (userid, itemid, rating))
 
+    _retryoncatalogchange('hash', con, insert)
 
-def getopenconnection(user='postgres', password='1234', dbname='postgres'):
-    return psycopg2.connect("dbname='" + dbname + "' user='" + user + "' host='localhost' password='" + password + "'")
+def _singleinsertsql(ratingstablename, tablename, scheme=None, index=None):
+    """
+    SQL of one statement inserting the row of the parameters $1, $2 and $3 into @ratingstablename and its partition
+    @tablename, adding it to the statistics of @scheme as a row of partition @index as well when @scheme is given.
+    """
+    statements = [f"main AS (INSERT INTO {ratingstablename} (userid, movieid, rating) VALUES ($1, $2, $3))"]
+    if scheme is not None:
+        statements.append(_statsctessql(scheme, _singlerowstats(index)))
+    return "WITH {} INSERT INTO {} (userid, movieid, rating) VALUES ($1, $2, $3)".format(', '.join(statements), tablename)
+
+def _roundrobininsertsql(ratingstablename, numberofpartitions, statistics=False):
+    """
+    SQL of one statement taking the next turn of the rotation and inserting the row of the parameters $1, $2 and $3
+    into @ratingstablename and the partition of the turn, which it returns. When the rotation does not have
+    @numberofpartitions partitions nothing is inserted and no row is returned.
+    """
+    statements = [f"""turn AS (
+            UPDATE {ROUNDROBIN_STATE_TABLE}
+            SET nextrow = nextrow + 1
+            WHERE numberofpartitions = {numberofpartitions}
+            RETURNING (nextrow - 1) % numberofpartitions AS index
+        )""", f"main AS (INSERT INTO {ratingstablename} (userid, movieid, rating) SELECT $1, $2, $3 FROM turn)"]
+    statements += [f"partition{i} AS (INSERT INTO {RROBIN_TABLE_PREFIX}{i} (userid, movieid, rating) "
+                   f"SELECT $1, $2, $3 FROM turn WHERE index = {i})" for i in range(numberofpartitions)]
+    if statistics:
+        statements.append(_statsctessql('roundrobin', _singlerowstats('index', 'turn')))
+    return "WITH {} SELECT index FROM turn".format(', '.join(statements))
 
+def _singlerowstats(index, source=None):
+    """
+    Function to get the SQL expressions of the eleven arrays of _statsdeltas for the row of the parameters $1, $2
+    and $3 in partition @index, selected from @source when given so that they are NULL when it has no row.
+    """
+    rating = "$3"
+    values = [index, 1, rating, rating, rating, '$2', 1, rating, '$1', 1, rating]
+    if source is None:
+        return [f"ARRAY[{value}]" for value in values]
+    return [f"(SELECT ARRAY[{value}] FROM {source})" for value in values]
 
-def loadratings(ratingstablename, ratingsfilepath, openconnection): 
+def _executeprepared(openconnection, sql, parametertypes, params):
     """
-    Function to load data in @ratingsfilepath file to a table called @ratingstablename.
+    Function to run the single statement @sql with @params in one round trip through a server-side prepared
+    statement of the connection, so that the server parses and plans it only once per connection. The statement
+    is prepared by the round trip of its first execution. It runs in a transaction like the other inserts, see
+    _transaction, except that on an idle connection in autocommit mode the message of PREPARE and EXECUTE is a
+    transaction of its own, without the round trips of BEGIN and COMMIT.
+    Returns the rows of the statement, None when it returns none.
     """
     con = openconnection
-    cur = con.cursor()
-    
-    # Drop table if exists and create new one
-    cur.execute(f"DROP TABLE IF EXISTS {ratingstablename}")
-    cur.execute(f"""
-        CREATE TABLE {ratingstablename} (
-            userid integer,
-            movieid integer,
-            rating float
-        )
-    """)
-    
-    # Read and process file in chunks
-    chunk_size = 100000
-    with open(ratingsfilepath, 'r') as f:
+    statements = _preparedstatements.setdefault(con, {})
+    name = statements.get(sql)
+    prepare = name is None
+    if prepare:
+        name = f"interface_insert{next(_preparedids)}"
+    # The statement is sent with the parameters of EXECUTE, its own % must not be taken for their markers
+    query = (f"PREPARE {name} ({', '.join(parametertypes)}) AS {sql.replace('%', '%%')}; " if prepare else '') + \
+        f"EXECUTE {name} ({', '.join(['%s'] * len(params))})"
+
+    try:
+        if con.autocommit and con.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            with closing(_cursor(con)) as cur:
+                cur.execute(query, params)
+                rows = cur.fetchall() if cur.description else None
+        else:
+            with _transaction(con) as cur:
+                cur.execute(query, params)
+                rows = cur.fetchall() if cur.description else None
+    except psycopg2.errors.InvalidSqlStatementName:
+        if prepare:
+            raise
+        # Deallocated behind our back, prepare it again
+    except psycopg2.Error:
+        if prepare:
+            # A prepared statement outlives the failure of the statements sent with it
+            with closing(_cursor(con)) as cur:
+                cur.execute("SELECT 1 FROM pg_prepared_statements WHERE name = %s", (name,))
+                if cur.fetchone() is not None:
+                    statements[sql] = name
+            if not con.autocommit:
+                con.rollback()
+        raise
+    else:
+        statements[sql] = name
+        return rows
+
+    del statements[sql]
+    return _executeprepared(con, sql, parametertypes, params)
+
+@_pooled
+def roundrobininsert_many(ratingstablename, ratings, openconnection):
+    """
+    Function to insert the (userid, itemid, rating) rows of @ratings into the main table and their round
+    robin partitions. The rows take consecutive turns of the rotation, exactly like repeated calls of
+    roundrobininsert, and are written with one binary COPY per table in a single transaction, one per node
+    when the partitions are sharded.
+    """
+    con = openconnection
+    userid, movieid, rating = _ratingcolumns(ratings)
+    if not len(userid):
+        return
+
+    def insert(catalog):
+        with _transaction(con) as cur, ExitStack() as shardtransactions:
+            if not catalog['shards']:
+                _lockpartitions(cur, catalog['tablenames'])
+            # Take one turn of the rotation for every row
+            cur.execute(f"""
+                UPDATE {ROUNDROBIN_STATE_TABLE}
+                SET nextrow = nextrow + %s
+                RETURNING nextrow - %s, numberofpartitions
+            """, (len(userid), len(userid)))
+            state = cur.fetchone()
+            if state is None:
+                raise Exception("No round robin partitions found, run roundrobinpartition first")
+            firstrow, numberofpartitions = state
+            if numberofpartitions != catalog['numberofpartitions']:
+                raise _StaleCatalog()
+            index = (firstrow + np.arange(len(userid))) % numberofpartitions
+
+            _copyrows(cur, ratingstablename, userid, movieid, rating)
+            if catalog['statistics']:
+                cur.execute(_statsupdatesql('roundrobin', ['%s'] * 11),
+                            _statsdeltas(index, userid, movieid, rating))
+            _copypartitions(_shardcursors(con, catalog['shards'], shardtransactions) or cur, catalog['tablenames'],
+                            index, userid, movieid, rating)
+
+    _retryoncatalogchange('roundrobin', con, insert)
+
+@_pooled
+def rangeinsert_many(ratingstablename, ratings, openconnection):
+    """
+    Function to insert the (userid, itemid, rating) rows of @ratings into the main table and their range
+    partitions with one binary COPY per table in a single transaction, one per node when the partitions are sharded.
+    """
+    con = openconnection
+    userid, movieid, rating = _ratingcolumns(ratings)
+    if not len(userid):
+        return
+
+    def insert(catalog):
+        index = _rangeindexes(rating, catalog['boundaries'])
+        if (index < 0).any():
+            raise ValueError("Rating {} is outside of all {} range partitions".format(
+                rating[index < 0][0], catalog['numberofpartitions']))
+
+        with _transaction(con) as cur, ExitStack() as shardtransactions:
+            if not catalog['shards']:
+                _lockpartitions(cur, catalog['tablenames'])
+            _copyrows(cur, ratingstablename, userid, movieid, rating)
+            if catalog['statistics']:
+                cur.execute(_statsupdatesql('range', ['%s'] * 11), _statsdeltas(index, userid, movieid, rating))
+            _copypartitions(_shardcursors(con, catalog['shards'], shardtransactions) or cur, catalog['tablenames'],
+                            index, userid, movieid, rating)
+
+    _retryoncatalogchange('range', con, insert)
+
+class BufferedWriter:
+    """
+    Write-behind queue of single-row inserts into the main table and the @scheme partitions, 'range' or 'roundrobin',
+    for many threads at once. insert returns at once with a future of the row, rows are buffered in memory and a
+    writer thread inserts them in batches with rangeinsert_many or roundrobininsert_many, one transaction per batch,
+    which groups them by partition. A batch is written once @batchsize rows are buffered or the oldest of them
+    waited @maxdelay seconds, so one commit serves up to @batchsize rows: larger values mean fewer commits and
+    smaller ones a shorter wait for each row. The futures resolve once the transaction of their batch committed,
+    or with the error that rolled it back.
+    At most @maxbuffered rows wait for the writer thread, insert blocks while the buffer is full. Round robin rows
+    take their turns in the order of the insert calls, like calls of roundrobininsert in that order.
+    @openconnection is a ConnectionPool, which lends a connection for every batch, or a connection whose
+    parameters are used to open the own connection of the writer.
+    """
+    def __init__(self, ratingstablename, openconnection, scheme='range', batchsize=1000, maxdelay=0.01,
+                 maxbuffered=100000):
+        if scheme not in ('range', 'roundrobin'):
+            raise ValueError(f"Unknown partitioning scheme '{scheme}', expected range or roundrobin")
+        if not 1 <= batchsize <= maxbuffered:
+            raise ValueError("Expected 1 <= batchsize <= maxbuffered")
+        self.ratingstablename = ratingstablename
+        self.scheme = scheme
+        self.batchsize = batchsize
+        self.maxdelay = maxdelay
+        self.maxbuffered = maxbuffered
+        self.closed = False
+        self._pool = openconnection if isinstance(openconnection, ConnectionPool) else None
+        self._con = None if self._pool is not None else _workerconnection(openconnection)
+        # Buffered rows with their futures and times, and the sequence numbers of the submitted, taken and written rows
+        self._rows = collections.deque()
+        self._submitted = 0
+        self._taken = 0
+        self._written = 0
+        self._flushuntil = 0
+        self._condition = threading.Condition()
+        self._stats = dict(rows=0, batches=0, errors=0, waits=0, batchseconds=0.0)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def insert(self, userid, itemid, rating, timeout=None):
+        """
+        Function to queue the row for the next batch, returning a concurrent.futures.Future of it. Waits up to
+        @timeout seconds, forever by default, for room in a full buffer, then raises queue.Full.
+        A row whose userid or itemid is not an integer is refused at once, so that it cannot fail the whole batch.
+        """
+        _ratingcolumns([(userid, itemid, rating)])
+        future = concurrent.futures.Future()
+        with self._condition:
+            if len(self._rows) >= self.maxbuffered:
+                self._stats['waits'] += 1
+                if not self._condition.wait_for(lambda: self.closed or len(self._rows) < self.maxbuffered, timeout):
+                    raise queue.Full(f"The buffer of {self.maxbuffered} rows stayed full for {timeout} seconds")
+            if self.closed:
+                raise Exception("The writer is closed")
+            self._rows.append(((userid, itemid, rating), future, time.monotonic()))
+            self._submitted += 1
+            if len(self._rows) == 1 or len(self._rows) == self.batchsize:
+                self._condition.notify_all()
+        return future
+
+    def flush(self, timeout=None):
+        """
+        Function to write the rows queued so far without waiting for the thresholds, returning whether they were
+        all written, successfully or not, within @timeout seconds.
+        """
+        with self._condition:
+            target = self._submitted
+            self._flushuntil = max(self._flushuntil, target)
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda: self._written >= target, timeout)
+
+    def close(self):
+        """
+        Function to write the queued rows, stop the writer thread and close its own connection.
+        """
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
+    def stats(self):
+        """
+        Function to get the rows, batches and failed batches written so far, the waits of insert on a full buffer,
+        and the average batch size and transaction time.
+        """
+        with self._condition:
+            stats = dict(self._stats, buffered=len(self._rows))
+        stats['averagebatchsize'] = stats['rows'] / stats['batches'] if stats['batches'] else 0.0
+        stats['averagebatchseconds'] = stats['batchseconds'] / stats['batches'] if stats['batches'] else 0.0
+        return stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
         while True:
-            chunk = []
-            for _ in range(chunk_size):
-                line = f.readline()
-                if not line:
-                    break
-                parts = line.strip().split('::')  # File format uses :: as delimiter
-                if len(parts) >= 3:  # userID::movieID::rating::timestamp
-                    userid, movieid, rating = parts[0], parts[1], parts[2]
-                    chunk.append(f"{userid}\t{movieid}\t{rating}\n")  # Use tab delimiter
-            
-            if not chunk:
-                break
-                
-            # Create a string buffer for the chunk and use COPY
-            buffer = StringIO(''.join(chunk))
-            cur.copy_from(buffer, ratingstablename, sep='\t', columns=('userid', 'movieid', 'rating'))
-            con.commit()
-    
-    cur.close()
+            with self._condition:
+                while not self._due():
+                    if self.closed and not self._rows:
+                        return
+                    self._condition.wait(self._rows[0][2] + self.maxdelay - time.monotonic() if self._rows else None)
+                batch = [self._rows.popleft() for _ in range(min(self.batchsize, len(self._rows)))]
+                self._taken += len(batch)
+                # Room for the inserts waiting on a full buffer
+                self._condition.notify_all()
+
+            started = time.perf_counter()
+            failed = self._write([row for row, _, _ in batch], [future for _, future, _ in batch])
+            with self._condition:
+                self._written += len(batch)
+                self._stats['rows'] += len(batch)
+                self._stats['batches'] += 1
+                self._stats['errors'] += failed
+                self._stats['batchseconds'] += time.perf_counter() - started
+                self._condition.notify_all()
+
+    def _due(self):
+        """
+        Function to tell whether the buffered rows must be written now. Called with the condition held.
+        """
+        return bool(self._rows) and (len(self._rows) >= self.batchsize or self.closed or self._taken < self._flushuntil
+                                     or time.monotonic() - self._rows[0][2] >= self.maxdelay)
+
+    def _write(self, rows, futures):
+        """
+        Function to insert @rows in one transaction and resolve their @futures, returning whether it failed.
+        Range ratings outside of all partitions only fail their own futures.
+        """
+        try:
+            with self._pool.connection() if self._pool is not None else nullcontext(self._con) as con:
+                if self.scheme == 'roundrobin':
+                    roundrobininsert_many(self.ratingstablename, rows, con)
+                else:
+                    userid, movieid, rating = _ratingcolumns(rows)
+                    catalog = _partitioncatalog('range', con)
+                    outside = _rangeindexes(rating, catalog['boundaries']) < 0
+                    for i in np.flatnonzero(outside):
+                        futures[i].set_exception(ValueError("Rating {} is outside of all {} range partitions".format(
+                            rows[i][2], catalog['numberofpartitions'])))
+                    futures = [future for future, skip in zip(futures, outside) if not skip]
+                    rangeinsert_many(self.ratingstablename, np.column_stack((userid, movieid, rating))[~outside], con)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return True
+        for future in futures:
+            future.set_result(None)
+        return False
 
-def rangepartition(ratingstablename, numberofpartitions, openconnection):
+class _StaleCatalog(Exception):
     """
-    Function to create partitions of main table based on range of ratings.
+    Raised by the insert of _retryoncatalogchange when the partitions it locked are not those of the partitioning.
+    """
+
+def _retryoncatalogchange(scheme, openconnection, insert):
+    """
+    Function to call insert(catalog) with the cached catalog entry of @scheme, and once more with a freshly read
+    entry when the partition it wrote to was dropped or now holds other ratings because the partitioning changed
+    since the entry was cached. insert must have rolled its transaction back when it raises.
     """
     con = openconnection
-    cur = con.cursor()
-    delta = 5.0 / numberofpartitions
-    
-    # Create all partition tables at once
-    create_tables_sql = '; '.join([
-        f"CREATE TABLE IF NOT EXISTS range_part{i} (userid integer, movieid integer, rating float)"
-        for i in range(numberofpartitions)
-    ])
-    cur.execute(create_tables_sql)
-    
-    # Clear existing data in partitions
-    cur.execute('; '.join([f"TRUNCATE TABLE range_part{i}" for i in range(numberofpartitions)]))
-    
-    # Insert data into partitions
-    for i in range(numberofpartitions):
-        minRange = i * delta
-        maxRange = minRange + delta
-        if i == 0:
-            cur.execute("""
-                INSERT INTO range_part{}
-                SELECT userid, movieid, rating 
-                FROM {}
-                WHERE rating >= {} AND rating <= {}
-            """.format(i, ratingstablename, minRange, maxRange))
+    try:
+        return insert(_partitioncatalog(scheme, con))
+    except (psycopg2.errors.CheckViolation, psycopg2.errors.UndefinedTable, _StaleCatalog):
+        _invalidatecatalog(con, scheme)
+        return insert(_partitioncatalog(scheme, con))
+
+def _lockpartitions(cur, tablenames):
+    """
+    Function to take the lock of an insert on all partitions @tablenames at the start of a batch insert. The
+    single-row inserts lock all partitions at the start of their statement, before the round robin state and
+    statistics rows, and the repartitions lock the partitions they change before those rows as well, so the batch
+    inserts must not lock a partition after one of these rows.
+    """
+    cur.execute(f"LOCK TABLE {', '.join(tablenames)} IN ROW EXCLUSIVE MODE")
+
+def _ratingcolumns(ratings):
+    """
+    Function to turn an iterable or array of (userid, itemid, rating) rows into userid, movieid and rating arrays.
+    The userid and itemid of every row must be integers that fit the integer columns.
+    """
+    rows = np.asarray(ratings if isinstance(ratings, np.ndarray) else list(ratings), dtype=np.float64).reshape(-1, 3)
+    ids = rows[:, :2]
+    info = np.iinfo(np.int32)
+    valid = (np.isfinite(ids) & (ids == np.floor(ids)) & (ids >= info.min) & (ids <= info.max)).all(axis=1)
+    if not valid.all():
+        raise ValueError("Malformed rating {}, userid and itemid must be integers".format(
+            tuple(rows[np.flatnonzero(~valid)[0]].tolist())))
+    return rows[:, 0].astype(np.int32), rows[:, 1].astype(np.int32), rows[:, 2]
+
+def _rangeindexes(rating, bounds):
+    """
+    Vectorized _rangeindex over the @rating array, -1 marks the ratings outside of all partitions.
+    """
+    index = np.maximum(np.searchsorted(bounds, rating, side='left') - 1, 0)
+    index[~((rating >= bounds[0]) & (rating <= bounds[-1]))] = -1
+    return index
+
+def _copypartitions(cur, tablenames, index, userid, movieid, rating):
+    """
+    Function to COPY every row into the partition @tablenames[index], keeping the order of the rows in each partition.
+    @cur is the cursor of all partitions, or a list with the cursor of every partition.
+    """
+    order = np.argsort(index, kind='stable')
+    partitions, starts = np.unique(index[order], return_index=True)
+    for partition, rows in zip(partitions, np.split(order, starts[1:])):
+        _copyrows(cur[partition] if isinstance(cur, list) else cur, tablenames[partition],
+                  userid[rows], movieid[rows], rating[rows])
+
+def _shardcursors(openconnection, shards, shardtransactions):
+    """
+    Function to open a transaction on every node of the partitions on @shards in the ExitStack @shardtransactions,
+    returning the list of the cursors of the partitions, None when they are not sharded.
+    """
+    if not shards:
+        return None
+    cursors = {}
+    for shard in dict.fromkeys(shards):
+        cursors[shard] = shardtransactions.enter_context(_shardtransaction(openconnection, shard))
+    return [cursors[shard] for shard in shards]
+
+@_pooled
+def rangequery(ratingminvalue, ratingmaxvalue, openconnection, schemes=('range', 'roundrobin'),
+               numberofworkers=None, batchsize=10000, arrays=False):
+    """
+    Generator of the (partitionname, userid, movieid, rating) rows of the partitions of @schemes with a rating
+    between @ratingminvalue and @ratingmaxvalue inclusive.
+    Only the range partitions overlapping the interval are read, one after the other. Round robin partitions
+    cannot be pruned, so all of them are read at the same time on up to @numberofworkers connections, one per
+    partition by default. Rows are fetched @batchsize at a time; with @arrays every batch is yielded as
+    (partitionname, userid, movieid, rating) with arrays for the last three instead.
+    """
+    con = openconnection
+    condition = "rating >= %s AND rating <= %s", (ratingminvalue, ratingmaxvalue)
+
+    for scheme in schemes:
+        catalog = _partitioncatalog(scheme, con)
+        if scheme == 'range':
+            tablenames, shards = _rangepartitionsbetween(catalog, ratingminvalue, ratingmaxvalue)
+            yield from _scanpartitions(con, tablenames, condition, 1, batchsize, arrays, shards)
         else:
-            cur.execute("""
-                INSERT INTO range_part{}
-                SELECT userid, movieid, rating 
-                FROM {}
-                WHERE rating > {} AND rating <= {}
-            """.format(i, ratingstablename, minRange, maxRange))
-    
-    cur.close()
-    con.commit()
+            yield from _scanpartitions(con, catalog['tablenames'], condition, numberofworkers, batchsize, arrays,
+                                       catalog['shards'])
 
-def roundrobinpartition(ratingstablename, numberofpartitions, openconnection):
+def _rangepartitionsbetween(catalog, ratingminvalue, ratingmaxvalue):
     """
-    Function to create partitions of main table using round robin approach.
+    Function to get the tablenames and shards of the range partitions in @catalog that overlap the interval
+    between @ratingminvalue and @ratingmaxvalue inclusive.
+    """
+    bounds = catalog['boundaries']
+    if not (ratingminvalue <= ratingmaxvalue and ratingminvalue <= bounds[-1] and ratingmaxvalue >= bounds[0]):
+        return [], None
+    first = _rangeindex(max(ratingminvalue, bounds[0]), bounds)
+    last = _rangeindex(min(ratingmaxvalue, bounds[-1]), bounds)
+    return catalog['tablenames'][first:last + 1], catalog['shards'] and catalog['shards'][first:last + 1]
+
+@_pooled
+def pointquery(ratingvalue, openconnection, schemes=('range', 'roundrobin'),
+               numberofworkers=None, batchsize=10000, arrays=False):
+    """
+    Generator of the (partitionname, userid, movieid, rating) rows of the partitions of @schemes with a rating
+    equal to @ratingvalue, reading only the range partition that can hold it. The other arguments are those
+    of rangequery.
     """
     con = openconnection
-    cur = con.cursor()
-    
-    # Create all partition tables at once
-    create_tables_sql = '; '.join([
-        f"CREATE TABLE IF NOT EXISTS rrobin_part{i} (userid integer, movieid integer, rating float)"
-        for i in range(numberofpartitions)
-    ])
-    cur.execute(create_tables_sql)
-    
-    # Clear existing data in partitions
-    cur.execute('; '.join([f"TRUNCATE TABLE rrobin_part{i}" for i in range(numberofpartitions)]))
-    
-    # Insert data into each partition
-    for i in range(numberofpartitions):
-        cur.execute("""
-            INSERT INTO rrobin_part{}
-            SELECT userid, movieid, rating
-            FROM (
-                SELECT *, ROW_NUMBER() OVER () - 1 as row_num
-                FROM {}
-            ) numbered_rows
-            WHERE row_num % {} = {}
-        """.format(i, ratingstablename, numberofpartitions, i))
-    
-    cur.close()
-    con.commit()
+    condition = "rating = %s", (ratingvalue,)
 
-def roundrobininsert(ratingstablename, userid, itemid, rating, openconnection):
+    for scheme in schemes:
+        catalog = _partitioncatalog(scheme, con)
+        if scheme == 'range':
+            index = _rangeindex(ratingvalue, catalog['boundaries'])
+            tablenames, shards = [], None
+            if index is not None:
+                tablenames, shards = [catalog['tablenames'][index]], catalog['shards'] and [catalog['shards'][index]]
+            yield from _scanpartitions(con, tablenames, condition, 1, batchsize, arrays, shards)
+        else:
+            yield from _scanpartitions(con, catalog['tablenames'], condition, numberofworkers, batchsize, arrays,
+                                       catalog['shards'])
+
+@_pooled
+def hashquery(keyvalue, openconnection, batchsize=10000, arrays=False):
     """
-    Function to insert a new row into the main table and specific partition based on round robin
-    approach.
+    Generator of the (partitionname, userid, movieid, rating) rows whose hash partitioning key, userid or movieid,
+    equals @keyvalue, reading only the hash partition of that key. The other arguments are those of rangequery.
     """
     con = openconnection
-    cur = con.cursor()
-    
+    catalog = _partitioncatalog('hash', con)
+    tablename = catalog['tablenames'][_hashindex(keyvalue, catalog['numberofpartitions'])]
+    yield from _scanpartitions(con, [tablename], (f"{catalog['partitionkey']} = %s", (keyvalue,)), 1, batchsize, arrays)
+
+@_pooled
+def aggregate(scheme, openconnection, functions=AGGREGATE_FUNCTIONS, groupby=None, ratingminvalue=None,
+              ratingmaxvalue=None, orderby=None, limit=None, numberofworkers=None, batchsize=100000):
+    """
+    Function to compute the @functions of AGGREGATE_FUNCTIONS over the ratings in the partitions of @scheme, over
+    all of them or grouped by @groupby, 'userid', 'movieid' or 'rating', optionally only over the ratings between
+    @ratingminvalue and @ratingmaxvalue inclusive.
+    Every partition computes its partial counts, sums, minimums and maximums on its own connection, or on its
+    shard node, up to @numberofworkers partitions at the same time, one per partition by default. The partial
+    results are merged here with array operations, so a partition only sends one row per group.
+    Without @groupby, returns a dict of the value of every function, None for the avg, min and max of no ratings.
+    With it, returns a dict of arrays: the groups under the @groupby key and the value of every function in the
+    same order, sorted by group, or by the function @orderby descending and cut to the first @limit groups,
+    e.g. the top-K movies by count.
+    """
+    con = openconnection
+    unknown = [function for function in functions if function not in AGGREGATE_FUNCTIONS]
+    if unknown or orderby not in AGGREGATE_FUNCTIONS + (None,):
+        raise ValueError(f"Unknown aggregate function {(unknown or [orderby])[0]}, expected one of "
+                         f"{', '.join(AGGREGATE_FUNCTIONS)}")
+    if groupby not in _AGGREGATE_KEYS:
+        raise ValueError(f"Cannot group by {groupby}, expected userid, movieid or rating")
+
+    clauses, params = [], []
+    if ratingminvalue is not None:
+        clauses.append("rating >= %s")
+        params.append(ratingminvalue)
+    if ratingmaxvalue is not None:
+        clauses.append("rating <= %s")
+        params.append(ratingmaxvalue)
+    condition = ' AND '.join(clauses) or 'TRUE', tuple(params)
+
+    catalog = _partitioncatalog(scheme, con)
+    tablenames, shards = catalog['tablenames'], catalog['shards']
+    if scheme == 'range' and params:
+        tablenames, shards = _rangepartitionsbetween(
+            catalog, -math.inf if ratingminvalue is None else ratingminvalue,
+            math.inf if ratingmaxvalue is None else ratingmaxvalue)
+
+    select = _PARTIAL_AGGREGATE_SELECT.format(key=_AGGREGATE_KEYS[groupby], tablename='{tablename}',
+                                              condition='{condition}')
+    with Instrumentation.phase('scatter'):
+        partials = [np.asarray(rows, dtype=np.float64).reshape(-1, 5)
+                    for _, rows in _scanbatches(con, tablenames, condition, numberofworkers, batchsize, shards, select)]
+
+    with Instrumentation.phase('gather'):
+        keys, counts, sums, mins, maxs = _mergepartials(partials).T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = {'count': counts.astype(np.int64), 'sum': sums, 'avg': sums / counts, 'min': mins, 'max': maxs}
+
+        if groupby is None:
+            if not len(keys):
+                return {function: 0 if function == 'count' else 0.0 if function == 'sum' else None
+                        for function in functions}
+            return {function: None if np.isnan(values[function][0]) else values[function][0].item()
+                    for function in functions}
+
+        order = np.arange(len(keys)) if orderby is None else np.lexsort((keys, -values[orderby]))
+        order = order[:limit]
+        groups = keys[order] if groupby == 'rating' else keys[order].astype(np.int32)
+        return {groupby: groups, **{function: values[function][order] for function in functions}}
+
+def _mergepartials(partials):
+    """
+    Function to merge the (key, count, sum, min, max) rows of the partial aggregates in the list of arrays
+    @partials into one row per key, sorted by key. The NULL minimums and maximums of groups without ratings
+    are NaN and left out.
+    """
+    rows = np.concatenate(partials) if partials else np.empty((0, 5))
+    if not len(rows):
+        return rows
+    rows = rows[np.argsort(rows[:, 0], kind='stable')]
+    starts = np.flatnonzero(np.concatenate(([True], rows[1:, 0] != rows[:-1, 0])))
+    return np.column_stack((rows[starts, 0], np.add.reduceat(rows[:, 1], starts), np.add.reduceat(rows[:, 2], starts),
+                            np.fmin.reduceat(rows[:, 3], starts), np.fmax.reduceat(rows[:, 4], starts)))
+
+def _scanpartitions(openconnection, tablenames, condition, numberofworkers, batchsize, arrays, shards=None):
+    """
+    Generator of the rows of @tablenames matching the (sql, params) @condition. A single worker reads the tables
+    one after the other on @openconnection, more workers read them at the same time on their own connections.
+    The tables of sharded partitions are read on the nodes of @shards, the conninfos of the tables.
+    """
+    for tablename, rows in _scanbatches(openconnection, tablenames, condition, numberofworkers, batchsize, shards):
+        yield from _scanresults(tablename, rows, arrays)
+
+def _scanbatches(openconnection, tablenames, condition, numberofworkers, batchsize, shards=None, select=None):
+    """
+    Generator of the (tablename, rows) batches of the tables read by _scanpartitions, in the order they arrive.
+    @select is the query run on every table, a template with {tablename} and {condition}, _SCAN_SELECT by default.
+    """
+    con = openconnection
+    shards = shards or [None] * len(tablenames)
+    numberofworkers = min(numberofworkers or len(tablenames), len(tablenames))
+    pool = _currentpool.get()
+    if pool is not None:
+        # Leave the pool connection of the call itself
+        numberofworkers = min(numberofworkers, pool.maxconn - 1)
+
+    if numberofworkers <= 1:
+        for tablename, shard in zip(tablenames, shards):
+            for rows in _fetchpartition(con, tablename, shard, condition, batchsize, select):
+                yield tablename, rows
+        return
+
+    results = queue.Queue(maxsize=2 * numberofworkers)
+    readers = [_PartitionReader(con, tablenames[i::numberofworkers], condition, batchsize, results,
+                                shards[i::numberofworkers], select)
+               for i in range(numberofworkers)]
     try:
-        # Insert into main table
-        cur.execute("""
-            INSERT INTO {} (userid, movieid, rating)
-            VALUES (%s, %s, %s)
-        """.format(ratingstablename), (userid, itemid, rating))
-        
-        # Get total count
-        cur.execute("SELECT COUNT(*) FROM {}".format(ratingstablename))
-        total_rows = cur.fetchone()[0]
-        
-        # Calculate partition index
-        numberofpartitions = count_partitions('rrobin_part', openconnection)
-        index = (total_rows - 1) % numberofpartitions
-        
-        # Insert into partition
-        cur.execute("""
-            INSERT INTO rrobin_part{} (userid, movieid, rating)
-            VALUES (%s, %s, %s)
-        """.format(index), (userid, itemid, rating))
-        
-        con.commit()
-    except Exception as e:
-        con.rollback()
-        raise e
+        running = len(readers)
+        while running:
+            result = results.get()
+            if result is None:
+                running -= 1
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                yield result
     finally:
-        cur.close()
+        # Also stops the readers when the consumer closes the generator early
+        for reader in readers:
+            reader.stop()
 
-def rangeinsert(ratingstablename, userid, itemid, rating, openconnection):
+def _scanresults(tablename, rows, arrays):
+    if arrays:
+        userid, movieid, rating = _ratingcolumns(rows)
+        yield tablename, userid, movieid, rating
+    else:
+        for row in rows:
+            yield (tablename,) + row
+
+def _fetchbatches(openconnection, tablename, condition, batchsize, select=None):
     """
-    Function to insert a new row into the main table and specific partition based on range rating.
+    Generator of the rows of @tablename matching @condition, @batchsize rows at a time through a server-side cursor.
+    The rows are those of the @select template, _SCAN_SELECT by default.
+    """
+    sql, params = condition
+    query = (select or _SCAN_SELECT).format(tablename=tablename, condition=sql)
+    with _transaction(openconnection) as cur:
+        cur.execute(f"DECLARE partitionscan NO SCROLL CURSOR FOR {query}", params)
+        while True:
+            cur.execute("FETCH %s FROM partitionscan", (batchsize,))
+            rows = cur.fetchall()
+            if not rows:
+                break
+            yield rows
+
+def _fetchpartition(openconnection, tablename, shard, condition, batchsize, select=None):
+    """
+    _fetchbatches on @openconnection, or on a connection to the node of @shard when it is not None.
+    """
+    if shard is None:
+        yield from _fetchbatches(openconnection, tablename, condition, batchsize, select)
+        return
+    with _shardpool(openconnection, shard).connection() as con:
+        yield from _fetchbatches(con, tablename, condition, batchsize, select)
+
+class _PartitionReader(threading.Thread):
+    """
+    Thread with its own connection that puts the (tablename, rows) batches of its tables matching a condition
+    on a shared queue, then None, or the error that stopped it.
+    """
+    def __init__(self, openconnection, tablenames, condition, batchsize, results, shards, select=None):
+        super().__init__(daemon=True)
+        self.pool = _currentpool.get()
+        self.record = Instrumentation.current()
+        self.con = _workerconnection(openconnection)
+        self.tablenames = tablenames
+        self.shards = shards
+        self.condition = condition
+        self.select = select
+        self.batchsize = batchsize
+        self.results = results
+        self.stopped = threading.Event()
+        self.start()
+
+    def run(self):
+        try:
+            with Instrumentation.attached(self.record):
+                for tablename, shard in zip(self.tablenames, self.shards):
+                    for rows in _fetchpartition(self.con, tablename, shard, self.condition, self.batchsize,
+                                                self.select):
+                        if not self.put((tablename, rows)):
+                            return
+            self.put(None)
+        except Exception as e:
+            self.put(e)
+        finally:
+            _releaseworkerconnection(self.con, self.pool)
+
+    def put(self, result):
+        """
+        Wait for room on the queue unless stopped, returning whether the result was queued.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.results.put(result, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+@_pooled
+def ratingstats(scheme, openconnection, movieid=None, userid=None):
+    """
+    Function to answer aggregate questions about the ratings in the partitions of @scheme from its statistics,
+    without scanning the partitions: the number, sum, average, minimum and maximum of all ratings with the same
+    figures of every partition, or the number, sum and average of the ratings of the movie @movieid or of the
+    user @userid. The partitions must have been built with statistics.
     """
     con = openconnection
-    cur = con.cursor()
-    
-    # Get number of partitions
-    numberofpartitions = count_partitions('range_part', openconnection)
-    delta = 5.0 / numberofpartitions
-    index = int(rating / delta)
-    if rating % delta == 0 and index != 0:
-        index -= 1
-    
-    # Insert into both tables in one transaction
-    cur.execute("""
-        BEGIN;
-        INSERT INTO {} (userid, movieid, rating)
-        VALUES (%s, %s, %s);
-        INSERT INTO range_part{} (userid, movieid, rating)
-        VALUES (%s, %s, %s);
-        COMMIT;
-    """.format(ratingstablename, index), 
-    (userid, itemid, rating, userid, itemid, rating))
-    
-    cur.close()
-    con.commit()
+    if movieid is not None and userid is not None:
+        raise ValueError("Expected a movieid or a userid, not both")
+    if not _partitioncatalog(scheme, con)['statistics']:
+        raise Exception("The {0} partitions have no statistics, run {0}partition with statistics=True".format(scheme))
+
+    with _transaction(con) as cur:
+        if movieid is not None or userid is not None:
+            table, column, key = ((MOVIE_STATS_TABLE, 'movieid', movieid) if movieid is not None
+                                  else (USER_STATS_TABLE, 'userid', userid))
+            cur.execute(f"SELECT rows, ratingsum FROM {table} WHERE scheme = %s AND {column} = %s", (scheme, key))
+            rows, ratingsum = cur.fetchone() or (0, 0.0)
+            return {'rows': rows, 'sum': ratingsum, 'average': ratingsum / rows if rows else None}
+
+        cur.execute(f"""
+            SELECT partition, rows, ratingsum, minrating, maxrating
+            FROM {PARTITION_STATS_TABLE}
+            WHERE scheme = %s
+            ORDER BY partition
+        """, (scheme,))
+        partitions = [{'partition': partition, 'rows': rows, 'sum': ratingsum,
+                       'average': ratingsum / rows if rows else None, 'min': minrating, 'max': maxrating}
+                      for partition, rows, ratingsum, minrating, maxrating in cur.fetchall()]
+
+    rows = sum(partition['rows'] for partition in partitions)
+    ratingsum = sum(partition['sum'] for partition in partitions)
+    minratings = [partition['min'] for partition in partitions if partition['min'] is not None]
+    maxratings = [partition['max'] for partition in partitions if partition['max'] is not None]
+    return {'rows': rows, 'sum': ratingsum, 'average': ratingsum / rows if rows else None,
+            'min': min(minratings, default=None), 'max': max(maxratings, default=None), 'partitions': partitions}
+
+@_pooled
+def checkstats(scheme, openconnection):
+    """
+    Function to check the statistics of @scheme against the rows of its partitions, which are read again on
+    their nodes. Returns the list of the differences found, empty when the statistics match the data.
+    """
+    con = openconnection
+    catalog = _partitioncatalog(scheme, con)
+    if not catalog['statistics']:
+        raise Exception("The {0} partitions have no statistics, run {0}partition with statistics=True".format(scheme))
+
+    # Statistics of the data: partition -> (rows, sum, min, max), movie or user -> [rows, sum]
+    partitions, movies, users = {}, {}, {}
+    tablenames = catalog['tablenames']
+    for i, (tablename, shard) in enumerate(zip(tablenames, catalog['shards'] or [None] * len(tablenames))):
+        with _shardtransaction(con, shard) if shard else _transaction(con) as cur:
+            cur.execute(_PARTITION_STATS_SELECT.format(tablename))
+            partitions[i] = cur.fetchone()
+            cur.execute(f"""
+                SELECT movieid, userid, GROUPING(movieid), COUNT(*), COALESCE(SUM(rating), 0)
+                FROM {tablename}
+                GROUP BY GROUPING SETS ((movieid), (userid))
+            """)
+            for movieid, userid, byuser, rows, ratingsum in cur.fetchall():
+                key, summaries = (userid, users) if byuser else (movieid, movies)
+                if key is not None:
+                    summary = summaries.setdefault(key, [0, 0.0])
+                    summary[0] += rows
+                    summary[1] += ratingsum
+
+    errors = []
+    with _transaction(con) as cur:
+        cur.execute(f"SELECT partition, rows, ratingsum, minrating, maxrating FROM {PARTITION_STATS_TABLE} "
+                    "WHERE scheme = %s", (scheme,))
+        stored = {partition: summary for partition, *summary in cur.fetchall()}
+        for partition in sorted(set(partitions) | set(stored)):
+            if not _samestats(stored.get(partition), partitions.get(partition)):
+                errors.append("Partition {} has the statistics (rows, sum, min, max) {} but the data {}".format(
+                    partition, stored.get(partition), partitions.get(partition)))
+        for name, table, column, summaries in (('Movie', MOVIE_STATS_TABLE, 'movieid', movies),
+                                               ('User', USER_STATS_TABLE, 'userid', users)):
+            cur.execute(f"SELECT {column}, rows, ratingsum FROM {table} WHERE scheme = %s", (scheme,))
+            stored = {key: summary for key, *summary in cur.fetchall()}
+            for key in sorted(set(summaries) | set(stored)):
+                if not _samestats(stored.get(key), summaries.get(key)):
+                    errors.append("{} {} has the statistics (rows, sum) {} but the data {}".format(
+                        name, key, stored.get(key), summaries.get(key)))
+    return errors
+
+def _samestats(stored, actual):
+    """
+    Function to compare two statistics tuples, allowing for the rounding of sums added up in another order.
+    """
+    if stored is None or actual is None:
+        return stored is actual
+    return all(a == b if a is None or b is None or isinstance(a, int) else math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-6)
+               for a, b in zip(stored, actual))
+
+def _refreshstats(cur, scheme, ratingstablename, tablenames, statistics, shards=None):
+    """
+    Function to rebuild the statistics of @scheme for its new partitions @tablenames within the transaction of
+    the build, or to drop them when the partitioning comes without @statistics. The movie and user statistics
+    are taken from the rows of @ratingstablename the partitions hold, in one scan.
+    """
+    if not statistics:
+        cur.execute("SELECT to_regclass(%s)", (PARTITION_STATS_TABLE,))
+        if cur.fetchone()[0] is not None:
+            cur.execute('; '.join(f"DELETE FROM {table} WHERE scheme = %s"
+                                  for table in (PARTITION_STATS_TABLE, MOVIE_STATS_TABLE, USER_STATS_TABLE)),
+                        (scheme,) * 3)
+        return
+
+    cur.execute(_STATS_SQL)
+    _refreshpartitionstats(cur, scheme, tablenames, shards)
+    condition = "TRUE"
+    if scheme == 'range':
+        bounds = _rangebounds(len(tablenames))
+        condition = f"rating >= {bounds[0]!r} AND rating <= {bounds[-1]!r}"
+    cur.execute(f"""
+        DELETE FROM {MOVIE_STATS_TABLE} WHERE scheme = %s;
+        DELETE FROM {USER_STATS_TABLE} WHERE scheme = %s;
+        WITH grouped AS (
+            SELECT movieid, userid, GROUPING(movieid) AS byuser, COUNT(*) AS rows,
+                   COALESCE(SUM(rating), 0) AS ratingsum
+            FROM {ratingstablename}
+            WHERE {condition}
+            GROUP BY GROUPING SETS ((movieid), (userid))
+        ), movies AS (
+            INSERT INTO {MOVIE_STATS_TABLE}
+            SELECT %s, movieid, rows, ratingsum FROM grouped WHERE byuser = 0 AND movieid IS NOT NULL
+        )
+        INSERT INTO {USER_STATS_TABLE}
+        SELECT %s, userid, rows, ratingsum FROM grouped WHERE byuser = 1 AND userid IS NOT NULL
+    """, (scheme,) * 4)
+
+def _refreshpartitionstats(cur, scheme, tablenames, shards=None):
+    """
+    Function to rebuild the partition statistics of @scheme from its partitions @tablenames, read on the nodes
+    of @shards when they are sharded.
+    """
+    cur.execute(f"DELETE FROM {PARTITION_STATS_TABLE} WHERE scheme = %s", (scheme,))
+    for i, (tablename, shard) in enumerate(zip(tablenames, shards or [None] * len(tablenames))):
+        with _shardtransaction(cur.connection, shard) if shard else nullcontext(cur) as partitioncur:
+            partitioncur.execute(_PARTITION_STATS_SELECT.format(tablename))
+            summary = partitioncur.fetchone()
+        cur.execute(f"INSERT INTO {PARTITION_STATS_TABLE} VALUES (%s, %s, %s, %s, %s, %s)", (scheme, i) + summary)
+
+def _statsupdatesql(scheme, placeholders):
+    """
+    SQL adding the deltas of _statsdeltas to the statistics of @scheme in one statement, @placeholders are the
+    driver's markers of its eleven arrays. The statistics rows are locked in the order of their keys, so
+    concurrent inserts cannot deadlock on them.
+    """
+    return f"WITH {_statsctessql(scheme, placeholders)} SELECT 1"
+
+def _statsctessql(scheme, placeholders):
+    """
+    SQL of the data-modifying WITH queries of _statsupdatesql, for statements that also make other changes.
+    @placeholders can also be SQL expressions of the arrays.
+    """
+    return """
+        partitions AS (
+            INSERT INTO {0} AS stats
+            SELECT '{3}', * FROM unnest({4}::integer[], {5}::bigint[], {6}::float8[], {7}::float8[], {8}::float8[])
+            ON CONFLICT (scheme, partition) DO UPDATE
+            SET rows = stats.rows + excluded.rows, ratingsum = stats.ratingsum + excluded.ratingsum,
+                minrating = LEAST(stats.minrating, excluded.minrating),
+                maxrating = GREATEST(stats.maxrating, excluded.maxrating)
+        ), movies AS (
+            INSERT INTO {1} AS stats
+            SELECT '{3}', * FROM unnest({9}::integer[], {10}::bigint[], {11}::float8[])
+            ON CONFLICT (scheme, movieid) DO UPDATE
+            SET rows = stats.rows + excluded.rows, ratingsum = stats.ratingsum + excluded.ratingsum
+        ), users AS (
+            INSERT INTO {2} AS stats
+            SELECT '{3}', * FROM unnest({12}::integer[], {13}::bigint[], {14}::float8[])
+            ON CONFLICT (scheme, userid) DO UPDATE
+            SET rows = stats.rows + excluded.rows, ratingsum = stats.ratingsum + excluded.ratingsum
+        )
+    """.format(PARTITION_STATS_TABLE, MOVIE_STATS_TABLE, USER_STATS_TABLE, scheme, *placeholders)
 
-def create_db(dbname):
+def _statsdeltas(index, userid, movieid, rating):
+    """
+    Function to sum up the rows given as values or arrays with their partition @index by partition, movie and user,
+    as the lists of the arguments of _statsupdatesql in key order. @rating must be the stored ratings.
+    """
+    index, userid, movieid = (np.atleast_1d(np.asarray(values, dtype=np.int64)) for values in (index, userid, movieid))
+    rating = np.atleast_1d(np.asarray(rating, dtype=np.float64))
+    deltas = []
+    for keys in (index, movieid, userid):
+        unique, inverse = np.unique(keys, return_inverse=True)
+        deltas += [unique.tolist(), np.bincount(inverse).tolist(), np.bincount(inverse, weights=rating).tolist()]
+        if keys is index:
+            minrating = np.full(len(unique), np.inf)
+            np.minimum.at(minrating, inverse, rating)
+            maxrating = np.full(len(unique), -np.inf)
+            np.maximum.at(maxrating, inverse, rating)
+            deltas += [minrating.tolist(), maxrating.tolist()]
+    return deltas
+
+def create_db(dbname, openconnection=None):
     """
     We create a DB by connecting to the default user and database of Postgres
     The function first checks if an existing database exists for a given name, else creates it.
+    An open connection or ConnectionPool of the same server can be passed instead of connecting again.
     :return:None
     """
+    if openconnection is not None:
+        with (openconnection.connection() if isinstance(openconnection, ConnectionPool) else nullcontext(openconnection)) as con:
+            autocommit = con.autocommit
+            con.autocommit = True
+            try:
+                _createdatabase(dbname, con)
+            finally:
+                con.autocommit = autocommit
+        return
+
     con = getopenconnection(dbname='postgres')
     con.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-    cur = con.cursor()
+    _createdatabase(dbname, con)
+    con.close()
+
+def _createdatabase(dbname, openconnection):
+    cur = _cursor(openconnection)
     
     cur.execute('SELECT COUNT(*) FROM pg_catalog.pg_database WHERE datname=%s', (dbname,))
     count = cur.fetchone()[0]
@@ -206,14 +2828,14 @@ def create_db(dbname):
         print('A database named {0} already exists'.format(dbname))
     
     cur.close()
-    con.close()
 
+@_pooled
 def count_partitions(prefix, openconnection):
     """
     Function to count the number of tables which have the @prefix in their name somewhere.
     """
     con = openconnection
-    cur = con.cursor()
+    cur = _cursor(con)
     cur.execute("""
         SELECT COUNT(*) 
         FROM pg_stat_user_tables 
@@ -222,3 +2844,225 @@ def count_partitions(prefix, openconnection):
     count = cur.fetchone()[0]
     cur.close()
     return count
+
+
+def _registerpartitions(cur, scheme, ratingstablename, boundaries, tablenames, partitionkey=None,
+                        shards=None, statistics=False):
+    """
+    Function to record a partitioning in the partition catalog, within the transaction of the build.
+    @shards are the conninfos of the nodes of the partitions, None when they live in this database.
+    @statistics tells whether the inserts maintain the statistics of the scheme.
+    The version of the entry is increased and announced to the listening sessions on commit.
+    """
+    cur.execute(_PARTITION_CATALOG_SQL)
+    cur.execute(_registerpartitionssql(['%s'] * 8),
+                (scheme, ratingstablename, len(tablenames), boundaries, tablenames, partitionkey, shards, statistics))
+    version = cur.fetchone()[0]
+    cur.execute("SELECT pg_notify(%s, %s)", (PARTITION_CATALOG_TABLE, f"{scheme} {version}"))
+
+def _registerpartitionssql(placeholders):
+    """
+    SQL to upsert the catalog entry of a scheme, @placeholders are the driver's markers of its eight arguments.
+    """
+    return """
+        INSERT INTO {} AS catalog (scheme, ratingstablename, numberofpartitions, boundaries, tablenames, partitionkey,
+                                   shards, statistics, version)
+        VALUES ({}, {}, {}, {}, {}, {}, {}, {}, 1)
+        ON CONFLICT (scheme) DO UPDATE
+        SET ratingstablename = excluded.ratingstablename,
+            numberofpartitions = excluded.numberofpartitions,
+            boundaries = excluded.boundaries,
+            tablenames = excluded.tablenames,
+            partitionkey = excluded.partitionkey,
+            shards = excluded.shards,
+            statistics = excluded.statistics,
+            version = catalog.version + 1
+        RETURNING version
+    """.format(PARTITION_CATALOG_TABLE, *placeholders)
+
+def _partitioncatalog(scheme, openconnection):
+    """
+    Function to get the catalog entry of the partitioning @scheme from the process-local cache of the connection.
+    The catalog is only read when the entry is missing or a newer version has been announced to the connection, so
+    inserts normally make no catalog queries at all. Notifications only reach a connection between transactions,
+    so inside a transaction of the caller the entry is read every time.
+    """
+    con = openconnection
+    _pollcatalog(con)
+    idle = con.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    catalog = _catalogcache.get(con, {}).get(scheme) if idle else None
+    if catalog is None:
+        catalog = _readcatalog(scheme, con)
+        if idle and con in _catalogcache:
+            _catalogcache[con][scheme] = catalog
+    return catalog
+
+def _readcatalog(scheme, openconnection):
+    """
+    Function to read the catalog entry of @scheme. An idle connection is subscribed to the catalog versions first,
+    with LISTEN committed before the read so that no later version goes unheard, and gets a cache of its own.
+    """
+    con = openconnection
+    idle = con.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    cur = _cursor(con)
+    try:
+        if idle and con not in _catalogcache:
+            cur.execute(f"LISTEN {PARTITION_CATALOG_TABLE}")
+            if not con.autocommit:
+                con.commit()
+            # Not within a 'with openconnection:' block in autocommit mode, where LISTEN waits for its end
+            if con.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                _catalogcache[con] = {}
+        cur.execute("SELECT to_regclass(%s)", (PARTITION_CATALOG_TABLE,))
+        row = None
+        if cur.fetchone()[0] is not None:
+            cur.execute(f"""
+                SELECT ratingstablename, numberofpartitions, boundaries, tablenames, partitionkey, shards, statistics,
+                       version
+                FROM {PARTITION_CATALOG_TABLE}
+                WHERE scheme = %s
+            """, (scheme,))
+            row = cur.fetchone()
+    finally:
+        cur.close()
+        # Do not leave a transaction open that the caller did not start
+        if idle and not con.autocommit:
+            con.commit()
+
+    if row is None:
+        raise Exception("No {0} partitions found, run {0}partition first".format(scheme))
+    ratingstablename, numberofpartitions, boundaries, tablenames, partitionkey, shards, statistics, version = row
+    return {
+        'scheme': scheme,
+        'ratingstablename': ratingstablename,
+        'numberofpartitions': numberofpartitions,
+        'boundaries': boundaries,
+        'tablenames': tablenames,
+        'partitionkey': partitionkey,
+        'shards': shards,
+        'statistics': bool(statistics),
+        'version': version,
+    }
+
+def _pollcatalog(openconnection):
+    """
+    Function to drop the cached catalog entries that the notifications received by the connection outdated.
+    Polling only reads what the server already sent, it makes no round trip.
+    """
+    con = openconnection
+    entries = _catalogcache.get(con)
+    if entries is None:
+        return
+    if con.closed:
+        del _catalogcache[con]
+        return
+    con.poll()
+    others = []
+    for notify in con.notifies:
+        if notify.channel != PARTITION_CATALOG_TABLE:
+            others.append(notify)
+            continue
+        scheme, version = notify.payload.split()
+        catalog = entries.get(scheme)
+        if catalog is not None and catalog['version'] != int(version):
+            del entries[scheme]
+    con.notifies[:] = others
+
+def _invalidatecatalog(openconnection, scheme):
+    """
+    Function to drop the cached catalog entries of @scheme of all connections of this process to the database of
+    @openconnection after this process changed the partitioning, without waiting for them to hear of it.
+    """
+    database = _databasekey(openconnection)
+    for con, entries in list(_catalogcache.items()):
+        if con.closed or _databasekey(con) == database:
+            entries.pop(scheme, None)
+
+def _databasekey(openconnection):
+    info = openconnection.info
+    return info.host, info.port, info.dbname
+
+def _connectionparams(openconnection):
+    """
+    Function to get the arguments of getopenconnection for another session on the database of @openconnection.
+    """
+    info = openconnection.info
+    return dict(user=info.user, password=info.password or '', dbname=info.dbname, host=info.host, port=info.port)
+
+def _workerconnection(openconnection):
+    """
+    Function to get another connection to the database of @openconnection for a helper thread, out of the
+    pool of the current call if there is one.
+    """
+    pool = _currentpool.get()
+    if pool is not None:
+        return pool.getconn()
+    return getopenconnection(**_connectionparams(openconnection))
+
+def _releaseworkerconnection(con, pool):
+    if pool is not None:
+        pool.putconn(con)
+    else:
+        con.close()
+
+def _shardconninfo(target):
+    """
+    Function to get the conninfo of the node of the connection @target, as recorded in the partition catalog.
+    The password is left out of the catalog.
+    """
+    return "host={host} port={port} dbname={dbname} user={user}".format(**target)
+
+def _shardpool(openconnection, shard, password=None):
+    """
+    Function to get the pool of connections to the node of the conninfo @shard, opened on first use with
+    @password, or else with the password of @openconnection.
+    """
+    with _shardpoolslock:
+        pool = _shardpools.get(shard)
+        if pool is None:
+            params = psycopg2.extensions.parse_dsn(shard)
+            params['password'] = openconnection.info.password or '' if password is None else password
+            pool = _shardpools[shard] = ConnectionPool(0, SHARD_POOL_SIZE, **params)
+    return pool
+
+@contextmanager
+def _shardtransaction(openconnection, shard):
+    """
+    Run the enclosed statements as one transaction on the node of @shard with a connection of its pool.
+    """
+    with _shardpool(openconnection, shard).connection() as con, _transaction(con) as cur:
+        yield cur
+
+@contextmanager
+def _transaction(openconnection):
+    """
+    Run the enclosed statements as one transaction, also when @openconnection is in autocommit mode.
+    """
+    con = openconnection
+    cur = _cursor(con)
+    if con.autocommit:
+        cur.execute("BEGIN")
+    try:
+        yield cur
+    except Exception:
+        if con.autocommit:
+            cur.execute("ROLLBACK")
+        else:
+            con.rollback()
+        raise
+    else:
+        with Instrumentation.phase('commit'):
+            if con.autocommit:
+                cur.execute("COMMIT")
+            else:
+                con.commit()
+    finally:
+        cur.close()
+
+def _cursor(openconnection):
+    """
+    Function to open a cursor on @openconnection, one that records its statements while Instrumentation is enabled.
+    """
+    if Instrumentation.isenabled():
+        return openconnection.cursor(cursor_factory=Instrumentation.InstrumentedCursor)
+    return openconnection.cursor()
@@ -1,8 +1,21 @@
+import asyncio
+import bz2
+import gzip
+import importlib
+import io
+import lzma
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
 import traceback
 import psycopg2
+import psycopg2.pool
 
 RANGE_TABLE_PREFIX = 'range_part'
 RROBIN_TABLE_PREFIX = 'rrobin_part'
+HASH_TABLE_PREFIX = 'hash_part'
 USER_ID_COLNAME = 'userid'
 MOVIE_ID_COLNAME = 'movieid'
 RATING_COLNAME = 'rating'
@@ -56,50 +69,151 @@ def getopenconnection(user='postgres', password='1234', dbname='postgres'):
 
 
 ####### Tester support
-def getCountrangepartition(ratingstablename, numberofpartitions, openconnection):
+# Order-independent checksum of a row: the sum of this hash over a table only depends on the multiset of its rows
+ROW_HASH_SQL = "hashint8extended(({0}::bigint << 32) | ({1}::bigint & 4294967295), hashfloat8extended({2}::float8, 0))" \
+    .format(USER_ID_COLNAME, MOVIE_ID_COLNAME, RATING_COLNAME)
+
+
+def getrangepartitionsql(numberofpartitions):
     """
-    Get number of rows for each partition
-    :param ratingstablename:
+    SQL expression of the range partition of a row, NULL when its rating is outside of all partitions.
+    The first partition holds the ratings from 0 to its upper bound, the others those above their lower bound up to
+    their upper bound.
     :param numberofpartitions:
-    :param openconnection:
     :return:
     """
-    cur = openconnection.cursor()
-    countList = []
     interval = 5.0 / numberofpartitions
-    cur.execute("select count(*) from {0} where rating >= {1} and rating <= {2}".format(ratingstablename,0, interval))
-    countList.append(int(cur.fetchone()[0]))
-
+    cases = ["WHEN {0} >= {1!r} AND {0} <= {2!r} THEN 0".format(RATING_COLNAME, 0, interval)]
     lowerbound = interval
     for i in range(1, numberofpartitions):
-        cur.execute("select count(*) from {0} where rating > {1} and rating <= {2}".format(ratingstablename,
-                                                                                          lowerbound,
-                                                                                          lowerbound + interval))
+        cases.append("WHEN {0} > {1!r} AND {0} <= {2!r} THEN {3}".format(RATING_COLNAME, lowerbound,
+                                                                      lowerbound + interval, i))
         lowerbound += interval
-        countList.append(int(cur.fetchone()[0]))
-
-    cur.close()
-    return countList
+    return "CASE {0} END".format(' '.join(cases))
 
 
-def getCountroundrobinpartition(ratingstablename, numberofpartitions, openconnection):
-    '''
-    Get number of rows for each partition
-    :param ratingstablename:
-    :param numberofpartitions:
+def verifypartitioning(ratingstablename, scheme, numberofpartitions, openconnection, partitiontableprefix,
+                       partitionstartindex=0, expectedrows=None):
+    """
+    Verify a 'range' or 'roundrobin' partitioning of ratingstablename with one scan of the base table, which gives the
+    expected count of every partition, and one scan of every partition.
+    Besides count mismatches, the checksums catch rows that are lost from a partition while others are duplicated
+    into it, and rows that are altered. The base table has no order, so which row is dealt to which round robin
+    partition depends on its scan order: round robin partitions only have an expected count, n // N or one more for
+    the first n % N of them, and only the checksum of all of them together is checked.
+    :param ratingstablename: Base table of the partitioning
+    :param scheme: 'range' or 'roundrobin'
+    :param numberofpartitions: Number of partitions asked for
     :param openconnection:
-    :return:
-    '''
-    cur = openconnection.cursor()
-    countList = []
-    for i in range(0, numberofpartitions):
-        cur.execute(
-            "select count(*) from (select *, row_number() over () from {0}) as temp where (row_number-1)%{1}= {2}".format(
-                ratingstablename, numberofpartitions, i))
-        countList.append(int(cur.fetchone()[0]))
+    :param partitiontableprefix: Partition i is named partitiontableprefix + (partitionstartindex + i)
+    :param partitionstartindex:
+    :param expectedrows: Number of rows the partitions should hold together, the partitioned rows of the base table by default
+    :return: Report dict with the overall counts and checksums, one entry per partition and the list of errors,
+             'ok' is True when there are none
+    """
+    if scheme not in ('range', 'roundrobin'):
+        raise ValueError("Unknown partitioning scheme '{0}', expected range or roundrobin".format(scheme))
+    report = {'scheme': scheme, 'numberofpartitions': numberofpartitions, 'tables': 0, 'rows': 0,
+              'expectedrows': expectedrows, 'unpartitionedrows': 0, 'lostrows': 0, 'extrarows': 0,
+              'checksum': 0, 'expectedchecksum': 0, 'partitions': [], 'errors': []}
+
+    with openconnection.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = 'public' AND table_name LIKE %s",
+                    (partitiontableprefix + '%',))
+        report['tables'] = int(cur.fetchone()[0])
+
+        if not isinstance(numberofpartitions, int) or numberofpartitions <= 0:
+            if report['tables'] != 0:
+                report['errors'].append('Expected 0 partition table(s) but found {0} table(s)'.format(report['tables']))
+            report['ok'] = not report['errors']
+            return report
+        if report['tables'] != numberofpartitions:
+            report['errors'].append('Expected {0} partition table(s) but found {1} table(s)'.format(
+                numberofpartitions, report['tables']))
+
+        # Single scan of the base table: expected count of every partition, and its checksum for range
+        expected = {}
+        if scheme == 'range':
+            partitionsql = getrangepartitionsql(numberofpartitions)
+            cur.execute("SELECT {0} AS partition, COUNT(*), COALESCE(SUM({1}), 0) FROM {2} GROUP BY 1".format(
+                partitionsql, ROW_HASH_SQL, ratingstablename))
+            for partition, count, checksum in cur.fetchall():
+                if partition is None:
+                    report['unpartitionedrows'] = int(count)
+                else:
+                    expected[int(partition)] = (int(count), int(checksum))
+            report['expectedchecksum'] = sum(checksum for _, checksum in expected.values())
+        else:
+            cur.execute("SELECT COUNT(*), COALESCE(SUM({0}), 0) FROM {1}".format(ROW_HASH_SQL, ratingstablename))
+            count, checksum = (int(value) for value in cur.fetchone())
+            for i in range(numberofpartitions):
+                expected[i] = (count // numberofpartitions + (i < count % numberofpartitions), None)
+            report['expectedchecksum'] = checksum
+
+        # Single scan of every existing partition, all in one statement
+        tablenames = ['{0}{1}'.format(partitiontableprefix, partitionstartindex + i) for i in range(numberofpartitions)]
+        existing = []
+        for i, tablename in enumerate(tablenames):
+            cur.execute("SELECT to_regclass(%s)", (tablename,))
+            if cur.fetchone()[0] is not None:
+                existing.append(i)
+        actual = {}
+        if existing:
+            cur.execute(' UNION ALL '.join(
+                "SELECT {0}, COUNT(*), COALESCE(SUM({1}), 0) FROM {2}".format(i, ROW_HASH_SQL, tablenames[i])
+                for i in existing))
+            actual = {int(i): (int(count), int(checksum)) for i, count, checksum in cur.fetchall()}
+
+    for i, tablename in enumerate(tablenames):
+        expectedcount, expectedchecksum = expected.get(i, (0, 0))
+        partition = {'table': tablename, 'exists': i in actual, 'rows': None, 'expectedrows': expectedcount,
+                     'checksum': None, 'expectedchecksum': expectedchecksum}
+        if i not in actual:
+            report['errors'].append('{0} does not exist'.format(tablename))
+        else:
+            partition['rows'], partition['checksum'] = actual[i]
+            if partition['rows'] != expectedcount:
+                report['errors'].append('{0} has {1} of rows while the correct number should be {2}'.format(
+                    tablename, partition['rows'], expectedcount))
+            elif expectedchecksum is not None and partition['checksum'] != expectedchecksum:
+                report['errors'].append('{0} has the correct number of rows ({1}) but not the correct rows'.format(
+                    tablename, expectedcount))
+        partition['ok'] = partition['exists'] and partition['rows'] == expectedcount and \
+            expectedchecksum in (None, partition['checksum'])
+        report['partitions'].append(partition)
+
+    report['rows'] = sum(count for count, _ in actual.values())
+    report['checksum'] = sum(checksum for _, checksum in actual.values())
+    if report['expectedrows'] is None:
+        report['expectedrows'] = sum(count for count, _ in expected.values())
+
+    # Completeness, disjointness and reconstruction of the partitions as a whole
+    if report['rows'] < report['expectedrows']:
+        report['lostrows'] = report['expectedrows'] - report['rows']
+        report['errors'].append('Completeness property of Partitioning failed. Expected {0} rows after merging all '
+                                'tables, but found {1} rows'.format(report['expectedrows'], report['rows']))
+    elif report['rows'] > report['expectedrows']:
+        report['extrarows'] = report['rows'] - report['expectedrows']
+        report['errors'].append('Disjointness property of Partitioning failed. Expected {0} rows after merging all '
+                                'tables, but found {1} rows'.format(report['expectedrows'], report['rows']))
+    elif report['checksum'] != report['expectedchecksum']:
+        report['errors'].append('Reconstruction property of Partitioning failed. The {0} rows after merging all '
+                                'tables are not the rows of {1}'.format(report['rows'], ratingstablename))
+    report['ok'] = not report['errors']
+    return report
 
-    cur.close()
-    return countList
+
+def checkpartitioning(ratingstablename, scheme, numberofpartitions, openconnection, partitiontableprefix,
+                      partitionstartindex, expectedrows):
+    """
+    Verify a partitioning with verifypartitioning, raising an exception with all errors of the report if it failed.
+    :return: The report
+    """
+    report = verifypartitioning(ratingstablename, scheme, numberofpartitions, openconnection, partitiontableprefix,
+                                partitionstartindex, expectedrows)
+    if not report['ok']:
+        raise Exception('{0} partitioning not done properly: {1}'.format(scheme, '; '.join(report['errors'])))
+    return report
 
 # Helpers for Tester functions
 def checkpartitioncount(cursor, expectedpartitions, prefix):
@@ -113,76 +227,19 @@ def checkpartitioncount(cursor, expectedpartitions, prefix):
             count))
 
 
-def totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex):
-    selects = []
-    for i in range(partitionstartindex, n + partitionstartindex):
-        selects.append('SELECT * FROM {0}{1}'.format(rangepartitiontableprefix, i))
-    cur.execute('SELECT COUNT(*) FROM ({0}) AS T'.format(' UNION ALL '.join(selects)))
-    count = int(cur.fetchone()[0])
-    return count
-
-
-def testrangeandrobinpartitioning(n, openconnection, rangepartitiontableprefix, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE):
+def countrows(tablename, userid, itemid, rating, openconnection):
     with openconnection.cursor() as cur:
-        if not isinstance(n, int) or n < 0:
-            # Test 1: Check the number of tables created, if 'n' is invalid
-            checkpartitioncount(cur, 0, rangepartitiontableprefix)
-        else:
-            # Test 2: Check the number of tables created, if all args are correct
-            checkpartitioncount(cur, n, rangepartitiontableprefix)
+        cur.execute('SELECT COUNT(*) FROM {0} WHERE {1} = %s AND {2} = %s AND {3} = %s'.format(
+            tablename, USER_ID_COLNAME, MOVIE_ID_COLNAME, RATING_COLNAME), (userid, itemid, rating))
+        return int(cur.fetchone()[0])
 
-            # Test 3: Test Completeness by SQL UNION ALL Magic
-            count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
-            if count < ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
-                "Completeness property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
-                    ACTUAL_ROWS_IN_INPUT_FILE, count))
-
-            # Test 4: Test Disjointness by SQL UNION Magic
-            count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
-            if count > ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
-                "Dijointness property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
-                    ACTUAL_ROWS_IN_INPUT_FILE, count))
-
-            # Test 5: Test Reconstruction by SQL UNION Magic
-            count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
-            if count != ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
-                "Rescontruction property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
-                    ACTUAL_ROWS_IN_INPUT_FILE, count))
-
-
-def testrangerobininsert(expectedtablename, itemid, openconnection, rating, userid):
+def tablechecksum(tablename, openconnection):
+    """
+    Count and order-independent checksum of the rows of tablename, equal for two tables holding the same rows
+    """
     with openconnection.cursor() as cur:
-        cur.execute(
-            'SELECT COUNT(*) FROM {0} WHERE {4} = {1} AND {5} = {2} AND {6} = {3}'.format(expectedtablename, userid,
-                                                                                          itemid, rating,
-                                                                                          USER_ID_COLNAME,
-                                                                                          MOVIE_ID_COLNAME,
-                                                                                          RATING_COLNAME))
-        count = int(cur.fetchone()[0])
-        if count != 1:  return False
-        return True
-
-def testEachRangePartition(ratingstablename, n, openconnection, rangepartitiontableprefix):
-    countList = getCountrangepartition(ratingstablename, n, openconnection)
-    cur = openconnection.cursor()
-    for i in range(0, n):
-        cur.execute("select count(*) from {0}{1}".format(rangepartitiontableprefix, i))
-        count = int(cur.fetchone()[0])
-        if count != countList[i]:
-            raise Exception("{0}{1} has {2} of rows while the correct number should be {3}".format(
-                rangepartitiontableprefix, i, count, countList[i]
-            ))
-
-def testEachRoundrobinPartition(ratingstablename, n, openconnection, roundrobinpartitiontableprefix):
-    countList = getCountroundrobinpartition(ratingstablename, n, openconnection)
-    cur = openconnection.cursor()
-    for i in range(0, n):
-        cur.execute("select count(*) from {0}{1}".format(roundrobinpartitiontableprefix, i))
-        count = cur.fetchone()[0]
-        if count != countList[i]:
-            raise Exception("{0}{1} has {2} of rows while the correct number should be {3}".format(
-                roundrobinpartitiontableprefix, i, count, countList[i]
-            ))
+        cur.execute('SELECT COUNT(*), COALESCE(SUM({0}), 0) FROM {1}'.format(ROW_HASH_SQL, tablename))
+        return tuple(int(value) for value in cur.fetchone())
 
 # ##########
 
@@ -210,6 +267,155 @@ def testloadratings(MyAssignment, ratingstablename, filepath, openconnection, ro
     return [True, None]
 
 
+
+def testparallelload(MyAssignment, ratingstablename, parallelratingstablename, filepath, openconnection,
+                     numberofworkers):
+    """
+    Tests the load ratings function with several workers, which must load the rows the single worker load of
+    ratingstablename holds
+    :param ratingstablename: Table loaded from filepath with one worker
+    :param parallelratingstablename: Argument for function to be tested, a table of its own
+    :param filepath: Argument for function to be tested
+    :param openconnection: Argument for function to be tested
+    :param numberofworkers: Argument for function to be tested
+    :return:Raises exception if any test fails
+    """
+    try:
+        MyAssignment.loadratings(parallelratingstablename, filepath, openconnection, numberofworkers=numberofworkers)
+        expected = tablechecksum(ratingstablename, openconnection)
+        loaded = tablechecksum(parallelratingstablename, openconnection)
+        if loaded != expected:
+            raise Exception('The load with {0} workers gave {1} rows (checksum {2}) instead of {3} (checksum {4})'.format(
+                numberofworkers, loaded[0], loaded[1], expected[0], expected[1]))
+        with openconnection.cursor() as cur:
+            cur.execute('DROP TABLE IF EXISTS {0}'.format(parallelratingstablename))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+# Lines the text and binary copy formats must load alike: signs, a blank, a short, a three field, a padded CRLF and
+# a five field line
+COPYFORMAT_LINES = b"1::10::3.5::838985046\n-2::20::-0.5::838983525\n\n3::30\n4::40::4\n" \
+                   b" 5::50::2.5::838983392 \r\n6::60::1::2::3\n"
+COPYFORMAT_ROWS = [(-2, 20, -0.5), (1, 10, 3.5), (4, 40, 4.0), (5, 50, 2.5), (6, 60, 1.0)]
+# A line both copy formats must reject
+COPYFORMAT_MALFORMED_LINE = b"1.5::10::3::838985046\n"
+
+
+def testcopyformats(MyAssignment, ratingstablename, openconnection):
+    """
+    Tests that the load ratings function reads the same rows with the 'text' and 'binary' copy formats, and that
+    both reject a malformed line
+    :param ratingstablename: Argument for function to be tested, a table of its own
+    :param openconnection: Argument for function to be tested
+    :return:Raises exception if any test fails
+    """
+    fd, filepath = tempfile.mkstemp(suffix='.dat')
+    try:
+        for copyformat in ('text', 'binary'):
+            with os.fdopen(os.open(filepath, os.O_WRONLY | os.O_TRUNC), 'wb') as f:
+                f.write(COPYFORMAT_LINES)
+            MyAssignment.loadratings(ratingstablename, filepath, openconnection, copyformat=copyformat)
+            with openconnection.cursor() as cur:
+                cur.execute('SELECT {1}, {2}, {3} FROM {0} ORDER BY 1'.format(
+                    ratingstablename, USER_ID_COLNAME, MOVIE_ID_COLNAME, RATING_COLNAME))
+                rows = cur.fetchall()
+            if rows != COPYFORMAT_ROWS:
+                raise Exception('The {0} copy format loaded {1} instead of {2}'.format(copyformat, rows, COPYFORMAT_ROWS))
+
+            with os.fdopen(os.open(filepath, os.O_WRONLY | os.O_APPEND), 'wb') as f:
+                f.write(COPYFORMAT_MALFORMED_LINE)
+            try:
+                MyAssignment.loadratings(ratingstablename, filepath, openconnection, copyformat=copyformat)
+            except (ValueError, psycopg2.DataError):
+                if openconnection.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                    openconnection.rollback()
+            else:
+                raise Exception('The {0} copy format loaded the malformed line {1!r}'.format(
+                    copyformat, COPYFORMAT_MALFORMED_LINE))
+        with openconnection.cursor() as cur:
+            cur.execute('DROP TABLE IF EXISTS {0}'.format(ratingstablename))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    finally:
+        os.close(fd)
+        os.remove(filepath)
+    return [True, None]
+
+
+# Ratings of the files written by createratingsfile
+GENERATED_RATINGS = (0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0)
+
+
+def createratingsfile(rows, seed=0):
+    """
+    Writes a temporary ratings file of rows random userid::movieid::rating::timestamp lines
+    :return: Path of the file, which the caller removes
+    """
+    generator = random.Random(seed)
+    fd, filepath = tempfile.mkstemp(suffix='.dat')
+    with os.fdopen(fd, 'w') as f:
+        for _ in range(rows):
+            f.write('{0}::{1}::{2}::838985046\n'.format(generator.randint(1, 1000), generator.randint(1, 500),
+                                                       generator.choice(GENERATED_RATINGS)))
+    return filepath
+
+
+# Rows of the file of teststreamedinputs, several blocks of the streaming loader
+STREAMED_ROWS = 250000
+STREAMED_COMPRESSIONS = (('.gz', gzip.open), ('.bz2', bz2.open), ('.xz', lzma.open))
+
+
+def teststreamedinputs(MyAssignment, ratingstablename, openconnection):
+    """
+    Tests the load ratings function with streamed inputs: gzip, bzip2 and xz compressed copies of a ratings file, the
+    file as a file object and as stdin must load the rows of the file itself
+    :param ratingstablename: Argument for function to be tested, a table of its own
+    :param openconnection: Argument for function to be tested
+    :return:Raises exception if any test fails
+    """
+    filepath = createratingsfile(STREAMED_ROWS)
+    paths = [filepath]
+    stdin = sys.stdin
+    try:
+        with open(filepath, 'ab') as f:
+            f.write(COPYFORMAT_LINES)
+        MyAssignment.loadratings(ratingstablename, filepath, openconnection)
+        expected = tablechecksum(ratingstablename, openconnection)
+
+        for source in [suffix for suffix, _ in STREAMED_COMPRESSIONS] + ['file object', 'stdin']:
+            if source == 'file object':
+                with open(filepath, 'rb') as f:
+                    MyAssignment.loadratings(ratingstablename, f, openconnection, copyformat='binary')
+            elif source == 'stdin':
+                with open(filepath, 'rb') as f:
+                    sys.stdin = io.TextIOWrapper(f)
+                    MyAssignment.loadratings(ratingstablename, '-', openconnection)
+                    sys.stdin = stdin
+            else:
+                paths.append(filepath + source)
+                with open(filepath, 'rb') as f, dict(STREAMED_COMPRESSIONS)[source](paths[-1], 'wb') as compressed:
+                    compressed.write(f.read())
+                # A compressed file is streamed by one worker whatever the number asked for
+                MyAssignment.loadratings(ratingstablename, paths[-1], openconnection, numberofworkers=4)
+            loaded = tablechecksum(ratingstablename, openconnection)
+            if loaded != expected:
+                raise Exception('The {0} input loaded {1} rows (checksum {2}) instead of {3} (checksum {4})'.format(
+                    source, loaded[0], loaded[1], expected[0], expected[1]))
+        with openconnection.cursor() as cur:
+            cur.execute('DROP TABLE IF EXISTS {0}'.format(ratingstablename))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    finally:
+        sys.stdin = stdin
+        for path in paths:
+            os.remove(path)
+    return [True, None]
+
+
 def testrangepartition(MyAssignment, ratingstablename, n, openconnection, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE):
     """
     Tests the range partition function for Completness, Disjointness and Reconstruction
@@ -222,8 +428,8 @@ def testrangepartition(MyAssignment, ratingstablename, n, openconnection, partit
 
     try:
         MyAssignment.rangepartition(ratingstablename, n, openconnection)
-        testrangeandrobinpartitioning(n, openconnection, RANGE_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
-        testEachRangePartition(ratingstablename, n, openconnection, RANGE_TABLE_PREFIX)
+        checkpartitioning(ratingstablename, 'range', n, openconnection, RANGE_TABLE_PREFIX, partitionstartindex,
+                          ACTUAL_ROWS_IN_INPUT_FILE)
         return [True, None]
     except Exception as e:
         traceback.print_exc()
@@ -242,13 +448,65 @@ def testroundrobinpartition(MyAssignment, ratingstablename, numberofpartitions,
     """
     try:
         MyAssignment.roundrobinpartition(ratingstablename, numberofpartitions, openconnection)
-        testrangeandrobinpartitioning(numberofpartitions, openconnection, RROBIN_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
-        testEachRoundrobinPartition(ratingstablename, numberofpartitions, openconnection, RROBIN_TABLE_PREFIX)
+        checkpartitioning(ratingstablename, 'roundrobin', numberofpartitions, openconnection, RROBIN_TABLE_PREFIX,
+                          partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+def testparallelpartition(MyAssignment, ratingstablename, scheme, n, openconnection, partitiontableprefix,
+                          numberofworkers):
+    """
+    Tests the rangepartition or roundrobinpartition function with several workers, right after the partitions were
+    built with one: the partitions must hold the same rows and be logged tables again. A build of a missing table
+    must then fail and leave them as they were, without staging tables.
+    :param ratingstablename: Argument for function to be tested
+    :param scheme: 'range' or 'roundrobin', the function to be tested
+    :param n: Argument for function to be tested, the number of partitions of the previous build
+    :param openconnection: Argument for function to be tested
+    :param partitiontableprefix: Prefix of the partition tables of the scheme
+    :param numberofworkers: Argument for function to be tested
+    :return:Raises exception if any test fails
+    """
+    try:
+        partitionfunction = getattr(MyAssignment, scheme + 'partition')
+        # The main table is read in the same order by both builds, so each round robin partition gets the same rows
+        expected = [tablechecksum(partitiontableprefix + str(i), openconnection) for i in range(n)]
+        partitionfunction(ratingstablename, n, openconnection, numberofworkers=numberofworkers)
+        partitions = [tablechecksum(partitiontableprefix + str(i), openconnection) for i in range(n)]
+        if partitions != expected:
+            raise Exception('The {0} partitions built with {1} workers hold (rows, checksum) {2} instead of {3}'.format(
+                scheme, numberofworkers, partitions, expected))
+        with openconnection.cursor() as cur:
+            cur.execute("SELECT relname FROM pg_class WHERE relname LIKE %s AND relkind = 'r' AND relpersistence <> 'p'",
+                        (partitiontableprefix + '%',))
+            unlogged = [tablename for (tablename,) in cur.fetchall()]
+        if unlogged:
+            raise Exception('The {0} partitions {1} are not logged tables'.format(scheme, unlogged))
+
+        try:
+            partitionfunction('missing' + ratingstablename, n + 1, openconnection, numberofworkers=numberofworkers)
+        except psycopg2.Error:
+            if openconnection.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                openconnection.rollback()
+        else:
+            raise Exception('{0}partition of a missing table succeeded'.format(scheme))
+        partitions = [tablechecksum(partitiontableprefix + str(i), openconnection) for i in range(n)]
+        with openconnection.cursor() as cur:
+            checkpartitioncount(cur, n, partitiontableprefix)
+            cur.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = 'public' AND "
+                        "table_name LIKE '%\\_staging'")
+            staging = int(cur.fetchone()[0])
+        if partitions != expected or staging:
+            raise Exception('The failed {0} build left {1} staging tables and the partitions {2} instead of {3}'.format(
+                scheme, staging, partitions, expected))
     except Exception as e:
         traceback.print_exc()
         return [False, e]
     return [True, None]
 
+
 def testroundrobininsert(MyAssignment, ratingstablename, userid, itemid, rating, openconnection, expectedtableindex):
     """
     Tests the roundrobin insert function by checking whether the tuple is inserted in he Expected table you provide
@@ -262,8 +520,10 @@ def testroundrobininsert(MyAssignment, ratingstablename, userid, itemid, rating,
     """
     try:
         expectedtablename = RROBIN_TABLE_PREFIX + expectedtableindex
+        # The ratings file may already hold the tuple, so the insert must add exactly one more
+        before = countrows(expectedtablename, userid, itemid, rating, openconnection)
         MyAssignment.roundrobininsert(ratingstablename, userid, itemid, rating, openconnection)
-        if not testrangerobininsert(expectedtablename, itemid, openconnection, rating, userid):
+        if countrows(expectedtablename, userid, itemid, rating, openconnection) != before + 1:
             raise Exception(
                 'Round robin insert failed! Couldnt find ({0}, {1}, {2}) tuple in {3} table'.format(userid, itemid, rating,
                                                                                                     expectedtablename))
@@ -286,12 +546,684 @@ def testrangeinsert(MyAssignment, ratingstablename, userid, itemid, rating, open
     """
     try:
         expectedtablename = RANGE_TABLE_PREFIX + expectedtableindex
+        # The ratings file may already hold the tuple, so the insert must add exactly one more
+        before = countrows(expectedtablename, userid, itemid, rating, openconnection)
         MyAssignment.rangeinsert(ratingstablename, userid, itemid, rating, openconnection)
-        if not testrangerobininsert(expectedtablename, itemid, openconnection, rating, userid):
+        if countrows(expectedtablename, userid, itemid, rating, openconnection) != before + 1:
             raise Exception(
                 'Range insert failed! Couldnt find ({0}, {1}, {2}) tuple in {3} table'.format(userid, itemid, rating,
                                                                                               expectedtablename))
     except Exception as e:
         traceback.print_exc()
         return [False, e]
-    return [True, None]
\ No newline at end of file
+    return [True, None]
+
+def testinsertintransaction(MyAssignment, insertfunction, ratingstablename, userid, itemid, rating, openconnection,
+                            partitiontableprefix, expectedtableindex):
+    """
+    Tests an insert function called inside a 'with openconnection:' block, which must neither fail nor change the
+    session settings of the connection, by checking that the tuple is added to the Expected table you provide
+    :param insertfunction: Name of the function to be tested, 'rangeinsert' or 'roundrobininsert'
+    :param ratingstablename: Argument for function to be tested
+    :param userid: Argument for function to be tested
+    :param itemid: Argument for function to be tested
+    :param rating: Argument for function to be tested
+    :param openconnection: Argument for function to be tested
+    :param partitiontableprefix: Prefix of the partition tables of the function
+    :param expectedtableindex: The expected table to which the record has to be saved
+    :return:Raises exception if any test fails
+    """
+    try:
+        expectedtablename = partitiontableprefix + expectedtableindex
+        autocommit = openconnection.autocommit
+        with openconnection:
+            before = countrows(expectedtablename, userid, itemid, rating, openconnection)
+            getattr(MyAssignment, insertfunction)(ratingstablename, userid, itemid, rating, openconnection)
+        if openconnection.autocommit != autocommit:
+            raise Exception('{0} changed the autocommit setting of the connection'.format(insertfunction))
+        with openconnection:
+            after = countrows(expectedtablename, userid, itemid, rating, openconnection)
+        if after != before + 1:
+            raise Exception('{0} in a transaction failed! Couldnt find ({1}, {2}, {3}) tuple in {4} table'.format(
+                insertfunction, userid, itemid, rating, expectedtablename))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+# Rows a batch insert must refuse: a fractional userid, an itemid beyond the integer columns and a NaN userid
+MALFORMED_BATCH_ROWS = [(1.7, 10, 2.5), (1, 3e9, 2.5), (float('nan'), 10, 2.5)]
+
+
+def testinsertmanyrejects(MyAssignment, insertfunction, ratingstablename, openconnection):
+    """
+    Tests that a batch insert function refuses a batch with a malformed userid or itemid with ValueError, without
+    inserting its valid rows
+    :param insertfunction: Name of the function to be tested, 'rangeinsert_many' or 'roundrobininsert_many'
+    :param ratingstablename: Argument for function to be tested
+    :param openconnection: Argument for function to be tested
+    :return:Raises exception if any test fails
+    """
+    try:
+        with openconnection.cursor() as cur:
+            cur.execute('SELECT COUNT(*) FROM {0}'.format(ratingstablename))
+            before = int(cur.fetchone()[0])
+        for row in MALFORMED_BATCH_ROWS:
+            try:
+                getattr(MyAssignment, insertfunction)(ratingstablename, [(1, 10, 2.5), row], openconnection)
+            except ValueError:
+                pass
+            else:
+                raise Exception('{0} accepted the malformed row {1}'.format(insertfunction, row))
+        with openconnection.cursor() as cur:
+            cur.execute('SELECT COUNT(*) FROM {0}'.format(ratingstablename))
+            if int(cur.fetchone()[0]) != before:
+                raise Exception('{0} inserted rows of a refused batch'.format(insertfunction))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+def getshardconnection(MyAssignment, openconnection, shard):
+    """
+    Opens a connection to the shard node shard, a dict of getopenconnection arguments, those left out being the ones
+    of openconnection
+    """
+    info = openconnection.info
+    return MyAssignment.getopenconnection(shard.get('user', info.user), shard.get('password', info.password or ''),
+                                          shard.get('dbname', info.dbname), shard.get('host', info.host),
+                                          shard.get('port', info.port))
+
+
+def testshardedpartition(MyAssignment, ratingstablename, scheme, n, openconnection, partitiontableprefix, shards,
+                         rating, expectedtableindex):
+    """
+    Tests the rangepartition or roundrobinpartition function with shards: every partition must hold the rows of the
+    partition of a build on this node, on the shard of its index, and none may be left on this node. An insert must
+    then reach its partition on its shard, and rangequery and pointquery must read the rows of ratingstablename.
+    :param ratingstablename: Argument for functions to be tested
+    :param scheme: 'range' or 'roundrobin', the functions to be tested
+    :param n: Argument for function to be tested
+    :param openconnection: Argument for functions to be tested
+    :param partitiontableprefix: Prefix of the partition tables of the scheme
+    :param shards: Argument for function to be tested, dicts of getopenconnection arguments
+    :param rating: Argument for insert function to be tested, a (userid, itemid, rating) row
+    :param expectedtableindex: The expected table to which the row has to be saved
+    :return:Raises exception if any test fails
+    """
+    connections = []
+    try:
+        partitionfunction = getattr(MyAssignment, scheme + 'partition')
+        partitionfunction(ratingstablename, n, openconnection)
+        # The main table is read in the same order by both builds, so each round robin partition gets the same rows
+        expected = [tablechecksum(partitiontableprefix + str(i), openconnection) for i in range(n)]
+        partitionfunction(ratingstablename, n, openconnection, shards=shards)
+        with openconnection.cursor() as cur:
+            checkpartitioncount(cur, 0, partitiontableprefix)
+        connections.extend(getshardconnection(MyAssignment, openconnection, shard) for shard in shards)
+        for con in connections:
+            con.autocommit = True
+        partitions = [tablechecksum(partitiontableprefix + str(i), connections[i % len(shards)]) for i in range(n)]
+        if partitions != expected:
+            raise Exception('The {0} partitions on the shards hold (rows, checksum) {1} instead of {2}'.format(
+                scheme, partitions, expected))
+
+        expectedtablename = partitiontableprefix + expectedtableindex
+        shardconnection = connections[int(expectedtableindex) % len(shards)]
+        before = countrows(expectedtablename, *rating, shardconnection)
+        getattr(MyAssignment, scheme + 'insert')(ratingstablename, *rating, openconnection)
+        if countrows(expectedtablename, *rating, shardconnection) != before + 1:
+            raise Exception('Sharded {0} insert failed! Couldnt find {1} tuple in {2} table of its shard'.format(
+                scheme, rating, expectedtablename))
+
+        with openconnection.cursor() as cur:
+            cur.execute('SELECT COUNT(*) FILTER (WHERE {0} >= 1.5 AND {0} <= 3.5), COUNT(*) FILTER (WHERE {0} = 2.5) '
+                        'FROM {1}'.format(RATING_COLNAME, ratingstablename))
+            expected = [int(count) for count in cur.fetchone()]
+        actual = [sum(1 for _ in MyAssignment.rangequery(1.5, 3.5, openconnection, schemes=(scheme,))),
+                  sum(1 for _ in MyAssignment.pointquery(2.5, openconnection, schemes=(scheme,)))]
+        if actual != expected:
+            raise Exception('rangequery and pointquery over the sharded {0} partitions returned {1} rows instead of '
+                            '{2}'.format(scheme, actual, expected))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    finally:
+        for con in connections:
+            con.close()
+    return [True, None]
+
+
+def getanotherconnection(MyAssignment, openconnection):
+    """
+    Opens another connection to the database of openconnection with MyAssignment.getopenconnection
+    """
+    info = openconnection.info
+    return MyAssignment.getopenconnection(info.user, info.password or '', info.dbname, info.host, info.port)
+
+
+def rebuildrangepartitions(modulename, connectionparams, ratingstablename, n):
+    """
+    Rebuilds the range partitions with n partitions in a process of its own, which the caches of this one know
+    nothing about
+    """
+    MyAssignment = importlib.import_module(modulename)
+    con = MyAssignment.getopenconnection(**connectionparams)
+    try:
+        MyAssignment.rangepartition(ratingstablename, n, con)
+    finally:
+        con.close()
+
+
+def countqueryrows(MyAssignment, ratingstablename, ratingminvalue, ratingmaxvalue, openconnection):
+    """
+    Counts the rows of rangequery and pointquery over the range partitions and the rows of ratingstablename they
+    should return
+    :return: [rangequery rows, pointquery rows of ratingminvalue], [expected rows of both]
+    """
+    actual = [sum(1 for _ in MyAssignment.rangequery(ratingminvalue, ratingmaxvalue, openconnection, schemes=('range',))),
+              sum(1 for _ in MyAssignment.pointquery(ratingminvalue, openconnection, schemes=('range',)))]
+    with openconnection.cursor() as cur:
+        cur.execute('SELECT COUNT(*) FILTER (WHERE {0} >= %s AND {0} <= %s), COUNT(*) FILTER (WHERE {0} = %s) '
+                    'FROM {1}'.format(RATING_COLNAME, ratingstablename), (ratingminvalue, ratingmaxvalue, ratingminvalue))
+        expected = [int(count) for count in cur.fetchone()]
+    openconnection.commit()
+    return actual, expected
+
+
+def testqueriesafterrebuild(MyAssignment, ratingstablename, n, rebuiltn, openconnection, ratingminvalue, ratingmaxvalue):
+    """
+    Tests rangequery and pointquery after the range partitions are rebuilt by another process: the partitions are
+    built with n partitions and queried on one connection, rebuilt with rebuiltn partitions by another process,
+    then queried on a new connection and on the first one again
+    :param ratingstablename: Argument for function to be tested
+    :param n: Number of partitions of the first build
+    :param rebuiltn: Number of partitions of the rebuild
+    :param openconnection: Connection to the database, which is committed first so that the connections of the test
+                           see its work and do not wait for its locks
+    :param ratingminvalue: Argument for function to be tested
+    :param ratingmaxvalue: Argument for function to be tested
+    :return:Raises exception if any test fails
+    """
+    connections = []
+    try:
+        openconnection.commit()
+        builder = getanotherconnection(MyAssignment, openconnection)
+        connections.append(builder)
+        MyAssignment.rangepartition(ratingstablename, n, builder)
+        actual, expected = countqueryrows(MyAssignment, ratingstablename, ratingminvalue, ratingmaxvalue, builder)
+        if actual != expected:
+            raise Exception('Queries over {0} range partitions returned {1} rows instead of {2}'.format(n, actual, expected))
+
+        info = openconnection.info
+        process = multiprocessing.get_context('spawn').Process(target=rebuildrangepartitions, args=(
+            MyAssignment.__name__, dict(user=info.user, password=info.password or '', dbname=info.dbname,
+                                        host=info.host, port=info.port), ratingstablename, rebuiltn))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise Exception('Rebuilding {0} range partitions in another process failed'.format(rebuiltn))
+
+        newcomer = getanotherconnection(MyAssignment, openconnection)
+        connections.append(newcomer)
+        for name, con in (('a new', newcomer), ('the building', builder)):
+            actual, expected = countqueryrows(MyAssignment, ratingstablename, ratingminvalue, ratingmaxvalue, con)
+            if actual != expected:
+                raise Exception('Queries on {0} connection after the rebuild from {1} to {2} range partitions returned '
+                                '{3} rows instead of {4}'.format(name, n, rebuiltn, actual, expected))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    finally:
+        for con in connections:
+            con.close()
+    return [True, None]
+
+
+def partitionrowssql(partitiontableprefix, n):
+    """
+    Query of the rows of the partitions partitiontableprefix0 to partitiontableprefix(n - 1) with the index of their
+    partition in a partition column
+    """
+    return ' UNION ALL '.join('SELECT {0} AS partition, {1}, {2}, {3} FROM {4}{0}'.format(
+        i, USER_ID_COLNAME, MOVIE_ID_COLNAME, RATING_COLNAME, partitiontableprefix) for i in range(n))
+
+
+def isclose(value, expected):
+    return value is not None and expected is not None and abs(value - expected) <= 1e-9 * max(1.0, abs(expected))
+
+
+def testloadandpartition(MyAssignment, ratingstablename, filepath, openconnection, n, rowsininpfile):
+    """
+    Tests the load and partition function, which must give the partitions of loadratings followed by
+    rangepartition and roundrobinpartition
+    :param ratingstablename: Argument for function to be tested
+    :param filepath: Argument for function to be tested
+    :param openconnection: Argument for function to be tested
+    :param n: Number of partitions of both schemes, built with statistics
+    :param rowsininpfile: Number of rows in the input file provided for assertion
+    :return:Raises exception if any test fails
+    """
+    try:
+        MyAssignment.loadandpartition(ratingstablename, filepath, openconnection, n, schemes=('range', 'roundrobin'),
+                                      statistics=True)
+        with openconnection.cursor() as cur:
+            checkpartitioncount(cur, n, RANGE_TABLE_PREFIX)
+            checkpartitioncount(cur, n, RROBIN_TABLE_PREFIX)
+        checkpartitioning(ratingstablename, 'range', n, openconnection, RANGE_TABLE_PREFIX, 0, rowsininpfile)
+        checkpartitioning(ratingstablename, 'roundrobin', n, openconnection, RROBIN_TABLE_PREFIX, 0, rowsininpfile)
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testrepartition(MyAssignment, ratingstablename, scheme, n, openconnection, partitiontableprefix):
+    """
+    Tests the rangerepartition or roundrobinrepartition function, which must leave the partitions a fresh
+    partitioning of ratingstablename into n partitions would give
+    :param scheme: 'range' or 'roundrobin', the function to be tested
+    :param ratingstablename: Argument for function to be tested
+    :param n: Argument for function to be tested
+    :param openconnection: Argument for function to be tested
+    :param partitiontableprefix: Prefix of the partition tables of the scheme
+    :return:Raises exception if any test fails
+    """
+    try:
+        moved = getattr(MyAssignment, scheme + 'repartition')(ratingstablename, n, openconnection)
+        with openconnection.cursor() as cur:
+            checkpartitioncount(cur, n, partitiontableprefix)
+            cur.execute('SELECT COUNT(*) FROM {0}'.format(ratingstablename))
+            count = int(cur.fetchone()[0])
+        if not 0 <= moved <= count:
+            raise Exception('{0}repartition moved {1} of {2} rows'.format(scheme, moved, count))
+        checkpartitioning(ratingstablename, scheme, n, openconnection, partitiontableprefix, 0, count)
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testinsertmany(MyAssignment, insertfunction, ratingstablename, ratings, openconnection, partitiontableprefix,
+                   expectedtableindexes):
+    """
+    Tests the rangeinsert_many or roundrobininsert_many function by checking that every row is added to its Expected
+    table
+    :param insertfunction: Name of the function to be tested
+    :param ratingstablename: Argument for function to be tested
+    :param ratings: Argument for function to be tested, rows that are all different
+    :param openconnection: Argument for function to be tested
+    :param partitiontableprefix: Prefix of the partition tables of the function
+    :param expectedtableindexes: The expected table of every row
+    :return:Raises exception if any test fails
+    """
+    try:
+        expectedtablenames = [partitiontableprefix + index for index in expectedtableindexes]
+        before = [countrows(tablename, *row, openconnection) for tablename, row in zip(expectedtablenames, ratings)]
+        getattr(MyAssignment, insertfunction)(ratingstablename, ratings, openconnection)
+        for tablename, row, count in zip(expectedtablenames, ratings, before):
+            if countrows(tablename, *row, openconnection) != count + 1:
+                raise Exception('{0} failed! Couldnt find {1} tuple in {2} table'.format(insertfunction, row, tablename))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testratingstats(MyAssignment, ratingstablename, scheme, n, ratings, openconnection, partitiontableprefix):
+    """
+    Tests the ratingstats and checkstats functions against the rows of the partitions, built with statistics, after
+    the first row of ratings is inserted by the single and the others by the batch insert function of the scheme
+    :param ratingstablename: Argument for functions to be tested
+    :param scheme: Argument for functions to be tested
+    :param n: Argument for function to be tested
+    :param ratings: Rows to insert
+    :param openconnection: Argument for functions to be tested
+    :param partitiontableprefix: Prefix of the partition tables of the scheme
+    :return:Raises exception if any test fails
+    """
+    try:
+        getattr(MyAssignment, scheme + 'partition')(ratingstablename, n, openconnection, statistics=True)
+        getattr(MyAssignment, scheme + 'insert')(ratingstablename, *ratings[0], openconnection)
+        getattr(MyAssignment, scheme + 'insert_many')(ratingstablename, ratings[1:], openconnection)
+        with openconnection.cursor() as cur:
+            cur.execute('SELECT COUNT(*), SUM({0}), MIN({0}), MAX({0}) FROM ({1}) AS T'.format(
+                RATING_COLNAME, partitionrowssql(partitiontableprefix, n)))
+            rows, ratingsum, minrating, maxrating = cur.fetchone()
+            cur.execute('SELECT {0}, COUNT(*), SUM({1}) FROM ({2}) AS T GROUP BY {0} ORDER BY 2 DESC, 1 LIMIT 1'.format(
+                MOVIE_ID_COLNAME, RATING_COLNAME, partitionrowssql(partitiontableprefix, n)))
+            movieid, movierows, moviesum = cur.fetchone()
+
+        stats = MyAssignment.ratingstats(scheme, openconnection)
+        if (stats['rows'] != rows or not isclose(stats['sum'], ratingsum) or stats['min'] != minrating
+                or stats['max'] != maxrating):
+            raise Exception('ratingstats gave {0} rows, sum {1}, min {2}, max {3} of the {4} partitions instead of {5}, '
+                            '{6}, {7}, {8}'.format(stats['rows'], stats['sum'], stats['min'], stats['max'], scheme,
+                                                   rows, ratingsum, minrating, maxrating))
+        stats = MyAssignment.ratingstats(scheme, openconnection, movieid=movieid)
+        if stats['rows'] != movierows or not isclose(stats['sum'], moviesum):
+            raise Exception('ratingstats gave {0} rows and sum {1} of movie {2} instead of {3} and {4}'.format(
+                stats['rows'], stats['sum'], movieid, movierows, moviesum))
+
+        differences = MyAssignment.checkstats(scheme, openconnection)
+        if differences:
+            raise Exception('checkstats found differences in the {0} statistics: {1}'.format(scheme, differences))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testaggregate(MyAssignment, scheme, n, openconnection, partitiontableprefix, ratingminvalue, ratingmaxvalue):
+    """
+    Tests the aggregate function against the rows of the partitions, over a range of ratings and grouped by movie
+    :param scheme: Argument for function to be tested
+    :param n: Number of partitions of the scheme
+    :param openconnection: Argument for function to be tested
+    :param partitiontableprefix: Prefix of the partition tables of the scheme
+    :param ratingminvalue: Argument for function to be tested
+    :param ratingmaxvalue: Argument for function to be tested
+    :return:Raises exception if any test fails
+    """
+    try:
+        with openconnection.cursor() as cur:
+            cur.execute('SELECT COUNT(*), SUM({0}), AVG({0}), MIN({0}), MAX({0}) FROM ({1}) AS T '
+                        'WHERE {0} >= %s AND {0} <= %s'.format(RATING_COLNAME, partitionrowssql(partitiontableprefix, n)),
+                        (ratingminvalue, ratingmaxvalue))
+            expected = dict(zip(('count', 'sum', 'avg', 'min', 'max'), cur.fetchone()))
+            cur.execute('SELECT COUNT(*) FROM ({0}) AS T GROUP BY {1} ORDER BY 1 DESC LIMIT 5'.format(
+                partitionrowssql(partitiontableprefix, n), MOVIE_ID_COLNAME))
+            expectedcounts = [int(count) for (count,) in cur.fetchall()]
+
+        result = MyAssignment.aggregate(scheme, openconnection, ratingminvalue=ratingminvalue,
+                                        ratingmaxvalue=ratingmaxvalue)
+        if (result['count'] != expected['count'] or not isclose(result['sum'], expected['sum'])
+                or not isclose(result['avg'], expected['avg']) or result['min'] != expected['min']
+                or result['max'] != expected['max']):
+            raise Exception('aggregate over the {0} partitions gave {1} instead of {2}'.format(scheme, result, expected))
+        grouped = MyAssignment.aggregate(scheme, openconnection, functions=('count',), groupby=MOVIE_ID_COLNAME,
+                                         orderby='count', limit=5)
+        counts = [int(count) for count in grouped['count']]
+        if counts != expectedcounts:
+            raise Exception('aggregate gave the top movie counts {0} instead of {1}'.format(counts, expectedcounts))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testconnectionpool(MyAssignment, ratingstablename, n, openconnection, ratingvalue):
+    """
+    Tests the connection pool: a query over a pool must return the rows it returns over a connection, a caller must
+    not get a connection while the only one is checked out, and the partition builds must work with that single
+    connection, range partitioning on it alone and round robin partitioning, which needs two, refusing to start
+    :param ratingstablename: Argument for functions to be tested
+    :param n: Number of the range partitions, which are rebuilt over the pool
+    :param openconnection: Connection to the database of the pool
+    :param ratingvalue: Rating of the pointquery run over the pool
+    :return:Raises exception if any test fails
+    """
+    pool = None
+    try:
+        info = openconnection.info
+        pool = MyAssignment.ConnectionPool(minconn=0, maxconn=1, user=info.user, password=info.password or '',
+                                           dbname=info.dbname, host=info.host, port=info.port)
+        expected = sorted(MyAssignment.pointquery(ratingvalue, openconnection, schemes=('range',)))
+        rows = sorted(MyAssignment.pointquery(ratingvalue, pool, schemes=('range',)))
+        if rows != expected:
+            raise Exception('pointquery over the pool returned {0} rows instead of {1}'.format(len(rows), len(expected)))
+
+        with pool.connection():
+            try:
+                pool.getconn(timeout=0.1)
+            except psycopg2.pool.PoolError:
+                pass
+            else:
+                raise Exception('The pool handed out more than its maxconn of 1 connection')
+        pool.putconn(pool.getconn(timeout=0.1))
+
+        MyAssignment.rangepartition(ratingstablename, n, pool, numberofworkers=2)
+        checkpartitioning(ratingstablename, 'range', n, openconnection, RANGE_TABLE_PREFIX, 0, None)
+        try:
+            MyAssignment.roundrobinpartition(ratingstablename, n, pool)
+        except psycopg2.pool.PoolError:
+            pass
+        else:
+            raise Exception('roundrobinpartition ran over a pool of 1 connection')
+        with openconnection.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = 'public' AND "
+                        "table_name LIKE '%\\_staging'")
+            if int(cur.fetchone()[0]) != 0:
+                raise Exception('The partition builds over the pool left staging tables')
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    finally:
+        if pool is not None:
+            pool.closeall()
+    return [True, None]
+
+
+def testbufferedwriter(MyAssignment, ratingstablename, scheme, ratings, openconnection, partitiontableprefix,
+                       expectedtableindexes):
+    """
+    Tests the buffered writer over a connection pool by checking that every row is added to its Expected table once
+    its future resolved
+    :param ratingstablename: Argument for function to be tested
+    :param scheme: Argument for function to be tested
+    :param ratings: Rows to insert, all different
+    :param openconnection: Connection to the database of the pool of the writer
+    :param partitiontableprefix: Prefix of the partition tables of the scheme
+    :param expectedtableindexes: The expected table of every row
+    :return:Raises exception if any test fails
+    """
+    pool = None
+    try:
+        info = openconnection.info
+        pool = MyAssignment.ConnectionPool(minconn=1, maxconn=2, user=info.user, password=info.password or '',
+                                           dbname=info.dbname, host=info.host, port=info.port)
+        expectedtablenames = [partitiontableprefix + index for index in expectedtableindexes]
+        before = [countrows(tablename, *row, openconnection) for tablename, row in zip(expectedtablenames, ratings)]
+        with MyAssignment.BufferedWriter(ratingstablename, pool, scheme=scheme) as writer:
+            futures = [writer.insert(*row) for row in ratings]
+        for future in futures:
+            future.result()
+        for tablename, row, count in zip(expectedtablenames, ratings, before):
+            if countrows(tablename, *row, openconnection) != count + 1:
+                raise Exception('BufferedWriter failed! Couldnt find {0} tuple in {1} table'.format(row, tablename))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    finally:
+        if pool is not None:
+            pool.closeall()
+    return [True, None]
+
+
+def testhashpartition(MyAssignment, ratingstablename, n, key, openconnection):
+    """
+    Tests the hash partition function: the partitions must hold all rows of ratingstablename, all rows of a key in the
+    same partition
+    :param ratingstablename: Argument for function to be tested
+    :param n: Argument for function to be tested
+    :param key: Argument for function to be tested
+    :param openconnection: Argument for function to be tested
+    :return:Raises exception if any test fails
+    """
+    try:
+        MyAssignment.hashpartition(ratingstablename, n, key, openconnection)
+        with openconnection.cursor() as cur:
+            checkpartitioncount(cur, n, HASH_TABLE_PREFIX)
+            cur.execute('SELECT COUNT(*) FROM {0}'.format(ratingstablename))
+            count = int(cur.fetchone()[0])
+            cur.execute('SELECT COUNT(*) FROM ({0}) AS T'.format(partitionrowssql(HASH_TABLE_PREFIX, n)))
+            partitioned = int(cur.fetchone()[0])
+            if partitioned != count:
+                raise Exception('The hash partitions hold {0} rows instead of {1}'.format(partitioned, count))
+            cur.execute('SELECT {0} FROM ({1}) AS T GROUP BY {0} HAVING COUNT(DISTINCT partition) > 1 LIMIT 1'.format(
+                key, partitionrowssql(HASH_TABLE_PREFIX, n)))
+            split = cur.fetchone()
+            if split is not None:
+                raise Exception('The rows of {0} {1} are in more than one hash partition'.format(key, split[0]))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testhashinsert(MyAssignment, ratingstablename, userid, itemid, rating, openconnection):
+    """
+    Tests the hash insert and hash query functions over hash partitions by userid: the query must return the
+    inserted tuple with all rows of the user, from a single partition
+    :param ratingstablename: Argument for function to be tested
+    :param userid: Argument for function to be tested
+    :param itemid: Argument for function to be tested
+    :param rating: Argument for function to be tested
+    :param openconnection: Argument for function to be tested
+    :return:Raises exception if any test fails
+    """
+    try:
+        before = list(MyAssignment.hashquery(userid, openconnection))
+        MyAssignment.hashinsert(ratingstablename, userid, itemid, rating, openconnection)
+        rows = list(MyAssignment.hashquery(userid, openconnection))
+        with openconnection.cursor() as cur:
+            cur.execute('SELECT COUNT(*) FROM {0} WHERE {1} = %s'.format(ratingstablename, USER_ID_COLNAME), (userid,))
+            count = int(cur.fetchone()[0])
+        if len(rows) != len(before) + 1 or len(rows) != count:
+            raise Exception('hashquery returned {0} rows of user {1} after the insert instead of {2}'.format(
+                len(rows), userid, count))
+        if (userid, itemid, rating) not in [tuple(row[1:]) for row in rows]:
+            raise Exception('Hash insert failed! Couldnt find ({0}, {1}, {2}) tuple'.format(userid, itemid, rating))
+        if len({row[0] for row in rows}) != 1:
+            raise Exception('hashquery read the rows of user {0} from more than one partition'.format(userid))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+# Rows of the load that fails in testloadprogress, more than one chunk of the text copy format
+LOADPROGRESS_ROWS = 150000
+
+
+def testloadprogress(MyAssignment, ratingstablename, openconnection):
+    """
+    Tests the load progress function: a resumable load that fails on a malformed line at the end of the file must
+    leave the progress of the rows it committed, and a complete load none
+    :param ratingstablename: Argument for function to be tested, a table of its own
+    :param openconnection: Argument for function to be tested
+    :return:Raises exception if any test fails
+    """
+    fd, filepath = tempfile.mkstemp(suffix='.dat')
+    try:
+        if MyAssignment.loadprogress(ratingstablename, openconnection) is not None:
+            raise Exception('loadprogress reported a load of {0} before any'.format(ratingstablename))
+        with os.fdopen(os.open(filepath, os.O_WRONLY | os.O_TRUNC), 'wb') as f:
+            f.write(b'1::10::3.5::838985046\n' * LOADPROGRESS_ROWS)
+            validbytes = f.tell()
+            f.write(COPYFORMAT_MALFORMED_LINE)
+        try:
+            MyAssignment.loadratings(ratingstablename, filepath, openconnection, resume=True)
+        except (ValueError, psycopg2.DataError):
+            if openconnection.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                openconnection.rollback()
+        else:
+            raise Exception('The resumable load loaded the malformed line {0!r}'.format(COPYFORMAT_MALFORMED_LINE))
+
+        progress = MyAssignment.loadprogress(ratingstablename, openconnection)
+        with openconnection.cursor() as cur:
+            cur.execute('SELECT COUNT(*) FROM {0}'.format(ratingstablename))
+            count = int(cur.fetchone()[0])
+        if progress is None or progress['rows'] != count or not 0 < count < LOADPROGRESS_ROWS:
+            raise Exception('loadprogress reported {0} after {1} of {2} rows were loaded'.format(
+                progress, count, LOADPROGRESS_ROWS))
+        if not 0 < progress['fraction'] < 1:
+            raise Exception('loadprogress reported the fraction {0} of an unfinished load'.format(progress['fraction']))
+
+        os.truncate(filepath, validbytes)
+        MyAssignment.loadratings(ratingstablename, filepath, openconnection, resume=True)
+        progress = MyAssignment.loadprogress(ratingstablename, openconnection)
+        if progress is not None:
+            raise Exception('loadprogress reported {0} after the load was complete'.format(progress))
+        with openconnection.cursor() as cur:
+            cur.execute('DROP TABLE IF EXISTS {0}'.format(ratingstablename))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    finally:
+        os.close(fd)
+        os.remove(filepath)
+    return [True, None]
+
+
+def testinstrumentation(MyAssignment, Instrumentation, scheme, openconnection):
+    """
+    Tests that an operation run while instrumented is reported to the sink once, and that the instrumentation is
+    disabled again afterwards
+    :param Instrumentation: The instrumentation module of MyAssignment
+    :param scheme: Partitions the aggregate operation reads
+    :param openconnection: Argument for function to be tested
+    :return:Raises exception if any test fails
+    """
+    try:
+        sink = Instrumentation.MemorySink()
+        with Instrumentation.instrumented(sink):
+            MyAssignment.aggregate(scheme, openconnection)
+        total = sink.totals().get('aggregate')
+        if total is None or total['calls'] != 1 or total['errors'] or not total['statements']:
+            raise Exception('The instrumentation recorded {0} for one aggregate call'.format(total))
+        if Instrumentation.isenabled():
+            raise Exception('The instrumentation stayed enabled after the instrumented block')
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+async def runasyncinterface(AsyncInterface, ratingstablename, scheme, n, rating, openconnection, maxconn,
+                            filepath=None):
+    info = openconnection.info
+    pool = await AsyncInterface.getopenpool(info.user, info.password or '', info.dbname, info.host, info.port,
+                                            maxconn=maxconn)
+    try:
+        if filepath is not None:
+            await AsyncInterface.loadratings(ratingstablename, filepath, pool, numberofworkers=maxconn)
+        await getattr(AsyncInterface, scheme + 'partition')(ratingstablename, n, pool)
+        await getattr(AsyncInterface, scheme + 'insert')(ratingstablename, *rating, pool)
+    finally:
+        await AsyncInterface.closepool(pool)
+
+
+def testasyncinterface(AsyncInterface, ratingstablename, filepath, n, ratings, openconnection, rowsininpfile,
+                       expectedtableindexes, maxconn):
+    """
+    Tests the functions of the asyncio interface over a pool of the database of openconnection: the file is loaded,
+    range partitioned and one row inserted by range, then the table is round robin partitioned and another row
+    inserted by round robin
+    :param AsyncInterface: The asyncio interface module
+    :param ratingstablename: Argument for functions to be tested
+    :param filepath: Argument for function to be tested
+    :param n: Number of partitions of both schemes
+    :param ratings: The range and the round robin inserted rows
+    :param openconnection: Connection to the database of the pool
+    :param rowsininpfile: Number of rows in the input file provided for assertion
+    :param expectedtableindexes: The expected range and round robin table of the inserted rows
+    :param maxconn: Connections of the pool and workers of the load, the builds must also work with fewer
+                    connections than partitions
+    :return:Raises exception if any test fails
+    """
+    try:
+        for scheme, partitiontableprefix, rating, index, rows, source in (
+                ('range', RANGE_TABLE_PREFIX, ratings[0], expectedtableindexes[0], rowsininpfile + 1, filepath),
+                ('roundrobin', RROBIN_TABLE_PREFIX, ratings[1], expectedtableindexes[1], rowsininpfile + 2, None)):
+            asyncio.run(runasyncinterface(AsyncInterface, ratingstablename, scheme, n, rating, openconnection, maxconn,
+                                          source))
+            checkpartitioning(ratingstablename, scheme, n, openconnection, partitiontableprefix, 0, rows)
+            if countrows(partitiontableprefix + index, *rating, openconnection) != 1:
+                raise Exception('Async {0} insert failed! Couldnt find {1} tuple in {2}{3} table'.format(
+                    scheme, rating, partitiontableprefix, index))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]